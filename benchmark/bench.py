@@ -0,0 +1,270 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parents[1]
+for folder in ['oacd', 'monotherapy', 'validation']:
+    sys.path.append(str(ROOT / folder))
+sys.path.append(str(ROOT))
+
+import curves
+import monotherapy
+import validation
+from oacd import ExperimentResult, write_result_excel
+from ranking import ComboRanker
+from regression import QuadraticRegression
+from synthetic import make_monotherapy_workbook, make_oacd_workbook, make_validation_workbook
+
+from common import workbook
+from common.profiling import Profiler
+from common.store import open_result_store, save_tables
+
+BASELINE_FILE = str(Path(__file__).resolve().parent / 'baselines.json')
+
+# name: (pipeline, workbook generator arguments); 'small' matches the shipped workbooks
+CASES = {'oacd-small': ('oacd', {'n_drugs': 12, 'n_combos': 100, 'n_sets': 6}),
+         'oacd-medium': ('oacd', {'n_drugs': 14, 'n_combos': 200, 'n_sets': 12}),
+         'oacd-large': ('oacd', {'n_drugs': 16, 'n_combos': 400, 'n_sets': 24}),
+         'monotherapy-small': ('monotherapy', {'n_drugs': 12}),
+         'monotherapy-large': ('monotherapy', {'n_drugs': 192, 'n_conc': 12}),
+         'validation-small': ('validation', {'n_combos': 27}),
+         'validation-large': ('validation', {'n_combos': 108})}
+DEFAULT_CASES = ['oacd-small', 'oacd-medium', 'monotherapy-small', 'monotherapy-large', 'validation-small',
+                 'validation-large']
+
+GENERATORS = {'oacd': make_oacd_workbook, 'monotherapy': make_monotherapy_workbook,
+              'validation': make_validation_workbook}
+
+VALIDATION_SHEETS = ['exp3_viral', 'exp3_veroe6', 'exp3_ac16', 'exp3_ac16_2', 'exp3_thle2', 'exp3_thle2_2']
+
+
+def get_workbook_name(folder, case):
+    pipeline, kwargs = CASES[case]
+    suffix = '_'.join(key + str(value) for key, value in sorted(kwargs.items()))
+
+    return str(Path(folder) / (pipeline + '_' + suffix + '.xlsx'))
+
+
+# every repetition parses the workbook from scratch: no in-process cache, no snapshot next to the file
+def clear_workbook_cache(file_name):
+    workbook._open_workbooks.clear()
+    for snapshot in Path(file_name).parent.glob('.' + Path(file_name).name + '.*.snapshot.npz'):
+        snapshot.unlink()
+
+
+# load -> normalize -> fit -> rank -> report of oacd.py
+def run_oacd(file_name, folder, profiler):
+    with profiler.stage('load') as record:
+        res = ExperimentResult(file_name)
+        res.check_linear_dependency()
+        record['rows'] = res.df_oacd.shape[0] + res.df_mono_X.shape[0]
+
+    with profiler.stage('normalize') as record:
+        res.process_raw_data()
+        res.normalize()
+        res.beautify_result()
+        record['rows'] = res.df_all_y.shape[0]
+
+    with profiler.stage('fit') as record:
+        model = QuadraticRegression(pd.concat([res.df_x_conc, res.df_mono_conc], ignore_index=True), res.df_all_y)
+        model.fit()
+        record['rows'] = model.x.shape[0]
+
+    with profiler.stage('rank') as record:
+        ranker = ComboRanker(model, res.df_conc_table)
+        ranker.rank()
+        record['rows'] = ranker.n_scored
+
+    with profiler.stage('report') as record:
+        save_tables(open_result_store(folder / 'results'), str(folder / 'OACD_result.xlsx'), res.get_tables(),
+                    write_result_excel, excel=True)
+        model.save_file_excel(str(folder / 'regr_final.xlsx'))
+        ranker.save_file_excel(str(folder / 'OACD_subsets.xlsx'))
+        record['rows'] = sum(df.shape[0] for df in res.get_tables().values())
+
+
+# load -> normalize -> fit -> report of monotherapy.py, the curves are fitted cold (no earlier run)
+def run_monotherapy(file_name, folder, profiler):
+    with profiler.stage('load') as record:
+        df_dmso = workbook.open_workbook(file_name).parse('Solvent')
+        drug_names, eff, ver, n_rows = monotherapy.get_batch_data(file_name, df_dmso['Drug'])
+        dmso = df_dmso.set_index('Drug').loc[drug_names, 'DMSO'].values
+        record['rows'] = int(n_rows.sum())
+
+    with profiler.stage('normalize', rows=int(n_rows.sum())):
+        inhibition, cytotoxicity = monotherapy.calculate_y_batch(dmso, eff, ver)
+
+    with profiler.stage('fit', rows=2 * len(drug_names)):
+        df_fits = curves.fit_dose_response(drug_names, eff[:, :, 0], ver[:, :, 0], inhibition, cytotoxicity)
+        df_selectivity = curves.get_selectivity(df_fits)
+
+    with profiler.stage('report') as record:
+        tables = monotherapy.get_result_tables(drug_names, ver[:, :, 0], inhibition, cytotoxicity, n_rows)
+        tables['Curve fits'] = df_fits
+        tables['Selectivity'] = df_selectivity
+        save_tables(open_result_store(folder / 'results'), str(folder / 'Monotherapy_result.xlsx'), tables,
+                    monotherapy.write_excel, excel=True)
+        record['rows'] = sum(df.shape[0] for df in tables.values())
+
+
+# load -> normalize -> stats -> report of validation.py, the statistical tests run over every combination
+def run_validation(file_name, folder, profiler):
+    with profiler.stage('load') as record:
+        dfs = [validation.get_raw_data(file_name, sheet_name) for sheet_name in VALIDATION_SHEETS]
+        dfs[2:] = [validation.subtract_blank(df) for df in dfs[2:]]
+        x = validation.get_raw_data(file_name, 'exp2_result')
+        record['rows'] = sum(df.shape[0] for df in dfs)
+
+    with profiler.stage('normalize') as record:
+        df_inhibition = validation.calculate_y(dfs[0], 'viral plate')
+        df_cyt = [validation.calculate_y(df, 'drug plate') for df in dfs[1:]]
+        df_cyt_vero = df_cyt[0]
+        df_cyt_ac = pd.concat(df_cyt[1:3], ignore_index=True)
+        df_cyt_thle = pd.concat(df_cyt[3:5], ignore_index=True)
+        record['rows'] = df_inhibition.shape[0] * 4
+
+    with profiler.stage('stats') as record:
+        combo = list(range(1, x.shape[0] + 1))
+        results = [validation.do_non_normality_procedure(df.copy(), combo, 'benchmark', fig_name)
+                   for df, fig_name in zip([df_inhibition, df_cyt_vero, df_cyt_ac, df_cyt_thle],
+                                           ['% Inhibition', '% Vero E6 Cytotoxicity', '% AC16 Cytotoxicity',
+                                            '% THLE-2 Cytotoxicity'])]
+        validation.save_stats(str(folder / 'Validation_stats.xlsx'), results)
+        record['rows'] = sum(r[1].shape[0] for r in results)
+
+    with profiler.stage('report') as record:
+        tables = validation.get_result_tables(x, *validation.compile_result(x, df_inhibition, df_cyt_vero,
+                                                                            df_cyt_ac, df_cyt_thle))
+        save_tables(open_result_store(folder / 'results'), str(folder / 'Validation_result.xlsx'), tables,
+                    validation.write_excel, excel=True)
+        record['rows'] = sum(df.shape[0] for df in tables.values())
+
+
+PIPELINES = {'oacd': run_oacd, 'monotherapy': run_monotherapy, 'validation': run_validation}
+
+
+# median wall/CPU time of every stage over the repetitions, outputs are rewritten each time; memory tracing
+# (peak_mb) slows the stages down and is off unless asked for
+def run_case(case, work_dir, repeat=3, trace_memory=False, verbose=False):
+    pipeline, kwargs = CASES[case]
+    file_name = get_workbook_name(work_dir, case)
+    if not Path(file_name).exists():
+        GENERATORS[pipeline](file_name, **kwargs)
+
+    runs = []
+    for _ in range(repeat):
+        folder = Path(work_dir) / case
+        shutil.rmtree(str(folder), ignore_errors=True)
+        folder.mkdir(parents=True)
+        clear_workbook_cache(file_name)
+
+        profiler = Profiler(case, trace_memory=trace_memory)
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            PIPELINES[pipeline](file_name, folder, profiler)
+        runs.append(profiler.stages)
+
+    stages = {}
+    for records in zip(*runs):
+        stages[records[0]['stage']] = {'rows': records[0]['rows'],
+                                       'wall_s': float(np.median([r['wall_s'] for r in records])),
+                                       'cpu_s': float(np.median([r['cpu_s'] for r in records]))}
+        if trace_memory:
+            stages[records[0]['stage']]['peak_mb'] = max(r['peak_mb'] for r in records)
+
+    return {'pipeline': pipeline, 'params': kwargs, 'repeat': repeat, 'stages': stages}
+
+
+# A stage regresses when it is slower than its baseline by more than the relative tolerance and by more
+# than min_s seconds, so sub-millisecond stages do not flag on timer noise.
+def compare(results, baselines, tolerance=0.25, min_s=0.05):
+    rows = []
+    for case, result in results.items():
+        base = baselines.get('cases', {}).get(case)
+        for stage, record in result['stages'].items():
+            base_s = base['stages'].get(stage, {}).get('wall_s') if base is not None else None
+            if base_s is None:
+                status, ratio = 'new', np.nan
+            else:
+                ratio = record['wall_s'] / base_s if base_s > 0 else np.inf
+                slower = record['wall_s'] > base_s * (1 + tolerance) and record['wall_s'] - base_s > min_s
+                faster = record['wall_s'] < base_s / (1 + tolerance) and base_s - record['wall_s'] > min_s
+                status = 'regression' if slower else ('improved' if faster else 'ok')
+            rows.append([case, stage, record['rows'], base_s, record['wall_s'], ratio, status])
+
+    return pd.DataFrame(rows, columns=['Case', 'Stage', 'Rows', 'Baseline (s)', 'Wall (s)', 'Ratio', 'Status'])
+
+
+def load_baselines(file_name):
+    if not Path(file_name).exists():
+        return {'cases': {}}
+
+    return json.loads(Path(file_name).read_text())
+
+
+def save_baselines(file_name, baselines, results):
+    baselines['python'] = platform.python_version()
+    baselines['platform'] = platform.platform()
+    baselines['cases'].update(results)
+    Path(file_name).write_text(json.dumps(baselines, indent=1))
+    print('...baselines have been saved to', file_name)
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipelines on synthetic workbooks.')
+    parser.add_argument('cases', nargs='*', default=DEFAULT_CASES,
+                        help='cases to run (' + ', '.join(CASES) + '), default: all but oacd-large')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per case, the median is reported')
+    parser.add_argument('--work-dir', default=None, help='folder for workbooks and outputs, default: temporary')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline JSON file')
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slow-down per stage')
+    parser.add_argument('--output', default=None, help='write the results of this run as JSON')
+    parser.add_argument('--memory', action='store_true', help='also trace the peak memory of every stage')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the pipelines')
+
+    args = parser.parse_args(argv)
+    unknown = [case for case in args.cases if case not in CASES]
+    if unknown:
+        parser.error('unknown case ' + ', '.join(unknown))
+
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='identifai_bench_')
+
+    results = {}
+    for case in args.cases:
+        print('Running', case, '...')
+        results[case] = run_case(case, work_dir, repeat=args.repeat, trace_memory=args.memory,
+                                 verbose=args.verbose)
+
+    baselines = load_baselines(args.baseline)
+    if baselines.get('platform') not in (None, platform.platform()):
+        print('...baselines were recorded on', baselines['platform'], '- timings may not be comparable')
+    df = compare(results, baselines, tolerance=args.tolerance)
+    with pd.option_context('display.width', 200, 'display.max_rows', None):
+        print(df.to_string(index=False, float_format='{:.3f}'.format))
+    n_new = int((df['Status'] == 'new').sum())
+    if n_new and not args.update_baseline:
+        print('...' + str(n_new) + ' stage(s) have no baseline and are not checked, record them with --update-baseline')
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=1))
+    if args.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.update_baseline:
+        save_baselines(args.baseline, baselines, results)
+    elif (df['Status'] == 'regression').any():
+        sys.exit(1)
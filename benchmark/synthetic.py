@@ -0,0 +1,207 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'oacd'))
+from oacd import get_default_plate_map
+
+# raw read of each control column, close to the levels of the shipped workbooks
+CONTROL_LEVELS = {'DMSO Eff': 6.0e4, 'No DMSO Eff': 6.0e4, 'Cells Eff': 3.3e5, 'Virus Eff': 5.5e4,
+                  'DMSO Vero': 3.7e5, 'No DMSO Vero': 3.7e5,
+                  'DMSO Cardiac': 6.0e6, 'No DMSO Cardiac': 6.0e6, 'Blank Cardiac': 2.5e3,
+                  'DMSO Liver': 7.0e5, 'No DMSO Liver': 7.0e5, 'Blank Liver': 4.5e2}
+
+# monotherapy/validation sheets: control column -> raw read on the viral and on the drug plate
+SHEET_CONTROLS = {'DMSO (G10-12)': (2.5e4, 3.5e5), 'Cells+media (H)': (2.4e5, 3.5e5),
+                  'Cells+media+virus (H)': (2.5e4, 4.0e4)}
+
+
+def get_drug_names(n_drugs):
+    return ['Drug ' + str(i + 1) for i in range(n_drugs)]
+
+
+# true quadratic responses on doses scaled to [0, 1]: %inhibition first, then the cytotoxicity outputs
+def get_responses(x, rng, n_out=4):
+    n_drugs = x.shape[1]
+    linear = np.column_stack([rng.uniform(0, 40, n_drugs)] + [rng.uniform(0, 10, n_drugs)] * (n_out - 1))
+    quadratic = rng.normal(0, 4, (n_out, n_drugs, n_drugs))
+    pair = np.einsum('ni,kij,nj->nk', x, quadratic, x)
+
+    return np.clip(x @ linear / np.sqrt(n_drugs) + pair / n_drugs, -20, 120)
+
+
+# multiplicative read noise
+def add_noise(values, rng, cv=0.05):
+    return values * rng.lognormal(0, cv, np.shape(values))
+
+
+# balanced random OACD-like array: every drug uses each dose level equally often
+def get_design_codes(n_combos, n_drugs, n_levels, rng):
+    return np.column_stack([rng.permutation(np.arange(n_combos) % n_levels) for _ in range(n_drugs)])
+
+
+def get_conc_table(drug_names, n_levels, rng):
+    df = pd.DataFrame({'Dose level': np.arange(n_levels)})
+    for drug_name in drug_names:
+        df[drug_name] = np.linspace(0, rng.uniform(0.01, 30), n_levels)
+
+    return df
+
+
+def get_control_sheet(controls, n_wells):
+    rows = []
+    for i, ctrl in enumerate(controls):
+        rows.append([None, 'Set ' + str(i + 1)])
+        rows.append([None, 'Control plates ' + str(i + 1)])
+        rows.append(['Well'] + list(ctrl))
+        for w in range(n_wells):
+            rows.append(['Well ' + str(w + 1)] + [ctrl[col][w] for col in ctrl])
+        rows.append([])
+
+    return pd.DataFrame(rows)
+
+
+# raw test reads that normalize back to the given %inhibition / %cytotoxicity against per-well baselines
+def get_test_reads(y, baseline, rng):
+    eff = baseline['DMSO Eff'] + (baseline['Cells Eff'] - baseline['DMSO Eff']) * y[..., 0] / 100
+    vero = baseline['DMSO Vero'] * (1 - y[..., 1] / 100)
+    reads = [eff, vero]
+    for readout in ['Cardiac', 'Liver'][0:y.shape[-1] - 2]:
+        blank = baseline['Blank ' + readout]
+        reads.append(blank + (baseline['DMSO ' + readout] - blank) * (1 - y[..., len(reads)] / 100))
+
+    return [np.round(add_noise(r, rng)) for r in reads]
+
+
+def write_sheets(file_name, sheets):
+    Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+    writer = pd.ExcelWriter(file_name, engine='xlsxwriter')
+    for sheet_name, df in sheets.items():
+        df.to_excel(writer, sheet_name=sheet_name, index=False, header=sheet_name != 'Controls')
+
+    writer.save()
+
+
+# OACD.xlsx layout (OACD, mono_X, Conc_table, Controls, 4 read-out sheets, 2 monotherapy sheets, Solvent)
+# with n_sets control sets; combos are split over groups of n_rep sets as in get_default_plate_map
+def make_oacd_workbook(file_name, n_drugs=12, n_levels=3, n_combos=100, n_rep=3, n_sets=6, n_wells=3, seed=0):
+    if n_sets % n_rep:
+        raise ValueError('n_sets must be a multiple of n_rep')
+
+    rng = np.random.default_rng(seed)
+    drug_names = get_drug_names(n_drugs)
+    df_conc_table = get_conc_table(drug_names, n_levels, rng)
+
+    codes = get_design_codes(n_combos, n_drugs, n_levels, rng)
+    mono_codes = np.vstack([np.eye(n_drugs, dtype=int)[i] * level
+                            for level in range(1, n_levels) for i in range(n_drugs)])
+    mono_ids = ['D' + str(i + 1) + '-L' + str(level) for level in range(1, n_levels) for i in range(n_drugs)]
+    combo_ids = ['C' + str(i + 1) for i in range(n_combos)]
+
+    # control sets and the baseline every test well is read against
+    controls = [{col: add_noise(np.full(n_wells, level), rng) for col, level in CONTROL_LEVELS.items()}
+                for _ in range(n_sets)]
+    baselines = {col: np.array([ctrl[col].mean() for ctrl in controls]) for col in CONTROL_LEVELS}
+    plate_map, mono_plate_map = get_default_plate_map(n_combos, len(mono_ids), n_sets, n_rep)
+
+    y = get_responses(np.vstack([codes, mono_codes]) / (n_levels - 1), rng)
+    y_rep = y[:, None, :] + rng.normal(0, 3, (y.shape[0], n_rep, y.shape[1]))
+    reads = get_test_reads(y_rep[0:n_combos], {col: b[plate_map] for col, b in baselines.items()}, rng)
+    mono_reads = get_test_reads(y_rep[n_combos:, :, 0:2], {col: b[mono_plate_map] for col, b in baselines.items()},
+                                rng)
+
+    rep_cols = ['replicate ' + str(r + 1) for r in range(n_rep)]
+    sheets = {'OACD': pd.DataFrame(codes, columns=drug_names), 'mono_X': pd.DataFrame(mono_codes, columns=drug_names)}
+    sheets['OACD'].insert(0, '', combo_ids)
+    sheets['mono_X'].insert(0, '', mono_ids)
+    sheets['Conc_table'] = df_conc_table
+    sheets['Controls'] = get_control_sheet(controls, n_wells)
+    for sheet_name, values in zip(['Efficacy', 'VeroE6', 'AC16', 'THLE-2'], reads):
+        sheets[sheet_name] = pd.DataFrame(values, columns=rep_cols)
+        sheets[sheet_name].insert(0, 'combo', combo_ids)
+    for sheet_name, values in zip(['mono_Eff', 'mono_VeroE6'], mono_reads):
+        sheets[sheet_name] = pd.DataFrame(values, columns=rep_cols)
+        sheets[sheet_name].insert(0, '', mono_ids)
+    sheets['Solvent'] = pd.DataFrame({'Drug': drug_names, 'DMSO': rng.integers(0, 2, n_drugs),
+                                      'Stock Solution (µM)*': 100000})
+
+    write_sheets(file_name, sheets)
+
+    return file_name
+
+
+# monotherapy/validation plate sheet: id column, triplicate test wells, controls in the first n_wells rows;
+# blank: None for no Blank column, NaN for an empty one, else the raw blank read
+def get_plate_sheet(ids, reads, plate, n_wells, rng, blank=None):
+    df = pd.DataFrame({ids.name: ids.values})
+    for r in range(reads.shape[1]):
+        df['Replicate ' + str(r + 1)] = np.round(add_noise(reads[:, r], rng))
+
+    controls = {col: levels[plate] for col, levels in SHEET_CONTROLS.items()}
+    if blank is not None:
+        controls['Blank'] = blank
+    for col, level in controls.items():
+        df[col] = np.nan
+        df.loc[0:n_wells - 1, col] = np.round(add_noise(np.full(n_wells, level), rng))
+
+    return df
+
+
+# Monotherapy.xlsx layout: Solvent sheet plus one <drug>_eff / <drug>_VeroE6 sheet pair per drug with n_conc
+# dilutions in triplicate, responses follow a Hill curve per drug
+def make_monotherapy_workbook(file_name, n_drugs=12, n_conc=9, n_wells=3, seed=0):
+    rng = np.random.default_rng(seed)
+    drug_names = get_drug_names(n_drugs)
+    conc = pd.Series(100 / 5.0 ** np.arange(n_conc), name='Concentration')
+
+    sheets = {'Solvent': pd.DataFrame({'Drug': drug_names, 'DMSO': rng.integers(0, 2, n_drugs)})}
+    for drug_name in drug_names:
+        inhibition = 100 / (1 + (rng.uniform(0.5, 20) / conc.values) ** rng.uniform(0.7, 2))
+        cytotoxicity = 60 / (1 + (rng.uniform(20, 500) / conc.values) ** rng.uniform(0.7, 2))
+        eff = SHEET_CONTROLS['DMSO (G10-12)'][0] + (SHEET_CONTROLS['Cells+media (H)'][0] -
+                                                    SHEET_CONTROLS['DMSO (G10-12)'][0]) * inhibition / 100
+        ver = SHEET_CONTROLS['DMSO (G10-12)'][1] * (1 - cytotoxicity / 100)
+
+        sheets[drug_name + '_eff'] = get_plate_sheet(conc, np.repeat(eff[:, None], 3, axis=1), 0, n_wells, rng,
+                                                     blank=np.nan)
+        sheets[drug_name + '_VeroE6'] = get_plate_sheet(conc, np.repeat(ver[:, None], 3, axis=1), 1, n_wells, rng,
+                                                        blank=np.nan)
+
+    write_sheets(file_name, sheets)
+
+    return file_name
+
+
+# Validation.xlsx layout: exp2_result plus the exp3 plates of n_combos combinations in triplicate; the AC16
+# and THLE-2 plates carry blank wells and are split over two sheets as in the shipped workbook
+def make_validation_workbook(file_name, n_drugs=12, n_combos=27, n_wells=3, seed=0):
+    rng = np.random.default_rng(seed)
+    drug_names = get_drug_names(n_drugs)
+    codes = get_design_codes(n_combos, n_drugs, 3, rng)
+    y = get_responses(codes / 2, rng)
+    combo_ids = pd.Series(np.arange(1, n_combos + 1), name='Combo_ID')
+
+    df_x = pd.DataFrame(codes * 0.5, columns=drug_names)
+    df_x.insert(0, 'Combo_ID', combo_ids)
+    for k, col in enumerate(['% Vero E6 Inhibition', '% Vero E6 Cytotoxicity', '% AC16 Cytotoxicity',
+                             '% THLE-2 Cytotoxicity']):
+        df_x[col] = y[:, k]
+    sheets = {'exp2_result': df_x}
+
+    lower, upper = SHEET_CONTROLS['DMSO (G10-12)'][0], SHEET_CONTROLS['Cells+media (H)'][0]
+    vehicle, blank = SHEET_CONTROLS['DMSO (G10-12)'][1], 2.4e3
+    y_rep = y[:, None, :] + rng.normal(0, 3, (n_combos, 3, 4))
+    sheets['exp3_viral'] = get_plate_sheet(combo_ids, lower + (upper - lower) * y_rep[:, :, 0] / 100, 0, n_wells, rng)
+    sheets['exp3_veroe6'] = get_plate_sheet(combo_ids, vehicle * (1 - y_rep[:, :, 1] / 100), 1, n_wells, rng)
+
+    split = -(-2 * n_combos // 3)
+    for k, sheet_name in [(2, 'exp3_ac16'), (3, 'exp3_thle2')]:
+        reads = blank + (vehicle - blank) * (1 - y_rep[:, :, k] / 100)
+        sheets[sheet_name] = get_plate_sheet(combo_ids[0:split], reads[0:split], 1, n_wells, rng, blank=blank)
+        sheets[sheet_name + '_2'] = get_plate_sheet(combo_ids[split:], reads[split:], 1, n_wells, rng, blank=blank)
+
+    write_sheets(file_name, sheets)
+
+    return file_name
@@ -1,148 +1,112 @@
-from scipy import stats
+import argparse
+import sys
+from pathlib import Path
+
 import pandas as pd
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.profiling import Profiler, add_profile_argument, get_profiler
+from common.workbook import open_workbook
+from solvent import VEHICLES, test_solvent_effect
+
 
 def read_excel(file_name):
-    xls = pd.ExcelFile(file_name)
+    xls = open_workbook(file_name)
     sheet_names = xls.sheet_names
 
-    dfs = [pd.DataFrame()] * len(sheet_names)
-    expr_no = [0] * len(sheet_names)
-
-    for i, sheet_name in enumerate(sheet_names):
-        dfs[i] = pd.read_excel(xls, sheet_name=sheet_name)
-        if 'exp1' in sheet_name:
-            expr_no[i] = 1
-        elif 'exp2' in sheet_name:
-            expr_no[i] = 2
-        elif 'exp3' in sheet_name:
-            expr_no[i] = 3
-
-    return dfs, sheet_names, expr_no
-
-
-def do_bonferoni_correction(p, expr_name, mode):
-    if 'exp1' in expr_name or 'exp3' in expr_name:
-        if mode == 'single':
-            p *= 4
-        elif mode == 'pair':
-            p *= 2
-        else:
-            raise Exception('wrong mode name', mode)
-    elif 'exp2' in expr_name:
-        if mode == 'single':
-            p *= 8
-        elif mode == 'pair':
-            p *= 4
-        else:
-            raise Exception('wrong mode name', mode)
-    else:
-        raise Exception('wrong sheet name', expr_name)
+    dfs = [xls.parse(sheet_name) for sheet_name in sheet_names]
 
-    if p > 1:
-        p = 1
-
-    return p
+    return dfs, sheet_names
 
 
 # 1) Normality test:
-def check_normality(df, expr_name):
-    is_reject = False
-    for vehicle in df.columns:
-        _, p = stats.shapiro(df[vehicle])
-
-        if p < 0.05:
-            print(vehicle, ": reject normality, p =", p)
-            is_reject = True
+def print_normality(df):
+    print('Part 1: Shapiro-Wilk test for normality:')
+    for _, row in df.iterrows():
+        print('Plates:', row['Sheet'])
+        if row['Normality'] == 'small groups':
+            print('assume non-normality for', row['Experiment'], 'due to small group size (n=' +
+                  str(min(row['n ' + vehicle] for vehicle in VEHICLES)) + ')')
         else:
-            print(vehicle, ": unable to reject normality, assume normal population, p =", p)
-            pass
-
-    print('Reject normality:', is_reject)
-
-    return is_reject
-
+            for vehicle in VEHICLES:
+                p = row['p normal ' + vehicle]
+                if p < 0.05:
+                    print(vehicle, ": reject normality, p =", p)
+                else:
+                    print(vehicle, ": unable to reject normality, assume normal population, p =", p)
+        print()
 
-# 2a, tests for non-parametric populations
-def test_non_parametric(df, expr_name):
+    normality = df.groupby('Experiment', sort=False)['Normality'].first()
+    print('Reject normality hypothesis:',
+          ', '.join(experiment + ': ' + str(value != 'normal') for experiment, value in normality.items()), '\n')
 
-    # rank sum
-    _, p = stats.ranksums(df['DMSO'], df['No DMSO'])
-    p = do_bonferoni_correction(p, expr_name, mode='pair')
 
-    if p < 0.05:
-        print('2) Wilcoxon rank-sum test:\nassume DMSO has effect, p =', p)
-    else:
-        print('2) Wilcoxon rank-sum test:\nassume DMSO does NOT have effect, p =', p)
+# 2) tests for equal variance and mean/median, p-values adjusted within every experiment
+def print_tests(df):
+    print('Part 2: Tests for equal variance and mean/median')
+    for _, row in df.iterrows():
+        print('Plates:', row['Sheet'])
+        if row['Test'] == 'Wilcoxon rank-sum test':
+            print('2) Wilcoxon rank-sum test:')
+        else:
+            variance = 'unequal variance' if row['Test'] == "Welch's t-test" else 'assume equal variance'
+            print("2) Bartlett's test:\n" + variance + ': p =', row['Bartlett p adj'], '\n3) ' + row['Test'] + ':')
 
-    pass
+        if row['Solvent effect']:
+            print('DMSO has effect, p =', row['p adj'])
+        else:
+            print('assume DMSO does NOT have effect, p =', row['p adj'])
+        print()
 
 
-# 2b, tests for equal variance and mean for parametric populations
-def test_parametric(df, expr_name):
-    # test equal variance
-    _, p1 = stats.bartlett(df['DMSO'], df['No DMSO'])
-    p1 = do_bonferoni_correction(p1, expr_name, mode='pair')
+def check_dmso(file_name, profiler=None, p_adjust='bonferroni'):
+    profiler = profiler or Profiler('check_dmso', enabled=False)
 
-    # test equal mean, depending on whether the groups have equal variance
-    if p1 < 0.05:
-        print("2) Bartlett's test:\nunequal variance: p =", p1, "\n3) Welch's t-test:")
-        _, p2 = stats.ttest_ind(df['DMSO'], df['No DMSO'], equal_var=False, nan_policy='omit')
-        p2 = do_bonferoni_correction(p2, expr_name, mode='pair')
-    else:
-        print("2) Bartlett's test:\nassume equal variance: p =", p1, "\n3) Student t-test:")
-        _, p2 = stats.ttest_ind(df['DMSO'], df['No DMSO'], equal_var=True, nan_policy='omit')
-        p2 = do_bonferoni_correction(p2, expr_name, mode='pair')
+    # read in data file
+    with profiler.stage('read_input') as record:
+        dfs, sheet_names = read_excel(file_name)
+        record['rows'] = sum(df.shape[0] for df in dfs)
 
-    if p2 < 0.05:
-        print('DMSO has effect, p =', p2)
-    else:
-        print('assume DMSO does NOT have effect, p =', p2)
+    # all plates of all experiments at once
+    with profiler.stage('solvent_effect_tests', rows=len(sheet_names)):
+        df = test_solvent_effect(dfs, sheet_names, p_adjust=p_adjust)
 
-    pass
+    print_normality(df)
+    print_tests(df)
 
+    return df
 
-def check_dmso(file_name):
-    # read in data file
-    dfs, sheet_names, expr_no = read_excel(file_name)
-    hypothesis = [False, False, False]
 
-    print('Part 1: Shapiro-Wilk test for normality:')
-    for i, sheet_name in enumerate(sheet_names):
-        print('Plates:', sheet_name)
+def save_file(file_name, df):
+    writer = pd.ExcelWriter(file_name, engine='xlsxwriter')
+    df.to_excel(writer, sheet_name='Solvent effect', index=False)
+    writer.save()
+    print('...solvent effect tests have been saved.')
 
-        df = dfs[i]
 
-        if expr_no[i] < 3:
-            is_reject = check_normality(df, sheet_name)
-            hypothesis[expr_no[i] - 1] += is_reject
-        else:
-            print('assume non-normality for exp3 due to small group size (n=3)')
-            hypothesis[expr_no[i] - 1] = 1
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Solvent effect (DMSO vs no DMSO) of every plate batch.')
+    parser.add_argument('input', nargs='?', default='DMSO_vs_noDMSO.xlsx',
+                        help='input workbook, default: DMSO_vs_noDMSO.xlsx')
+    parser.add_argument('--p-adjust', choices=['bonferroni', 'holm', 'fdr_bh'], default='bonferroni',
+                        help='p-value adjustment over the plates of an experiment, default: bonferroni')
+    add_profile_argument(parser, 'check_dmso')
 
-        print()
-    print('Reject normality hypothesis:',
-          'experiment 1:', bool(hypothesis[0]), ',',
-          'experiment 2:', bool(hypothesis[1]), ',',
-          'experiment 3:', bool(hypothesis[2]), '\n')
-    print('Part 2: Tests for equal variance and mean/median')
-    for i, sheet_name in enumerate(sheet_names):
-        print('Plates:', sheet_name)
+    return parser.parse_args(argv)
 
 
-        df = dfs[i]
-        is_reject = hypothesis[expr_no[i] - 1]
-        if is_reject:  # reject normality, follow up with non-parametric tests
-            test_non_parametric(df, sheet_name)
-        else:  # NOT reject normality, follow up with parametric tests
-            test_parametric(df, sheet_name)
-        print()
+def main(argv=None):
+    args = get_args(argv)
+    file = args.input
+    file_output = 'DMSO_stats.xlsx'
 
-    pass
+    # move everything into def to remove shadow name
+    profiler = get_profiler('check_dmso', argv)
+    df_stats = check_dmso(file, profiler, args.p_adjust)
+    with profiler.stage('save_results', rows=df_stats.shape[0]):
+        save_file(file_output, df_stats)
+    profiler.save()
 
 
 if __name__ == '__main__':
-    file = 'DMSO_vs_noDMSO.xlsx'
-
-    # move everything into def to remove shadow name
-    check_dmso(file)
+    main()
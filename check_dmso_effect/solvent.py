@@ -0,0 +1,210 @@
+import re
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.stats import adjust_by_family
+
+VEHICLES = ['DMSO', 'No DMSO']
+
+# Shapiro-Wilk coefficients and p-value approximation of Royston (1992), as in algorithm AS R94
+SW_A_LAST = [0, 0.221157, -0.147981, -2.071190, 4.434685, -2.706056]
+SW_A_SECOND = [0, 0.042981, -0.293762, -1.752461, 5.682633, -3.582633]
+SW_SMALL_GAMMA = [-2.273, 0.459]
+SW_SMALL_MEAN = [0.5440, -0.39978, 0.025054, -6.714e-4]
+SW_SMALL_SD = [1.3822, -0.77857, 0.062767, -0.0020322]
+SW_LARGE_MEAN = [-1.5861, -0.31082, -0.083751, 0.0038915]
+SW_LARGE_SD = [-0.4803, -0.082676, 0.0030302]
+
+
+def poly(coef, x):
+    return sum(c * x ** i for i, c in enumerate(coef))
+
+
+# every sheet is one plate batch with a column per vehicle: (plates x vehicles x wells), NaN padded
+def stack_plates(dfs, vehicles=VEHICLES):
+    n_wells = max(df.shape[0] for df in dfs)
+    values = np.full((len(dfs), len(vehicles), n_wells), np.nan)
+    for i, df in enumerate(dfs):
+        for j, vehicle in enumerate(vehicles):
+            column = df[vehicle].values.astype(float)
+            values[i, j, 0:column.shape[0]] = column
+
+    return values
+
+
+# count, mean and sample variance over the last axis, NaN wells are left out
+def get_moments(values):
+    n = np.sum(~np.isnan(values), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(values, axis=-1) / n
+        var = np.nansum((values - mean[..., None]) ** 2, axis=-1) / (n - 1)
+
+    return n, mean, var
+
+
+def get_sw_coefficients(n):
+    m = stats.norm.ppf((np.arange(1, n + 1) - 0.375) / (n + 0.25))
+    if n == 3:
+        return np.array([-np.sqrt(0.5), 0, np.sqrt(0.5)])
+
+    u = 1 / np.sqrt(n)
+    mm = np.sum(m ** 2)
+    a = m / np.sqrt(mm)
+    a_last = a[-1] + poly(SW_A_LAST, u)
+    if n > 5:
+        a_second = a[-2] + poly(SW_A_SECOND, u)
+        eps = (mm - 2 * m[-1] ** 2 - 2 * m[-2] ** 2) / (1 - 2 * a_last ** 2 - 2 * a_second ** 2)
+        a = m / np.sqrt(eps)
+        a[[0, 1, -2, -1]] = [-a_last, -a_second, a_second, a_last]
+    else:
+        eps = (mm - 2 * m[-1] ** 2) / (1 - 2 * a_last ** 2)
+        a = m / np.sqrt(eps)
+        a[[0, -1]] = [-a_last, a_last]
+
+    return a
+
+
+def get_sw_pvalue(w, n):
+    if n == 3:
+        return np.maximum(6 / np.pi * (np.arcsin(np.sqrt(w)) - np.arcsin(np.sqrt(0.75))), 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.log(1 - w)
+        if n <= 11:
+            gamma = poly(SW_SMALL_GAMMA, n)
+            z = (-np.log(gamma - y) - poly(SW_SMALL_MEAN, n)) / np.exp(poly(SW_SMALL_SD, n))
+            return np.where(y >= gamma, 1e-99, stats.norm.sf(z))
+
+        z = (y - poly(SW_LARGE_MEAN, np.log(n))) / np.exp(poly(SW_LARGE_SD, np.log(n)))
+
+    return stats.norm.sf(z)
+
+
+# Shapiro-Wilk W and p over the last axis of a NaN-padded array; rows of the same size share one set of
+# coefficients, so there is one matrix product per distinct well count. Rows with < 3 wells give NaN.
+def shapiro_wilk(values):
+    shape = values.shape[:-1]
+    values = np.sort(values.reshape(-1, values.shape[-1]), axis=1)  # NaN sorts last
+    n = np.sum(~np.isnan(values), axis=1)
+
+    w, p = np.full(n.shape, np.nan), np.full(n.shape, np.nan)
+    for size in np.unique(n[n >= 3]):
+        rows = np.flatnonzero(n == size)
+        x = values[rows, 0:size]
+        ss = np.sum((x - x.mean(axis=1, keepdims=True)) ** 2, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            w[rows] = np.minimum((x @ get_sw_coefficients(size)) ** 2 / ss, 1)
+        p[rows] = get_sw_pvalue(w[rows], size)
+
+    return w.reshape(shape), p.reshape(shape)
+
+
+def bartlett(x, y):
+    (n1, _, v1), (n2, _, v2) = get_moments(x), get_moments(y)
+    dof = n1 + n2 - 2
+    pooled = ((n1 - 1) * v1 + (n2 - 1) * v2) / dof
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = dof * np.log(pooled) - (n1 - 1) * np.log(v1) - (n2 - 1) * np.log(v2)
+        t /= 1 + (1 / (n1 - 1) + 1 / (n2 - 1) - 1 / dof) / 3
+
+    return t, stats.chi2.sf(t, 1)
+
+
+# Student's (equal_var) or Welch's two-sided t-test, element-wise per row
+def ttest(x, y, equal_var):
+    (n1, m1, v1), (n2, m2, v2) = get_moments(x), get_moments(y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if equal_var:
+            dof = n1 + n2 - 2
+            se = np.sqrt(((n1 - 1) * v1 + (n2 - 1) * v2) / dof * (1 / n1 + 1 / n2))
+        else:
+            se = np.sqrt(v1 / n1 + v2 / n2)
+            dof = se ** 4 / ((v1 / n1) ** 2 / (n1 - 1) + (v2 / n2) ** 2 / (n2 - 1))
+        t = (m1 - m2) / se
+
+    return t, 2 * stats.t.sf(np.abs(t), dof)
+
+
+# Wilcoxon rank-sum z (normal approximation, no tie correction, as scipy.stats.ranksums); the mid-rank of
+# every x well in the pooled row is counted directly, which needs no per-row ranking
+def ranksums(x, y):
+    pooled = np.concatenate([x, y], axis=-1)
+    less = np.sum(x[..., :, None] > pooled[..., None, :], axis=-1)
+    equal = np.sum(x[..., :, None] == pooled[..., None, :], axis=-1)
+    rank_sum = np.sum(np.where(np.isnan(x), 0, less + (equal + 1) / 2), axis=-1)
+
+    n1, n2 = np.sum(~np.isnan(x), axis=-1), np.sum(~np.isnan(y), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (rank_sum - n1 * (n1 + n2 + 1) / 2) / np.sqrt(n1 * n2 * (n1 + n2 + 1) / 12)
+
+    return z, 2 * stats.norm.sf(np.abs(z))
+
+
+# experiment a sheet belongs to ('exp2_viral' -> 'exp2'), the sheet itself when there is no such prefix
+def get_experiment(sheet_name):
+    match = re.match(r'(exp\d+)', sheet_name)
+
+    return match.group(1) if match else sheet_name
+
+
+# Solvent effect of every plate batch (sheet) in one pass. An experiment counts as normal unless any vehicle
+# column of its plates rejects Shapiro-Wilk at alpha, or any has <= small_n wells (too few to judge).
+# Normal experiments get Bartlett's test and then Student's or Welch's t-test, the others a Wilcoxon
+# rank-sum test. p-values are adjusted within each experiment over its plates, each plate being one
+# DMSO-vs-no-DMSO comparison whichever test it got.
+def test_solvent_effect(dfs, sheet_names, p_adjust='bonferroni', alpha=0.05, small_n=3, vehicles=VEHICLES):
+    values = stack_plates(dfs, vehicles)
+    x, y = values[:, 0, :], values[:, 1, :]
+    n, mean, _ = get_moments(values)
+    w, p_normal = shapiro_wilk(values)
+    experiments = np.array([get_experiment(sheet_name) for sheet_name in sheet_names])
+
+    # normality per experiment
+    rejected = np.any(p_normal < alpha, axis=1)
+    small = np.any(n <= small_n, axis=1)
+    normality = {}
+    for experiment in np.unique(experiments):
+        plates = experiments == experiment
+        if small[plates].any():
+            normality[experiment] = 'small groups'
+        else:
+            normality[experiment] = 'non-normal' if rejected[plates].any() else 'normal'
+    normal = np.array([normality[e] == 'normal' for e in experiments])
+
+    # every test on every plate, then the one that applies is picked per plate
+    _, p_bartlett = bartlett(x, y)
+    p_bartlett[~normal] = np.nan
+    p_bartlett_adj = adjust_by_family(p_bartlett, experiments, p_adjust)
+    equal_var = ~(p_bartlett_adj < alpha)
+
+    t_student, p_student = ttest(x, y, equal_var=True)
+    t_welch, p_welch = ttest(x, y, equal_var=False)
+    z, p_ranksum = ranksums(x, y)
+
+    test = np.where(normal, np.where(equal_var, 'Student t-test', "Welch's t-test"), 'Wilcoxon rank-sum test')
+    statistic = np.where(normal, np.where(equal_var, t_student, t_welch), z)
+    p = np.where(normal, np.where(equal_var, p_student, p_welch), p_ranksum)
+    p_adj = adjust_by_family(p, experiments, p_adjust)
+
+    df = pd.DataFrame({'Sheet': sheet_names, 'Experiment': experiments})
+    for j, vehicle in enumerate(vehicles):
+        df['n ' + vehicle] = n[:, j]
+        df['Mean ' + vehicle] = mean[:, j]
+    for j, vehicle in enumerate(vehicles):
+        df['W ' + vehicle] = w[:, j]
+        df['p normal ' + vehicle] = p_normal[:, j]
+    df['Normality'] = [normality[e] for e in experiments]
+    df['Bartlett p'] = p_bartlett
+    df['Bartlett p adj'] = p_bartlett_adj
+    df['Test'] = test
+    df['Statistic'] = statistic
+    df['p'] = p
+    df['p adj'] = p_adj
+    df['Solvent effect'] = p_adj < alpha
+
+    return df
@@ -0,0 +1,135 @@
+import argparse
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from common.store import get_frame_digest
+
+# bump to drop every cached stage after a change in how stage results are stored
+CACHE_VERSION = 1
+
+
+def get_part_digest(part):
+    if isinstance(part, pd.DataFrame):
+        return get_frame_digest(part)
+    if isinstance(part, np.ndarray):
+        return hashlib.sha256(str((part.shape, part.dtype.str)).encode() + np.ascontiguousarray(part).tobytes()) \
+            .hexdigest()[:16]
+    if isinstance(part, str):
+        return part
+
+    return hashlib.sha256(pickle.dumps(part, protocol=4)).hexdigest()[:16]
+
+
+# digest of the source files defining the given modules, classes or functions, part of every stage key so an
+# edited script never gets results computed by its previous version
+def get_source_digest(*objects):
+    h = hashlib.sha256()
+    for file_name in sorted(set(inspect.getfile(obj) for obj in objects)):
+        h.update(Path(file_name).read_bytes())
+
+    return h.hexdigest()[:16]
+
+
+# Content-addressed, size-bounded on-disk LRU of stage results. A key is the hash of the stage name and of
+# everything the stage reads (sheet digests, upstream stage keys, parameters), so a stage is recomputed
+# only when one of its inputs changed. Entries are pickles named by their key; reading an entry bumps its
+# modification time and the least recently used entries are evicted once the folder exceeds max_bytes.
+class StageCache(object):
+    root: Path
+    max_bytes: int
+    enabled: bool
+
+    def __init__(self, root, max_bytes=2 ** 30, enabled=True):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = []
+        self.misses = []
+
+    def get_key(self, stage, *parts):
+        h = hashlib.sha256(str(CACHE_VERSION).encode() + stage.encode())
+        for part in parts:
+            h.update(b'\x1f' + get_part_digest(part).encode())
+
+        return stage + '-' + h.hexdigest()[:32]
+
+    def get(self, key):
+        path = self._get_path(key)
+        if not self.enabled or not path.exists():
+            return False, None
+
+        try:
+            with path.open('rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return False, None  # unreadable or written by an incompatible version, recomputed
+        os.utime(str(path))
+
+        return True, value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+
+        path = self._get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp' + str(os.getpid()))
+        with tmp.open('wb') as f:
+            pickle.dump(value, f, protocol=4)
+        tmp.replace(path)
+        self.evict()
+
+    # value of func(), from the cache when the key is known
+    def run(self, key, func):
+        hit, value = self.get(key)
+        if hit:
+            self.hits.append(key)
+            return value
+
+        value = func()
+        self.misses.append(key)
+        self.put(key, value)
+
+        return value
+
+    def evict(self):
+        entries = [(path.stat().st_mtime, path.stat().st_size, path) for path in self.root.glob('*/*.pkl')]
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink()
+            total -= size
+
+    def clear(self):
+        for path in self.root.glob('*/*.pkl'):
+            path.unlink()
+
+    def get_summary(self):
+        return 'stage cache: ' + str(len(self.hits)) + ' reused, ' + str(len(self.misses)) + ' computed'
+
+    def _get_path(self, key):
+        digest = key.rsplit('-', 1)[-1]
+
+        return self.root / digest[0:2] / (key + '.pkl')
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--no-cache', action='store_true', help='recompute every stage, do not write the cache')
+    parser.add_argument('--cache-size', type=float, default=1024, metavar='MB', help='size bound of the cache')
+
+
+# --no-cache and --cache-size MB on the command line of a script, the cache lives in folder root
+def get_stage_cache(root='.stage_cache', argv=None):
+    parser = argparse.ArgumentParser()
+    add_cache_arguments(parser)
+    args, _ = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+
+    return StageCache(root, max_bytes=int(args.cache_size * 2 ** 20), enabled=not args.no_cache)
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import pickle
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+FONT_SIZE = 23
+
+# kind: renderer name, file_name: output image, data: plain arrays/lists/strings passed to the renderer
+FigureJob = namedtuple('FigureJob', ['kind', 'file_name', 'data'])
+
+# per output folder: file name -> digest of the data it was rendered from
+MANIFEST = '.figures.json'
+
+
+def get_job_digest(job):
+    return hashlib.sha256(pickle.dumps((job.kind, job.data), protocol=4)).hexdigest()[:16]
+
+
+# one figure per size and process, cleared between renders instead of being rebuilt
+_templates = {}
+
+
+def get_template(figsize):
+    if figsize not in _templates:
+        # matplotlib is imported by the first render only, a run whose figures are all up to date never loads it
+        import matplotlib
+        matplotlib.use('Agg')  # figures are only written to file, never shown
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        _templates[figsize] = fig
+
+    fig = _templates[figsize]
+    fig.clear()
+
+    return fig
+
+
+# series: list of dicts with x, y, err and optional color / width / label
+def render_bar(ax, series, xticks, xticklabels, ylabel, legend=False, hide_spines=False):
+    for s in series:
+        kwargs = {key: s[key] for key in ('color', 'width', 'label') if key in s}
+        ax.bar(s['x'], s['y'], yerr=s['err'], align='center', ecolor='black', capsize=5,
+               edgecolor='white' if 'color' in s else None, **kwargs)
+
+    ax.set_xticks(xticks)
+    ax.set_xticklabels(xticklabels, fontsize=FONT_SIZE)
+    ax.set_ylabel(ylabel, fontsize=FONT_SIZE)
+    ax.yaxis.set_tick_params(labelsize=FONT_SIZE)
+    if legend:
+        ax.legend(bbox_to_anchor=(0.95, 1, 0, 0), loc='upper left', fontsize=FONT_SIZE)
+    if hide_spines:
+        ax.spines['right'].set_visible(False)
+        ax.spines['top'].set_visible(False)
+
+
+# predicted response over a dose grid of two drugs: x (n,), y (m,), z (m x n)
+def render_surface(ax, x, y, z, xlabel, ylabel, title):
+    contour = ax.contourf(x, y, z, levels=20, cmap='viridis')
+    ax.figure.colorbar(contour, ax=ax)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+
+
+RENDERERS = {
+    'bar': ((20, 8), render_bar),
+    'surface': ((6, 5), render_surface),
+}
+
+
+def render_job(job):
+    figsize, renderer = RENDERERS[job.kind]
+    fig = get_template(figsize)
+    renderer(fig.add_subplot(111), **job.data)
+
+    Path(job.file_name).parent.mkdir(parents=True, exist_ok=True)
+    fig.savefig(job.file_name)
+
+    return job.file_name
+
+
+def _read_manifest(folder):
+    path = Path(folder) / MANIFEST
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+# Render every job whose data changed since its image was last written, on a process pool.
+# Returns the file names that were rendered.
+def render_all(jobs, max_workers=None):
+    digests = [get_job_digest(job) for job in jobs]
+    manifests = {}
+    stale = []
+    for job, digest in zip(jobs, digests):
+        path = Path(job.file_name)
+        folder = str(path.parent)
+        if folder not in manifests:
+            manifests[folder] = _read_manifest(folder)
+        if not path.exists() or manifests[folder].get(path.name) != digest:
+            stale.append(job)
+
+    max_workers = min(max_workers or os.cpu_count() or 1, max(len(stale), 1))
+    if max_workers == 1:
+        rendered = [render_job(job) for job in stale]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            rendered = list(pool.map(render_job, stale, chunksize=max(1, len(stale) // (4 * max_workers))))
+
+    for job, digest in zip(jobs, digests):
+        path = Path(job.file_name)
+        manifests[str(path.parent)][path.name] = digest
+    for folder, manifest in manifests.items():
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        (Path(folder) / MANIFEST).write_text(json.dumps(manifest, indent=1, sort_keys=True))
+
+    print('...rendered', len(rendered), 'of', len(jobs), 'figures.')
+
+    return rendered
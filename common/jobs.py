@@ -0,0 +1,155 @@
+import contextlib
+import getpass
+import importlib
+import io
+import os
+import sys
+import tempfile
+import traceback
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# command: (folder, module) of every pipeline script; a module is only imported when its command runs
+PIPELINES = {'oacd': ('oacd', 'oacd'),
+             'monotherapy': ('monotherapy', 'monotherapy'),
+             'validation': ('validation', 'validation'),
+             'dmso': ('check_dmso_effect', 'check_dmso')}
+
+# local socket of the worker server, a named pipe on Windows
+if sys.platform == 'win32':
+    DEFAULT_ADDRESS = r'\\.\pipe\identifai-' + getpass.getuser()
+else:
+    DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), 'identifai-' + getpass.getuser() + '.sock')
+
+
+def load_pipeline(command):
+    folder, module = PIPELINES[command]
+    path = str(ROOT / folder)
+    if path not in sys.path:
+        sys.path.append(path)
+
+    return importlib.import_module(module)
+
+
+def run_pipeline(command, argv):
+    return load_pipeline(command).main(argv)
+
+
+# Runs one pipeline in this process as if started in folder cwd and returns (exit status, printed output).
+# Meant for long-lived workers, so what a run leaves behind is dropped afterwards: the open workbooks
+# (the snapshots on disk make reopening cheap) and the memory tracing started by --profile.
+def run_job(command, argv, cwd):
+    output = io.StringIO()
+    status = 0
+    old_cwd = os.getcwd()
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                run_pipeline(command, argv)
+            except SystemExit as e:  # argparse errors and --help
+                status = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+    finally:
+        os.chdir(old_cwd)
+        workbook = sys.modules.get('common.workbook')
+        if workbook is not None:
+            workbook._open_workbooks.clear()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    return status, output.getvalue()
+
+
+# worker initializer: pandas, scipy, sklearn and the pipeline modules are imported once per worker process
+def warm_up(commands):
+    for command in commands:
+        load_pipeline(command)
+
+
+def _reply(conn, future):
+    try:
+        status, output = future.result()
+    except Exception as e:  # the worker died, e.g. out of memory
+        status, output = 1, 'worker failed: ' + repr(e) + '\n'
+    try:
+        conn.send({'status': status, 'output': output})
+    except OSError:
+        pass  # client went away
+    finally:
+        conn.close()
+
+
+# A socket file left behind by a server that did not shut down cleanly blocks the address.
+def _remove_stale_socket(address):
+    if sys.platform == 'win32' or not os.path.exists(address):
+        return
+
+    try:
+        Client(address).close()
+    except OSError:
+        os.unlink(address)
+    else:
+        raise RuntimeError('a worker server is already running on ' + address)
+
+
+# Serves pipeline jobs on a local socket from n_workers processes that imported every pipeline at startup,
+# so a job pays neither interpreter start-up nor import time. One request per connection:
+# {'command', 'argv', 'cwd'} runs a pipeline, {'command': 'stop'} shuts the server down;
+# every reply is {'status', 'output'}. Jobs beyond n_workers wait in the pool's queue.
+def serve(address=DEFAULT_ADDRESS, n_workers=None, commands=None):
+    commands = list(commands or PIPELINES)
+    n_workers = n_workers or os.cpu_count() or 1
+    _remove_stale_socket(address)
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=warm_up, initargs=(commands,)) as pool:
+        for future in [pool.submit(os.getpid) for _ in range(n_workers)]:
+            future.result()  # start and warm up the workers before accepting jobs
+
+        umask = os.umask(0o177)  # socket file readable by this user only
+        try:
+            listener = Listener(address)
+        finally:
+            os.umask(umask)
+
+        print('...serving', ', '.join(commands), 'on', address, 'with', n_workers, 'worker(s)')
+        with listener:
+            while True:
+                conn = listener.accept()
+                try:
+                    request = conn.recv()
+                except (OSError, EOFError):
+                    conn.close()
+                    continue
+
+                command = request.get('command')
+                if command == 'stop':
+                    conn.send({'status': 0, 'output': '...worker server stopped.\n'})
+                    conn.close()
+                    break
+                if command not in commands:
+                    conn.send({'status': 2, 'output': 'unknown command ' + repr(command) + '\n'})
+                    conn.close()
+                    continue
+
+                future = pool.submit(run_job, command, list(request.get('argv', [])), request['cwd'])
+                future.add_done_callback(lambda f, conn=conn: _reply(conn, f))
+
+
+# Runs a pipeline on the worker server, raises OSError when no server listens on address.
+def submit(command, argv, cwd=None, address=DEFAULT_ADDRESS):
+    with Client(address) as conn:
+        conn.send({'command': command, 'argv': list(argv), 'cwd': cwd or os.getcwd()})
+        return conn.recv()
+
+
+def stop(address=DEFAULT_ADDRESS):
+    with Client(address) as conn:
+        conn.send({'command': 'stop'})
+        return conn.recv()
@@ -0,0 +1,86 @@
+import numpy as np
+
+# well roles
+EMPTY, BLANK, DMSO, NO_DMSO, CELLS, VIRUS, TEST = range(-1, 6)
+CONTROL_ROLES = [BLANK, DMSO, NO_DMSO, CELLS, VIRUS]
+ROLE_NAMES = {'blank': BLANK, 'dmso': DMSO, 'no dmso': NO_DMSO, 'cells': CELLS, 'virus': VIRUS, 'test': TEST}
+
+
+class PlateArray(object):
+    # (plates x wells x readouts) raw reads, NaN where a well has no read-out
+    values: np.ndarray
+    # role of every well slot, the same layout on every plate
+    roles: np.ndarray
+    readouts: list
+
+    def __init__(self, values, roles, readouts):
+        self.values = np.asarray(values, dtype=float)
+        self.roles = np.asarray(roles, dtype=np.int8)
+        self.readouts = list(readouts)
+
+    # mean of the wells with a given role: (plates x readouts)
+    def get_baseline(self, role):
+        mask = (self.roles == role)[None, :, None] & ~np.isnan(self.values)
+        count = mask.sum(axis=1)
+        total = np.where(mask, self.values, 0).sum(axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > 0, total / count, np.nan)
+
+    # baselines per plate broadcast over its own wells, or gathered for external wells through a plate map
+    # of plate indices shaped like their leading axes
+    def _get_bound(self, role, plate_map):
+        baseline = self.get_baseline(role)
+        if plate_map is None:
+            return baseline[:, None, :]
+
+        return baseline[np.asarray(plate_map)]
+
+    # %cytotoxicity of every well on every plate and cell line, blank-corrected where blank wells exist
+    def calc_cytotoxicity(self, vehicle=DMSO, values=None, plate_map=None):
+        values = self.values if values is None else values
+        blank = np.nan_to_num(self._get_bound(BLANK, plate_map))
+        cell_vehicle = self._get_bound(vehicle, plate_map) - blank
+        cell_drug = values - blank
+
+        return (cell_vehicle - cell_drug) / cell_vehicle * 100
+
+    # %inhibition between the infected (lower) and uninfected (upper) baselines
+    def calc_inhibition(self, lower=DMSO, upper=CELLS, values=None, plate_map=None):
+        values = self.values if values is None else values
+        cell_virus = self._get_bound(lower, plate_map)
+        cell_vehicle = self._get_bound(upper, plate_map)
+
+        return (values - cell_virus) / (cell_vehicle - cell_virus) * 100
+
+    def get_test(self, result):
+        return result[:, self.roles == TEST, :]
+
+
+# controls: per plate {(readout, role): well values}, tests: per plate {readout: well values}
+def build_plates(controls, tests, readouts):
+    slots = []
+    for role in CONTROL_ROLES:
+        n_wells = max([len(v) for plate in controls for (_, r), v in plate.items() if r == role], default=0)
+        slots += [role] * n_wells
+    n_test = max([len(v) for plate in tests for v in plate.values()], default=0)
+    roles = np.array(slots + [TEST] * n_test, dtype=np.int8)
+
+    values = np.full((len(tests), len(roles), len(readouts)), np.nan)
+    for p in range(len(tests)):
+        for (readout, role), v in controls[p].items():
+            start = int(np.argmax(roles == role))
+            values[p, start:start + len(v), readouts.index(readout)] = v
+        for readout, v in tests[p].items():
+            start = len(slots)
+            values[p, start:start + len(v), readouts.index(readout)] = v
+
+    return PlateArray(values, roles, readouts)
+
+
+# one sheet of validation/monotherapy layout: replicate columns 1-3 are test wells, controls by column name
+def from_sheet(df, controls):
+    plate = {('y', role): df[col].values.astype(float) for col, role in controls.items() if col in df}
+    test = {'y': df.iloc[:, 1:4].values.astype(float).ravel()}
+
+    return build_plates([plate], [test], ['y'])
@@ -0,0 +1,122 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# callables hook(event, script, record), told when a stage starts ('stage_started') and when it ends
+# ('stage_done'), whether the profiler is enabled or not; the job service streams them as progress events
+_stage_hooks = []
+
+
+def add_stage_hook(hook):
+    _stage_hooks.append(hook)
+
+
+def remove_stage_hook(hook):
+    _stage_hooks.remove(hook)
+
+
+def _notify(event, script, record):
+    for hook in _stage_hooks:
+        hook(event, script, record)
+
+
+# bytes read and written by this process so far (Linux), None elsewhere
+def get_io_counters():
+    try:
+        fields = dict(line.split(': ') for line in Path('/proc/self/io').read_text().splitlines())
+    except (OSError, ValueError):
+        return None
+
+    return int(fields['rchar']), int(fields['wchar'])
+
+
+# Per-stage wall/CPU time, peak traced memory, rows and I/O bytes of a script run, reported as JSON.
+# A disabled profiler still accepts every call, so scripts can wrap their steps unconditionally.
+# CPU time and memory cover the main process only, not process-pool workers. Tracing memory slows Python
+# code down, trace_memory=False keeps the timings closer to an untraced run.
+class Profiler(object):
+    # input
+    name: str
+    enabled: bool
+    trace_memory: bool
+
+    # output
+    stages: list
+
+    def __init__(self, name, enabled=True, file_name=None, trace_memory=True):
+        self.name = name
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.file_name = file_name or name + '_profile.json'
+        self.stages = []
+        self.start = time.perf_counter()
+        if enabled and trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    # the yielded record takes extra fields, e.g. record['rows'] = n
+    @contextmanager
+    def stage(self, name, rows=None):
+        record = {'stage': name, 'rows': rows}
+        _notify('stage_started', self.name, record)
+        if not self.enabled:
+            yield record
+            _notify('stage_done', self.name, record)
+            return
+
+        if self.trace_memory:
+            _reset_peak()
+        io_start = get_io_counters()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = round(time.perf_counter() - wall, 6)
+            record['cpu_s'] = round(time.process_time() - cpu, 6)
+            if self.trace_memory:
+                record['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 3)
+            io_stop = get_io_counters()
+            if io_start is not None and io_stop is not None:
+                record['read_bytes'] = io_stop[0] - io_start[0]
+                record['written_bytes'] = io_stop[1] - io_start[1]
+            self.stages.append(record)
+        _notify('stage_done', self.name, record)
+
+    def get_report(self):
+        return {'script': self.name, 'python': platform.python_version(), 'platform': platform.platform(),
+                'wall_s': round(time.perf_counter() - self.start, 6), 'stages': self.stages}
+
+    def save(self):
+        if not self.enabled:
+            return
+
+        report = json.dumps(self.get_report(), indent=1)
+        Path(self.file_name).write_text(report)
+        print('...profile has been saved to', self.file_name)
+
+
+def _reset_peak():
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:  # Python < 3.9: restart tracing, which also drops the earlier traces
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+def add_profile_argument(parser, name):
+    parser.add_argument('--profile', nargs='?', const=name + '_profile.json', default=None, metavar='FILE',
+                        help='write per-stage timing, memory and I/O as JSON')
+
+
+# --profile [FILE] on the command line of a script, default FILE is <name>_profile.json
+def get_profiler(name, argv=None):
+    parser = argparse.ArgumentParser(prog=name)
+    add_profile_argument(parser, name)
+    args, _ = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+
+    return Profiler(name, enabled=args.profile is not None, file_name=args.profile)
@@ -0,0 +1,303 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from common.jobs import PIPELINES, run_job, warm_up
+from common.profiling import add_stage_hook
+
+# input: absolute path of the workbook, folder: where the job writes its outputs, argv: extra pipeline options
+Job = namedtuple('Job', ['job_id', 'command', 'input', 'folder', 'argv'])
+
+# events that end a job
+END_EVENTS = ('done', 'failed')
+
+
+def get_job_folder(file_name):
+    path = Path(file_name).resolve()
+
+    return str(path.parent / path.stem)
+
+
+# workbooks of the given files and folders (top level of a folder, Excel lock files left out)
+def get_inputs(paths, pattern='*.xlsx'):
+    inputs = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            inputs += [p for p in sorted(path.glob(pattern)) if not p.name.startswith('~$')]
+        else:
+            inputs.append(path)
+
+    return [str(p.resolve()) for p in inputs]
+
+
+# --- worker side: every pool process sends the progress of its current job to the service ----------------
+
+_events = None
+_job_id = None
+_stage_start = {}
+
+
+def _init_worker(commands, events):
+    global _events
+    _events = events
+    warm_up(commands)
+    add_stage_hook(_send_stage_event)
+
+
+def _send(event, **fields):
+    _events.put(dict(job=_job_id, event=event, time=time.time(), **fields))
+
+
+def _send_stage_event(event, script, record):
+    if _job_id is None:
+        return
+
+    fields = {'stage': record['stage'], 'rows': record['rows']}
+    if event == 'stage_started':
+        _stage_start[record['stage']] = time.perf_counter()
+    else:
+        fields['wall_s'] = round(time.perf_counter() - _stage_start.pop(record['stage']), 6)
+    _send(event, **fields)
+
+
+# Runs a job in a pool process; its end event goes through the same queue as its stage events, after them.
+def _run_job(job):
+    global _job_id
+    _job_id = job.job_id
+    try:
+        _send('started', pid=os.getpid())
+        Path(job.folder).mkdir(parents=True, exist_ok=True)
+        status, output = run_job(job.command, [job.input] + list(job.argv), job.folder)
+        _send('done' if status == 0 else 'failed', status=status, output=output)
+    finally:
+        _job_id = None
+
+    return status
+
+
+# Asyncio service running pipeline jobs on many workbooks at once. Jobs go through three steps:
+#   1. submit() queues a job, and waits while max_pending jobs are already queued (backpressure);
+#   2. a loader parses the workbook in a thread into its snapshot, at most n_workers jobs ahead of the pool;
+#   3. a dispatcher runs the job in a process pool whose workers imported every pipeline at startup.
+# So the file I/O and parsing of the next jobs overlap the normalize/fit/rank work of the running ones.
+# A worker that dies (e.g. out of memory) breaks the whole pool: the jobs running on it fail and the pool is
+# replaced by a fresh one before the next job.
+# Progress is streamed as plain dicts by events(): 'queued', 'loaded', 'started', 'stage_started',
+# 'stage_done' (with wall_s), then 'done' or 'failed' (with status and the printed output of the job).
+class JobService(object):
+    # input
+    n_workers: int
+    max_pending: int
+    commands: list
+
+    def __init__(self, n_workers=None, max_pending=8, commands=None):
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.commands = list(commands or PIPELINES)
+        self.n_submitted = 0
+        self.open_jobs = set()
+
+    async def __aenter__(self):
+        await self.start()
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.pending = asyncio.Queue(maxsize=self.max_pending)
+        self.loaded = asyncio.Queue(maxsize=self.n_workers)
+        self.event_queue = asyncio.Queue()
+        self.finished = asyncio.Condition()
+
+        self.worker_events = multiprocessing.Queue()
+        self.pool = self._start_pool()
+        self.pool_lock = asyncio.Lock()
+        self.tasks = [self.loop.create_task(self._load())]
+        self.tasks += [self.loop.create_task(self._dispatch()) for _ in range(self.n_workers)]
+        self.relay = self.loop.create_task(self._relay())
+
+    async def submit(self, command, file_name, argv=(), folder=None):
+        if command not in self.commands:
+            raise ValueError('unknown pipeline ' + repr(command))
+
+        self.n_submitted += 1
+        job = Job(self.n_submitted, command, str(Path(file_name).resolve()), folder or get_job_folder(file_name),
+                  tuple(argv))
+        self.open_jobs.add(job.job_id)
+        await self.pending.put(job)
+        self._emit({'job': job.job_id, 'event': 'queued', 'time': time.time(), 'command': command,
+                    'input': job.input, 'folder': job.folder})
+
+        return job.job_id
+
+    # progress events until the service is closed
+    async def events(self):
+        while True:
+            event = await self.event_queue.get()
+            if event is None:
+                return
+            yield event
+
+    # wait until every submitted job has ended and its events were emitted
+    async def join(self):
+        async with self.finished:
+            await self.finished.wait_for(lambda: not self.open_jobs)
+
+    async def close(self):
+        await self.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        self.worker_events.put(None)
+        await self.relay
+        await self.loop.run_in_executor(None, self.pool.shutdown)
+        self.worker_events.close()
+        self.event_queue.put_nowait(None)
+
+    def _start_pool(self):
+        return ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker,
+                                   initargs=(self.commands, self.worker_events))
+
+    # replaces a broken pool once, however many dispatchers saw it break
+    async def _restart_pool(self, pool):
+        async with self.pool_lock:
+            if self.pool is pool:
+                pool.shutdown(wait=False)
+                self.pool = self._start_pool()
+
+    def _emit(self, event):
+        self.event_queue.put_nowait(event)
+
+    async def _end_job(self, job_id):
+        async with self.finished:
+            self.open_jobs.discard(job_id)
+            self.finished.notify_all()
+
+    async def _load(self):
+        while True:
+            job = await self.pending.get()
+            start = time.perf_counter()
+            try:
+                await self.loop.run_in_executor(None, _load_workbook, job.input)
+            except Exception:
+                pass  # the pipeline reports the error when it opens the workbook
+            else:
+                self._emit({'job': job.job_id, 'event': 'loaded', 'time': time.time(),
+                            'wall_s': round(time.perf_counter() - start, 6)})
+            await self.loaded.put(job)
+
+    async def _dispatch(self):
+        while True:
+            job = await self.loaded.get()
+            pool = self.pool
+            try:
+                await self.loop.run_in_executor(pool, _run_job, job)
+            except Exception as e:  # the worker died, e.g. out of memory, its events may be incomplete
+                self._emit({'job': job.job_id, 'event': 'failed', 'time': time.time(), 'status': 1,
+                            'output': 'worker failed: ' + repr(e) + '\n'})
+                await self._end_job(job.job_id)
+                if isinstance(e, BrokenProcessPool):
+                    await self._restart_pool(pool)
+
+    # moves worker events from the process queue onto the event loop
+    async def _relay(self):
+        while True:
+            event = await self.loop.run_in_executor(None, self.worker_events.get)
+            if event is None:
+                return
+            self._emit(event)
+            if event['event'] in END_EVENTS:
+                await self._end_job(event['job'])
+
+
+# parses the workbook once into its snapshot, which the worker then loads instead of the xlsx
+def _load_workbook(file_name):
+    from common.workbook import Workbook
+
+    Workbook(Path(file_name).resolve())
+
+
+# Filesystem stand-in for a LIMS queue: submits every workbook that appears in (or changes in) folder once its
+# size and modification time held still over one poll, until stop is set.
+async def watch(service, command, folder, argv=(), pattern='*.xlsx', poll_interval=2.0, stop=None):
+    loop = asyncio.get_running_loop()
+    stop = stop or asyncio.Event()
+    submitted, last = {}, {}
+    while not stop.is_set():
+        stats = await loop.run_in_executor(None, _scan, folder, pattern)
+        for path, key in stats.items():
+            if last.get(path) == key and submitted.get(path) != key:
+                submitted[path] = key
+                await service.submit(command, path, argv)
+        last = stats
+        try:
+            await asyncio.wait_for(stop.wait(), poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _scan(folder, pattern):
+    stats = {}
+    for path in get_inputs([folder], pattern):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # removed in between
+        stats[path] = (stat.st_mtime_ns, stat.st_size)
+
+    return stats
+
+
+# Runs command on every workbook of paths (files or folders) and passes each progress event to on_event.
+# With watch_folders the folders are watched for new workbooks instead, until the task is cancelled.
+# Returns the number of failed jobs.
+async def run_batch(command, paths, argv=(), n_workers=None, max_pending=8, watch_folders=False,
+                    poll_interval=2.0, on_event=None):
+    failed = 0
+
+    async def consume(service):
+        nonlocal failed
+        async for event in service.events():
+            failed += event['event'] == 'failed'
+            if on_event is not None:
+                on_event(event)
+
+    async with JobService(n_workers, max_pending, [command]) as service:
+        consumer = asyncio.ensure_future(consume(service))
+        folders = [path for path in paths if Path(path).is_dir()]
+        for file_name in get_inputs([path for path in paths if not watch_folders or path not in folders]):
+            await service.submit(command, file_name, argv)
+        if watch_folders:
+            await asyncio.gather(*[watch(service, command, folder, argv, poll_interval=poll_interval)
+                                   for folder in folders])
+    await consumer
+
+    return failed
+
+
+def format_event(event):
+    prefix = '[' + str(event['job']) + '] '
+    kind = event['event']
+    if kind == 'queued':
+        return prefix + 'queued ' + event['command'] + ' ' + event['input'] + ' -> ' + event['folder']
+    if kind in ('loaded', 'stage_done'):
+        name = 'workbook' if kind == 'loaded' else event['stage']
+        return prefix + name + ' done in ' + str(round(event['wall_s'], 3)) + ' s'
+    if kind == 'stage_started':
+        return prefix + event['stage'] + '...'
+    if kind == 'started':
+        return prefix + 'started on worker ' + str(event['pid'])
+    if kind == 'failed':
+        tail = event['output'].rstrip().splitlines()[-5:]
+        return prefix + 'failed with status ' + str(event['status']) + ''.join('\n    ' + line for line in tail)
+
+    return prefix + kind
@@ -0,0 +1,33 @@
+import numpy as np
+
+
+def adjust_pvalues(p, method='bonferroni'):
+    p = np.asarray(p, dtype=float)
+    m = p.shape[0]
+    if method == 'bonferroni':
+        return np.minimum(p * m, 1)
+
+    order = np.argsort(p)
+    if method == 'holm':
+        adj = np.maximum.accumulate((m - np.arange(m)) * p[order])
+    elif method == 'fdr_bh':
+        adj = np.minimum.accumulate((m / np.arange(m, 0, -1) * p[order[::-1]]))[::-1]
+    else:
+        raise ValueError('unknown p-value adjustment: ' + method)
+
+    out = np.empty(m)
+    out[order] = np.minimum(adj, 1)
+
+    return out
+
+
+# adjustment within every family of tests, the family size is the number of its non-NaN p-values
+def adjust_by_family(p, families, method='bonferroni'):
+    p = np.asarray(p, dtype=float)
+    families = np.asarray(families)
+    out = np.full(p.shape, np.nan)
+    for family in np.unique(families[~np.isnan(p)]):
+        index = np.flatnonzero((families == family) & ~np.isnan(p))
+        out[index] = adjust_pvalues(p[index], method)
+
+    return out
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import re
+from pathlib import Path
+
+import pandas as pd
+
+MANIFEST = '_manifest.json'
+
+
+def _import_parquet():
+    # pyarrow is only needed once a store is opened, so scripts that never touch one do not import it
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as err:
+        raise ImportError('the result store needs pyarrow: pip install pyarrow') from err
+
+    return pyarrow, pyarrow.parquet
+
+
+def get_frame_digest(df):
+    values = pd.util.hash_pandas_object(df, index=False).values
+    header = json.dumps([[str(c), str(t)] for c, t in df.dtypes.items()])
+
+    return hashlib.sha256(header.encode() + values.tobytes()).hexdigest()[:16]
+
+
+def get_table_dir(name):
+    return re.sub(r'[^0-9A-Za-z_.-]+', '_', name)
+
+
+# Columnar result store: one folder per logical table (the sheet names of the xlsx outputs), each holding
+# Parquet partitions. write() replaces a table, append() adds a partition, read() memory-maps the files.
+# Excel files are views exported from the store and only rewritten when the store changed since.
+class ResultStore(object):
+    root: Path
+    manifest: dict
+
+    def __init__(self, root):
+        self.pa, self.pq = _import_parquet()
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        path = self.root / MANIFEST
+        if path.exists():
+            self.manifest = json.loads(path.read_text())
+        else:
+            self.manifest = {'version': 0, 'tables': {}, 'digests': {}, 'views': {}}
+
+    @property
+    def tables(self):
+        return list(self.manifest['tables'])
+
+    # a table whose content did not change is left as is, so exported views stay up to date
+    def write(self, name, df):
+        digest = get_frame_digest(df)
+        if name in self.manifest['tables'] and self.manifest['digests'].get(name) == digest:
+            return self
+
+        for part in self.manifest['tables'].get(name, []):
+            if (self.root / part).exists():
+                (self.root / part).unlink()
+        self.manifest['tables'][name] = []
+        self.append(name, df)
+        self.manifest['digests'][name] = digest
+        self._save_manifest()
+
+        return self
+
+    def append(self, name, df):
+        self.manifest['digests'].pop(name, None)
+        parts = self.manifest['tables'].setdefault(name, [])
+        part = get_table_dir(name) + '/part-' + str(self.manifest['version']).zfill(5) + '.parquet'
+        (self.root / part).parent.mkdir(parents=True, exist_ok=True)
+
+        df = df.rename(columns=str)
+        self.pq.write_table(self.pa.Table.from_pandas(df, preserve_index=False), str(self.root / part))
+        parts.append(part)
+        self._commit()
+
+        return self
+
+    def read(self, name, columns=None):
+        if name not in self.manifest['tables']:
+            raise KeyError('no table ' + name + ' in result store ' + str(self.root))
+
+        parts = [self.pq.read_table(str(self.root / part), columns=columns, memory_map=True)
+                 for part in self.manifest['tables'][name]]
+
+        return self.pa.concat_tables(parts).to_pandas()
+
+    # write_excel(file_name, {name: DataFrame}) renders the view, skipped when the file is up to date
+    def export_excel(self, file_name, names, write_excel):
+        key = str(Path(file_name).resolve())
+        if Path(file_name).exists() and self.manifest['views'].get(key) == self.manifest['version']:
+            print('...' + Path(file_name).name + ' is up to date.')
+            return False
+
+        write_excel(file_name, {name: self.read(name) for name in names})
+        self.manifest['views'][key] = self.manifest['version']
+        self._save_manifest()
+
+        return True
+
+    def _commit(self):
+        self.manifest['version'] += 1
+        self._save_manifest()
+
+    def _save_manifest(self):
+        path = self.root / MANIFEST
+        tmp = path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.manifest, indent=1))
+        tmp.replace(path)
+
+
+# --store: 'parquet' needs pyarrow, 'none' writes the result tables to the Excel file only, 'auto' is 'parquet'
+# when pyarrow imports and 'none' otherwise; --excel also exports the Excel view of a store
+def add_store_arguments(parser):
+    parser.add_argument('--store', choices=['auto', 'parquet', 'none'], default='auto',
+                        help='result store backend, default: parquet if pyarrow is usable, otherwise none')
+    parser.add_argument('--excel', action='store_true',
+                        help='also export the Excel file from the result store (always written without a store)')
+
+
+# result store in folder root for the --store backend, None when there is none
+def open_result_store(root, backend='auto'):
+    if backend == 'none':
+        return None
+
+    try:
+        return ResultStore(root)
+    except ImportError as err:
+        if backend == 'parquet':
+            raise
+        print('...no result store (' + str(err.__cause__ or err) + '), results go to the Excel file only')
+        return None
+
+
+# Saves the result tables {sheet name: DataFrame} into the store, and exports its Excel view when excel is set;
+# without a store they are written to the Excel file directly. Returns whether the Excel file was written.
+def save_tables(store, file_name, tables, write_excel, excel=False):
+    if store is None:
+        write_excel(file_name, tables)
+        return True
+
+    for name, df in tables.items():
+        store.write(name, df)
+    print('...data have been saved to the result store.')
+
+    return store.export_excel(file_name, list(tables), write_excel) if excel else False
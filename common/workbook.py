@@ -0,0 +1,151 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# cell type codes stored in the snapshot
+EMPTY, FLOAT, INT, BOOL, TEXT = 0, 1, 2, 3, 4
+
+
+def get_digest(file_name):
+    return hashlib.sha256(Path(file_name).read_bytes()).hexdigest()[:16]
+
+
+def get_snapshot_path(file_name, digest):
+    path = Path(file_name)
+
+    return path.with_name('.' + path.name + '.' + digest + '.snapshot.npz')
+
+
+def encode_sheet(raw):
+    values = np.full(raw.shape, np.nan)
+    codes = np.zeros(raw.shape, dtype=np.int8)
+    text = []
+
+    for (r, c), cell in np.ndenumerate(raw.values):
+        if isinstance(cell, (bool, np.bool_)):
+            codes[r, c], values[r, c] = BOOL, float(cell)
+        elif isinstance(cell, (int, np.integer)):
+            codes[r, c], values[r, c] = INT, float(cell)
+        elif isinstance(cell, (float, np.floating)):
+            if not np.isnan(cell):
+                codes[r, c], values[r, c] = FLOAT, cell
+        elif isinstance(cell, str):
+            codes[r, c] = TEXT
+            text.append(cell)
+        elif cell is not None:
+            raise TypeError('unsupported cell type for snapshot: ' + type(cell).__name__)
+
+    return values, codes, np.array(text, dtype=str)
+
+
+def decode_sheet(values, codes, text):
+    cells = np.full(values.shape, np.nan, dtype=object)
+    cells[codes == FLOAT] = values[codes == FLOAT]
+    cells[codes == INT] = values[codes == INT].astype(np.int64).astype(object)
+    cells[codes == BOOL] = values[codes == BOOL].astype(bool).astype(object)
+    cells[codes == TEXT] = text.astype(object)
+
+    return pd.DataFrame(cells)
+
+
+# Header handling of pd.read_excel: empty names become 'Unnamed: <i>' and duplicates get a '.<n>' suffix
+def get_column_names(row):
+    names = []
+    seen = {}
+    for i, name in enumerate(row):
+        if name is None or (isinstance(name, float) and np.isnan(name)):
+            name = 'Unnamed: ' + str(i)
+        if name in seen:
+            seen[name] += 1
+            name = str(name) + '.' + str(seen[name])
+        else:
+            seen[name] = 0
+        names.append(name)
+
+    return names
+
+
+class Workbook(object):
+    # input
+    file_name: str
+    digest: str
+
+    # output
+    sheet_names: list
+    raw: dict
+
+    # every sheet is parsed once with header=None and later sliced in memory, on an unchanged workbook
+    # the raw cells come from a snapshot next to the file keyed by its content hash
+    def __init__(self, file_name, use_snapshot=True):
+        self.file_name = str(file_name)
+        self.digest = get_digest(file_name)
+        self.sheet_digests = {}
+        snapshot = get_snapshot_path(file_name, self.digest)
+
+        if use_snapshot and snapshot.exists():
+            self._load_snapshot(snapshot)
+        else:
+            self.raw = pd.read_excel(self.file_name, sheet_name=None, header=None)
+            self.sheet_names = list(self.raw)
+            if use_snapshot:
+                self._save_snapshot(snapshot)
+
+    # same result as pd.read_excel(file_name, sheet_name=sheet_name, header=header)
+    def parse(self, sheet_name, header=0):
+        raw = self.raw[sheet_name]
+        if header is None:
+            return raw.copy().infer_objects()
+
+        df = raw.iloc[header + 1:, :].reset_index(drop=True)
+        df.columns = get_column_names(raw.iloc[header, :].tolist())
+
+        return df.infer_objects()
+
+    # content hash of one sheet's cells, so stage caches can key on the sheets a stage actually reads
+    def get_sheet_digest(self, sheet_name):
+        if sheet_name not in self.sheet_digests:
+            raw = self.raw[sheet_name]
+            cells = '\x1f'.join(type(cell).__name__ + ':' + str(cell) for cell in raw.values.ravel())
+            self.sheet_digests[sheet_name] = hashlib.sha256((str(raw.shape) + cells).encode()).hexdigest()[:16]
+
+        return self.sheet_digests[sheet_name]
+
+    def _save_snapshot(self, snapshot):
+        arrays = {'sheet_names': np.array(self.sheet_names, dtype=str)}
+        try:
+            for i, sheet_name in enumerate(self.sheet_names):
+                arrays['values_' + str(i)], arrays['codes_' + str(i)], arrays['text_' + str(i)] = \
+                    encode_sheet(self.raw[sheet_name])
+        except TypeError as e:
+            print('...no snapshot for ' + self.file_name + ', ' + str(e))
+            return
+
+        # drop snapshots of earlier versions of the same workbook
+        for old in snapshot.parent.glob('.' + Path(self.file_name).name + '.*.snapshot.npz'):
+            old.unlink()
+        np.savez(str(snapshot), **arrays)
+
+    def _load_snapshot(self, snapshot):
+        with np.load(str(snapshot), allow_pickle=False) as data:
+            self.sheet_names = data['sheet_names'].tolist()
+            self.raw = {}
+            for i, sheet_name in enumerate(self.sheet_names):
+                self.raw[sheet_name] = decode_sheet(data['values_' + str(i)], data['codes_' + str(i)],
+                                                    data['text_' + str(i)])
+
+
+_open_workbooks = {}
+
+
+# scripts call this per sheet, the workbook is only re-read when the file changes on disk
+def open_workbook(file_name, use_snapshot=True):
+    path = Path(file_name).resolve()
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+
+    if key not in _open_workbooks:
+        _open_workbooks[key] = Workbook(path, use_snapshot=use_snapshot)
+
+    return _open_workbooks[key]
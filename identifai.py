@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from common.jobs import DEFAULT_ADDRESS, PIPELINES, run_pipeline, serve, stop, submit
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(prog='identifai', description='IDentif.AI pipelines.',
+                                     epilog='Options of a pipeline: identifai <pipeline> --help')
+    parser.add_argument('--daemon', action='store_true',
+                        help='run the pipeline on the warm workers of "identifai serve"')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='socket of the worker server')
+    parser.add_argument('command', choices=list(PIPELINES) + ['batch', 'serve', 'stop'],
+                        help='pipeline to run, run one on many workbooks, or start/stop the worker server')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='arguments of the pipeline, e.g. the input workbook')
+
+    return parser.parse_args(argv)
+
+
+def get_serve_args(argv):
+    parser = argparse.ArgumentParser(prog='identifai serve', description='Serve pipeline jobs from warm workers.')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default: one per CPU')
+    parser.add_argument('--pipelines', nargs='+', choices=list(PIPELINES), default=list(PIPELINES),
+                        help='pipelines the workers import at startup')
+
+    return parser.parse_args(argv)
+
+
+def get_batch_args(argv):
+    parser = argparse.ArgumentParser(prog='identifai batch', description='Run a pipeline on many workbooks at once.',
+                                     epilog='Other options are passed on to every job, e.g. --no-cache.')
+    parser.add_argument('pipeline', choices=list(PIPELINES))
+    parser.add_argument('inputs', nargs='+', help='workbooks, or folders of workbooks')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default: one per CPU')
+    parser.add_argument('--max-pending', type=int, default=8, help='queued jobs before submitting waits')
+    parser.add_argument('--watch', action='store_true', help='keep watching the folders for new workbooks')
+    parser.add_argument('--poll', type=float, default=2.0, help='seconds between two scans of a watched folder')
+    parser.add_argument('--json', action='store_true', help='print every progress event as a JSON line')
+
+    return parser.parse_known_args(argv)
+
+
+def run_batch(argv):
+    from common.service import format_event, run_batch
+
+    args, job_argv = get_batch_args(argv)
+    on_event = (lambda event: print(json.dumps(event), flush=True)) if args.json else \
+        (lambda event: print(format_event(event), flush=True))
+    try:
+        failed = asyncio.run(run_batch(args.pipeline, args.inputs, job_argv, args.workers, args.max_pending,
+                                       args.watch, args.poll, on_event))
+    except KeyboardInterrupt:
+        failed = 1
+    sys.exit(1 if failed else 0)
+
+
+def main(argv=None):
+    args = get_args(argv)
+
+    if args.command == 'batch':
+        run_batch(args.args)
+    elif args.command == 'serve':
+        serve_args = get_serve_args(args.args)
+        serve(args.address, serve_args.workers, serve_args.pipelines)
+    elif args.command == 'stop':
+        print(stop(args.address)['output'], end='')
+    elif args.daemon:
+        try:
+            reply = submit(args.command, args.args, os.getcwd(), args.address)
+        except OSError:
+            print('...no worker server on', args.address, '- running in this process', file=sys.stderr)
+            run_pipeline(args.command, args.args)
+        else:
+            print(reply['output'], end='')
+            sys.exit(reply['status'])
+    else:
+        # only the chosen pipeline and what it imports are loaded
+        run_pipeline(args.command, args.args)
+
+
+if __name__ == '__main__':
+    main()
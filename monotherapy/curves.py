@@ -0,0 +1,278 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+READOUTS = ['Inhibition', 'Cytotoxicity']
+
+# Hill slope range, and how far (log10 units) EC50 may lie beyond the tested concentrations
+HILL_BOUNDS = (0.05, 20.0)
+EC50_MARGIN = 3.0
+
+
+# 4-parameter logistic y = bottom + (top - bottom) / (1 + 10^(hill * (log_ec50 - log_x))) of every curve (row of
+# params: bottom, top, log10 EC50, Hill slope) at its log10 concentrations, and its Jacobian:
+# (curves x points), (curves x points x 4)
+def logistic(params, log_x):
+    bottom, top, log_ec50, hill = [params[:, k, None] for k in range(4)]
+    dist = log_ec50 - log_x
+    u = 10 ** np.clip(hill * dist, -100, 100)
+    s = 1 / (1 + u)
+    y = bottom + (top - bottom) * s
+
+    # d y / d (hill * dist), shared by the EC50 and Hill derivatives
+    dz = -(top - bottom) * s * s * u * np.log(10)
+    jac = np.stack([1 - s, s, dz * hill, dz * dist], axis=2)
+
+    return y, jac
+
+
+# starting points from the data, n_starts per curve: plateaus at the lowest and highest response (ordered by the
+# trend of the curve), EC50 at the point closest to halfway and spread over the tested range, Hill slope 1 and 3
+def get_starts(log_x, y):
+    x_mean = np.nanmean(log_x, axis=1, keepdims=True)
+    y_mean = np.nanmean(y, axis=1, keepdims=True)
+    rising = np.nansum((log_x - x_mean) * (y - y_mean), axis=1) >= 0
+
+    y_min, y_max = np.nanmin(y, axis=1), np.nanmax(y, axis=1)
+    x_min, x_max = np.nanmin(log_x, axis=1), np.nanmax(log_x, axis=1)
+    middle = np.abs(np.where(np.isnan(y), np.inf, y) - ((y_min + y_max) / 2)[:, None])
+    log_ec50 = [log_x[np.arange(y.shape[0]), np.argmin(middle, axis=1)]]
+    log_ec50 += [x_min + q * (x_max - x_min) for q in (0.25, 0.5, 0.75)]
+
+    starts = [np.column_stack([np.where(rising, y_min, y_max), np.where(rising, y_max, y_min), ec50,
+                               np.full(y.shape[0], hill)])
+              for ec50 in log_ec50 for hill in (1.0, 3.0)]
+
+    return np.stack(starts, axis=1)
+
+
+# Box of every curve: plateaus within one response span beyond the measured responses, EC50 within
+# EC50_MARGIN decades of the tested concentrations, Hill slope within HILL_BOUNDS: (curves x 4) each
+def get_bounds(log_x, y):
+    y_min, y_max = np.nanmin(y, axis=1), np.nanmax(y, axis=1)
+    span = np.maximum(y_max - y_min, 1)
+    x_min, x_max = np.nanmin(log_x, axis=1), np.nanmax(log_x, axis=1)
+    hill = np.ones_like(y_min)
+    lower = np.column_stack([y_min - span, y_min - span, x_min - EC50_MARGIN, HILL_BOUNDS[0] * hill])
+    upper = np.column_stack([y_max + span, y_max + span, x_max + EC50_MARGIN, HILL_BOUNDS[1] * hill])
+
+    return lower, upper
+
+
+def get_sse(params, log_x, y, valid):
+    f, _ = logistic(params, log_x)
+
+    return np.sum(np.where(valid, y - f, 0) ** 2, axis=1)
+
+
+# Projected Levenberg-Marquardt on a batch of curves (rows), each from its own start. Every iteration solves the
+# damped normal equations of all active rows in one batched 4x4 solve; the damping of a row is lowered after a
+# step that reduced its SSE and raised after one that did not. A row converges once a step changes its SSE by
+# less than tol (relative) or its parameters by less than tol (relative); it stops without converging when no
+# damped step helps any more (stalled) or after max_iter iterations.
+def levenberg_marquardt(x, y, valid, start, lower, upper, max_iter=200, tol=1e-8):
+    p = np.clip(start, lower, upper)
+    sse = get_sse(p, x, y, valid)
+    lam = np.full(p.shape[0], 1e-3)
+    n_iter = np.zeros(p.shape[0], dtype=int)
+    done = np.zeros(p.shape[0], dtype=bool)
+    converged = np.zeros(p.shape[0], dtype=bool)
+
+    for _ in range(max_iter):
+        act = np.flatnonzero(~done)
+        if act.shape[0] == 0:
+            break
+
+        f, jac = logistic(p[act], x[act])
+        r = np.where(valid[act], y[act] - f, 0)
+        jac = jac * valid[act][:, :, None]
+        jtj = np.einsum('npk,npl->nkl', jac, jac)
+        grad = np.einsum('npk,np->nk', jac, r)
+
+        diag = np.einsum('nkk->nk', jtj)
+        ridge = lam[act, None] * diag + 1e-12 * (1 + diag.max(axis=1, keepdims=True))
+        step = np.linalg.solve(jtj + ridge[:, :, None] * np.eye(4), grad[:, :, None])[:, :, 0]
+
+        trial = np.clip(p[act] + step, lower[act], upper[act])
+        trial_sse = get_sse(trial, x[act], y[act], valid[act])
+        better = trial_sse < sse[act]
+        n_iter[act] += 1
+
+        small_gain = sse[act] - trial_sse <= tol * np.maximum(sse[act], 1e-12)
+        small_step = np.all(np.abs(trial - p[act]) <= tol * (np.abs(p[act]) + 1e-3), axis=1)
+        p[act[better]] = trial[better]
+        sse[act[better]] = trial_sse[better]
+        lam[act] = np.where(better, lam[act] / 10, lam[act] * 10)
+
+        stalled = lam[act] > 1e12  # no step reduces the SSE any more
+        converged[act[better & (small_gain | small_step)]] = True
+        done[act[better & (small_gain | small_step) | stalled]] = True
+
+    return p, sse, n_iter, converged
+
+
+# 4PL fit of many curves at once. log_x, y: (curves x points), NaN where a curve has no point; initial:
+# (curves x 4) starting parameters, e.g. the fits of a previous run on the same data, initial_r2 their R2.
+# A curve with a starting point is refined from there only (warm start); the others are fitted from every point
+# of get_starts and keep the best fit, which avoids the local minima of a single start. A warm fit that does not
+# converge or ends below its initial R2 is fitted from every point of get_starts as well, in a second batch.
+# Curves with fewer than 5 points are not fitted (NaN).
+def fit_curves(log_x, y, initial=None, initial_r2=None, max_iter=200, tol=1e-8):
+    y = np.asarray(y, dtype=float)
+    valid = ~np.isnan(y) & ~np.isnan(log_x)
+    log_x = np.where(valid, log_x, np.nan)
+    y = np.where(valid, y, np.nan)
+    n_curves = y.shape[0]
+    fitted = np.flatnonzero(valid.sum(axis=1) >= 5)
+
+    params = np.full((n_curves, 4), np.nan)
+    sse = np.full(n_curves, np.nan)
+    r2 = np.full(n_curves, np.nan)
+    n_iter = np.zeros(n_curves, dtype=int)
+    converged = np.zeros(n_curves, dtype=bool)
+    if fitted.shape[0] == 0:
+        return {'params': params, 'sse': sse, 'r2': r2, 'n_iter': n_iter, 'converged': converged}
+
+    x, y_fit, valid_fit = np.where(valid, log_x, 0)[fitted], y[fitted], valid[fitted]
+    starts = get_starts(log_x[fitted], y_fit)
+    lower, upper = get_bounds(log_x[fitted], y_fit)
+    sst = np.nansum((y_fit - np.nanmean(y_fit, axis=1, keepdims=True)) ** 2, axis=1)
+    n_starts = starts.shape[1]
+
+    warm = np.full((fitted.shape[0], 4), np.nan) if initial is None else np.asarray(initial, dtype=float)[fitted]
+    warm_r2 = np.full(fitted.shape[0], np.nan) if initial_r2 is None else np.asarray(initial_r2, dtype=float)[fitted]
+    has_warm = np.flatnonzero(~np.isnan(warm).any(axis=1))
+    cold = np.setdiff1d(np.arange(fitted.shape[0]), has_warm)
+
+    # one row per (curve, start): the warm start of a curve that has one, all starts of the others
+    owner = np.concatenate([has_warm, np.repeat(cold, n_starts)])
+    start = np.vstack([warm[has_warm], starts[cold].reshape(-1, 4)])
+    rows = levenberg_marquardt(x[owner], y_fit[owner], valid_fit[owner], start, lower[owner], upper[owner],
+                               max_iter, tol)
+
+    # warm fits that did not converge or lost fit quality get the cold starts too
+    with np.errstate(invalid='ignore', divide='ignore'):
+        worse = 1 - rows[1][0:has_warm.shape[0]] / sst[has_warm] < warm_r2[has_warm] - 1e-9
+    retry = has_warm[~rows[3][0:has_warm.shape[0]] | worse]
+    if retry.shape[0] > 0:
+        retry_owner = np.repeat(retry, n_starts)
+        retry_rows = levenberg_marquardt(x[retry_owner], y_fit[retry_owner], valid_fit[retry_owner],
+                                         starts[retry].reshape(-1, 4), lower[retry_owner], upper[retry_owner],
+                                         max_iter, tol)
+        owner = np.concatenate([owner, retry_owner])
+        rows = [np.concatenate([a, b]) for a, b in zip(rows, retry_rows)]
+    p, row_sse, row_iter, row_converged = rows
+
+    # best start of every curve; iterations are summed over its starts
+    order = np.lexsort((row_sse, owner))
+    _, first = np.unique(owner[order], return_index=True)
+    best = order[first]
+    params[fitted], sse[fitted], converged[fitted] = p[best], row_sse[best], row_converged[best]
+    n_iter[fitted] = np.bincount(owner, weights=row_iter, minlength=fitted.shape[0]).astype(int)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r2[fitted] = 1 - sse[fitted] / sst
+
+    return {'params': params, 'sse': sse, 'r2': r2, 'n_iter': n_iter, 'converged': converged}
+
+
+# concentration at which the fitted curve crosses the given response, NaN if it never does
+def get_crossing(params, response):
+    bottom, top, log_ec50, hill = params.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        u = (top - bottom) / (response - bottom) - 1
+
+        return np.where(u > 0, 10 ** (log_ec50 - np.log10(u) / hill), np.nan)
+
+
+# lowest / highest tested concentration of every curve, NaN for a curve without points
+def get_range(log_x, tested, reduce, fill):
+    bound = reduce(np.where(tested, log_x, fill), axis=1)
+
+    return np.where(np.isfinite(bound), 10 ** bound, np.nan)
+
+
+# digest of the points (log10 concentration, response) of every curve, so a stored fit is only reused for the
+# data it was fitted to and not for a new screen that reuses the drug names
+def get_curve_digests(log_x, y):
+    digests = []
+    for x_curve, y_curve in zip(log_x, y):
+        valid = ~np.isnan(x_curve) & ~np.isnan(y_curve)
+        digests.append(hashlib.sha256(np.stack([x_curve[valid], y_curve[valid]]).tobytes()).hexdigest()[:16])
+
+    return digests
+
+
+# starting parameters and R2 of every curve (drug-major, readouts in READOUTS order) from an earlier 'Curve fits'
+# table, NaN for a curve it has no fit of with the same data digest
+def get_warm_start(previous, drug_names, digests):
+    index = pd.MultiIndex.from_product([list(drug_names), READOUTS])
+    if previous is None or 'Data digest' not in previous.columns:
+        return np.full((len(index), 4), np.nan), np.full(len(index), np.nan)
+
+    df = previous.set_index(['Drug', 'Readout']).reindex(index)
+    same = (df['Data digest'] == np.asarray(digests)).values
+    initial = np.where(same[:, None], df[['Bottom', 'Top', 'EC50', 'Hill']].values.astype(float), np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        initial[:, 2] = np.log10(initial[:, 2])
+
+    return initial, np.where(same, df['R2'].values.astype(float), np.nan)
+
+
+# 4PL fits of %inhibition and %cytotoxicity of every drug in one batch, one row per drug and readout. conc_eff,
+# conc_ver: (drugs x concentrations) of the efficacy and VeroE6 plates, inhibition/cytotoxicity: (drugs x
+# concentrations x replicates); every replicate well is a point, wells at concentration 0 are left out.
+# previous: the 'Curve fits' table of an earlier run; its fits of curves with unchanged data (same Data digest)
+# are the starting points of those curves (warm start). Response50 is the concentration of 50% inhibition (IC50)
+# or cytotoxicity (CC50).
+def fit_dose_response(drug_names, conc_eff, conc_ver, inhibition, cytotoxicity, previous=None):
+    n_drugs, _, n_rep = inhibition.shape
+    log_x = []
+    for conc in [conc_eff, conc_ver]:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            log_conc = np.where(conc > 0, np.log10(conc), np.nan)
+        log_x.append(np.repeat(log_conc[:, :, None], n_rep, axis=2).reshape(n_drugs, -1))
+    log_x = np.stack(log_x, axis=1).reshape(2 * n_drugs, -1)
+    y = np.stack([inhibition.reshape(n_drugs, -1), cytotoxicity.reshape(n_drugs, -1)], axis=1)
+    y = y.reshape(2 * n_drugs, -1)
+
+    digests = get_curve_digests(log_x, y)
+    fit = fit_curves(log_x, y, *get_warm_start(previous, drug_names, digests))
+    params = fit['params']
+
+    df = pd.DataFrame({'Drug': np.repeat(list(drug_names), 2), 'Readout': READOUTS * n_drugs})
+    df['Bottom'] = params[:, 0]
+    df['Top'] = params[:, 1]
+    df['EC50'] = 10 ** params[:, 2]
+    df['Hill'] = params[:, 3]
+    df['Response50'] = get_crossing(params, 50)
+    tested = ~np.isnan(y) & ~np.isnan(log_x)
+    df['Min conc'] = get_range(log_x, tested, np.min, np.inf)
+    df['Max conc'] = get_range(log_x, tested, np.max, -np.inf)
+    df['R2'] = fit['r2']
+    df['Iterations'] = fit['n_iter']
+    df['Converged'] = fit['converged']
+    df['Data digest'] = digests
+
+    return df
+
+
+# IC50, CC50 and selectivity index CC50 / IC50 per drug. A CC50 beyond the highest tested concentration (or
+# never reached) is reported as that concentration and flagged, its SI is then a lower bound; an IC50 outside
+# the tested range is left out.
+def get_selectivity(df_fits):
+    fits = df_fits.set_index(['Drug', 'Readout'])
+    drug_names = list(dict.fromkeys(df_fits['Drug']))
+    eff = fits.xs('Inhibition', level='Readout').loc[drug_names]
+    ver = fits.xs('Cytotoxicity', level='Readout').loc[drug_names]
+
+    ic50 = eff['Response50'].where((eff['Response50'] >= eff['Min conc']) & (eff['Response50'] <= eff['Max conc']))
+    beyond = ~(ver['Response50'] <= ver['Max conc'])
+    cc50 = ver['Response50'].where(~beyond, ver['Max conc'])
+
+    df = pd.DataFrame({'Drug': drug_names, 'IC50': ic50.values, 'CC50': cc50.values})
+    df['SI'] = df['CC50'] / df['IC50']
+    df['CC50 beyond range'] = beyond.values
+
+    return df
@@ -1,9 +1,24 @@
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 from openpyxl import load_workbook
 import logging
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.profiling import add_profile_argument, get_profiler
+from common.store import add_store_arguments, open_result_store, save_tables
+from common.workbook import open_workbook
+from curves import fit_dose_response, get_selectivity
+
+# control columns read by get_control, test wells are the 3 columns after 'Concentration'
+CONTROL_COLS = ['DMSO (G10-12)', 'Cells+media (H)', 'Cells+media+virus (H)']
+
+
 def get_raw_data(file_name, sheet_name):
-    df = pd.read_excel(file_name, sheet_name=sheet_name).astype(float)
+    df = open_workbook(file_name).parse(sheet_name).astype(float)
 
     return df
 
@@ -42,6 +57,65 @@ def calculate_y(dmso, df_eff, df_ver):
     return inhibition, cytotoxicity
 
 
+# batch mode: all <drug>_eff / <drug>_VeroE6 sheets stacked into (drugs x concentrations x columns) arrays,
+# padded with NaN where a drug (or one of its two sheets) has fewer concentrations.
+# A drug with a missing sheet or control column is reported and left out.
+def get_batch_data(file_name, drug_names):
+    xls = open_workbook(file_name)
+
+    found, frames = [], []
+    for drug_name in drug_names:
+        sheets = [drug_name + '_eff', drug_name + '_VeroE6']
+        missing = [s for s in sheets if s not in xls.sheet_names]
+        if missing:
+            print('Failed to compile for ' + drug_name + ', missing sheet ' + ', '.join(missing))
+            continue
+
+        dfs = [xls.parse(s) for s in sheets]
+        missing = [s + ' ' + repr(col) for s, df in zip(sheets, dfs) for col in CONTROL_COLS if col not in df.columns]
+        if missing:
+            print('Failed to compile for ' + drug_name + ', missing column ' + ', '.join(missing))
+            continue
+
+        found.append(drug_name)
+        for df in dfs:
+            frames.append(pd.concat([df.iloc[:, 0:4], df[CONTROL_COLS]], axis=1).values.astype(float))
+
+    # rows of a drug: the longer of its two sheets, as the concentrations come from the VeroE6 sheet
+    n_rows = np.array([max(eff.shape[0], ver.shape[0]) for eff, ver in zip(frames[0::2], frames[1::2])], dtype=int)
+    stacked = np.full((len(frames), max(n_rows, default=0), 4 + len(CONTROL_COLS)), np.nan)
+    for i, frame in enumerate(frames):
+        stacked[i, 0:frame.shape[0], :] = frame
+
+    return found, stacked[0::2], stacked[1::2], n_rows
+
+
+def get_control_batch(plate, dmso, extra_str):
+    with np.errstate(invalid='ignore'):
+        avg = {col: np.nanmean(plate[:, :, 4 + i], axis=1) for i, col in enumerate(CONTROL_COLS)}
+
+    avg_wo = avg['Cells+media (H)'] if 'drug plate' in extra_str else avg['Cells+media+virus (H)']
+
+    return np.where(dmso == 0, avg_wo, avg['DMSO (G10-12)'])
+
+
+def calculate_y_batch(dmso, eff, ver):
+    dmso = np.asarray(dmso)
+
+    # controls per drug: lower bound and upper bound cell viability
+    cell_virus = get_control_batch(eff, dmso, 'viral plate')[:, None, None]
+    cell_vehicle = get_control_batch(ver, dmso, 'drug plate')[:, None, None]
+
+    # test drug wells
+    cell_drug_virus = eff[:, :, 1:4]
+    cell_drug = ver[:, :, 1:4]
+
+    inhibition = (cell_drug_virus - cell_virus) / (cell_vehicle - cell_virus) * 100
+    cytotoxicity = (cell_vehicle - cell_drug) / cell_vehicle * 100
+
+    return inhibition, cytotoxicity
+
+
 def save_file(file_name, df1, df2, df3, drug_name):
     book = None
     try:
@@ -63,25 +137,82 @@ def save_file(file_name, df1, df2, df3, drug_name):
     pass
 
 
-if __name__ == '__main__':
-    file_input = 'Monotherapy.xlsx'
+# one result table per drug, keyed by its sheet name in Monotherapy_result.xlsx
+def get_result_tables(drug_names, drug_conc, inhibition, cytotoxicity, n_rows):
+    columns = ['concentration', 'inhibition 1', 'inhibition 2', 'inhibition 3', 'cytotoxicity 1',
+               'cytotoxicity 2', 'cytotoxicity 3']
+
+    tables = {}
+    for i, drug_name in enumerate(drug_names):
+        values = np.hstack([drug_conc[i, :, None], inhibition[i], cytotoxicity[i]])[0:n_rows[i]]
+        tables[drug_name] = pd.DataFrame(values, columns=columns)
+
+    return tables
+
+
+# all result sheets in one writer session
+def write_excel(file_name, tables):
+    writer = pd.ExcelWriter(file_name, engine='xlsxwriter')
+    for sheet_name, df in tables.items():
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+    writer.save()
+    print('...data have been saved.')
+
+
+def save_file_batch(file_name, drug_names, drug_conc, inhibition, cytotoxicity, n_rows):
+    write_excel(file_name, get_result_tables(drug_names, drug_conc, inhibition, cytotoxicity, n_rows))
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Monotherapy %inhibition and %cytotoxicity of every drug.')
+    parser.add_argument('input', nargs='?', default='Monotherapy.xlsx',
+                        help='input workbook, default: Monotherapy.xlsx')
+    add_profile_argument(parser, 'monotherapy')
+    add_store_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    file_input = args.input
     file_output = 'Monotherapy_result.xlsx'
+    folder_store = './results/monotherapy'
+
+    profiler = get_profiler('monotherapy', argv)
 
     # get list: if drug was dissolved in DMSO (1), no DMSO (0)
-    df_dmso = pd.read_excel(file_input, sheet_name='Solvent')
+    with profiler.stage('read_input') as record:
+        df_dmso = open_workbook(file_input).parse('Solvent')
 
-    for i, drug_name in enumerate(df_dmso['Drug']):
-        try:
-            df_eff = get_raw_data(file_input, drug_name + '_eff')
-            df_ver = get_raw_data(file_input, drug_name + '_VeroE6')
+        # read every drug sheet in one pass, then calculate and save all drugs at once
+        drug_names, eff, ver, n_rows = get_batch_data(file_input, df_dmso['Drug'])
+        dmso = df_dmso.set_index('Drug').loc[drug_names, 'DMSO'].values
+        record['rows'] = int(n_rows.sum())
 
-            drug_conc = df_ver.iloc[:, 0]
-            inhibition, cytotoxicity = calculate_y(df_dmso['DMSO'][i], df_eff, df_ver)
+    with profiler.stage('calculate_y', rows=int(n_rows.sum())):
+        inhibition, cytotoxicity = calculate_y_batch(dmso, eff, ver)
 
-            save_file(file_output, drug_conc, inhibition, cytotoxicity, drug_name=drug_name)
-        except Exception as e:
-            print('Failed to compile for ' + drug_name + ', ' + str(e))
-            pass
+    # dose-response curves of all drugs in one batch, curves with unchanged data start from the fit of the previous run
+    store = open_result_store(folder_store, args.store)
+    with profiler.stage('fit_curves', rows=2 * len(drug_names)):
+        previous = store.read('Curve fits') if store is not None and 'Curve fits' in store.tables else None
+        df_fits = fit_dose_response(drug_names, eff[:, :, 0], ver[:, :, 0], inhibition, cytotoxicity, previous)
+        df_selectivity = get_selectivity(df_fits)
+        print('...' + str(int(df_fits['Converged'].sum())) + ' of ' + str(df_fits.shape[0]) +
+              ' dose-response fits converged' + (' (warm start).' if previous is not None else '.'))
 
-    pass
+    # results go to the result store and/or the Excel file
+    with profiler.stage('save_results') as record:
+        tables = get_result_tables(drug_names, ver[:, :, 0], inhibition, cytotoxicity, n_rows)
+        tables['Curve fits'] = df_fits
+        tables['Selectivity'] = df_selectivity
+        save_tables(store, file_output, tables, write_excel, args.excel)
+        record['rows'] = sum(df.shape[0] for df in tables.values())
+
+    profiler.save()
 
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ranking import PRED_COLUMNS
+from regression import build_design
+
+
+# Resampling replicates with replacement inside each combo keeps its replicate count, so the count-weighted
+# design of every output is the same for all resamples. The fit is then one fixed linear map of the
+# replicate means: coef = S @ y_mean with S the minimum-norm solution operator of the weighted design.
+def get_solution_operator(design, counts):
+    operators = []
+    for c in range(counts.shape[1]):
+        sqrt_w = np.sqrt(counts[:, c].astype(float))
+        operators.append(np.linalg.pinv(sqrt_w[:, None] * design) * sqrt_w[None, :])
+
+    return np.stack(operators)
+
+
+# replicate means of n_boot resamples: (n_boot x combos x outputs)
+def resample_means(y_sorted, counts, n_boot, rng):
+    n_rows, n_rep, n_out = y_sorted.shape
+    draw = np.floor(rng.random((n_boot, n_rows, n_rep, n_out)) * np.maximum(counts, 1)[None, :, None, :])
+    draw = draw.astype(np.int64)
+    values = np.take_along_axis(np.broadcast_to(y_sorted, draw.shape), draw, axis=2)
+
+    # only the first count draws of a row are used, the rest is padding
+    used = np.arange(n_rep)[None, None, :, None] < counts[None, :, None, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(used, values, 0).sum(axis=2) / counts[None, :, :]
+
+    return np.nan_to_num(means)
+
+
+# predictions of the candidate combinations under every resample: (n_boot x candidates x outputs)
+def bootstrap_predictions(operators, y_sorted, counts, candidates, n_boot, seed):
+    rng = np.random.default_rng(seed)
+    means = resample_means(y_sorted, counts, n_boot, rng)
+    coef = np.einsum('kpn,bnk->bpk', operators, means)
+
+    return np.einsum('cp,bpk->bck', candidates, coef)
+
+
+_shared = None
+
+
+def _init_worker(operators, y_sorted, counts, candidates):
+    global _shared
+    _shared = (operators, y_sorted, counts, candidates)
+
+
+def _run_chunk(n_boot, seed):
+    return bootstrap_predictions(*_shared, n_boot, seed)
+
+
+class BootstrapRanking(object):
+    # input
+    subsets: dict
+    objective: np.ndarray
+
+    # output
+    predictions: np.ndarray
+    summary: dict
+
+    def __init__(self, model, ranker, n_boot=2000, seed=0, level=0.95, top_n=5):
+        # candidates are the ranked combinations of every subset size
+        self.subsets = ranker.get_subsets()
+        self.objective = ranker.objective
+        self.drug_names = list(model.drug_names)
+        self.n_boot = n_boot
+        self.seed = seed
+        self.level = level
+        self.top_n = top_n
+
+        counts = np.sum(~np.isnan(model.y_rep), axis=1)
+        self.counts = counts
+        self.y_sorted = np.sort(model.y_rep, axis=1)  # NaN replicates last
+        self.operators = get_solution_operator(model.design, counts)
+
+        conc = np.vstack([df[self.drug_names].values for df in self.subsets.values()])
+        self.candidates, _ = build_design(conc)
+
+    def run(self, max_workers=None, chunk_size=250):
+        sizes = [min(chunk_size, self.n_boot - i) for i in range(0, self.n_boot, chunk_size)]
+        seeds = np.random.SeedSequence(self.seed).spawn(len(sizes))
+        args = (self.operators, self.y_sorted, self.counts, self.candidates)
+
+        max_workers = max_workers or os.cpu_count() or 1
+        if max_workers == 1:
+            parts = [bootstrap_predictions(*args, n, s) for n, s in zip(sizes, seeds)]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=args) as pool:
+                parts = list(pool.map(_run_chunk, sizes, seeds))
+
+        self.predictions = np.concatenate(parts, axis=0)
+        self.summary = self._summarize()
+
+        return self
+
+    def _summarize(self):
+        alpha = (1 - self.level) / 2 * 100
+        summary = {}
+        start = 0
+        for sheet_name, df in self.subsets.items():
+            pred = self.predictions[:, start:start + df.shape[0], :]
+            start += df.shape[0]
+
+            # rank of every candidate within its subset, per resample (1 = best)
+            score = pred @ self.objective
+            rank = np.argsort(np.argsort(-score, axis=1), axis=1) + 1
+
+            df = df.copy()
+            df.insert(0, 'Rank', np.arange(1, df.shape[0] + 1))
+            df['Mean bootstrap rank'] = rank.mean(axis=0)
+            df['P(rank 1)'] = (rank == 1).mean(axis=0)
+            df['P(top ' + str(self.top_n) + ')'] = (rank <= self.top_n).mean(axis=0)
+            for k, col in enumerate(PRED_COLUMNS[:pred.shape[2]]):
+                low, high = np.percentile(pred[:, :, k], [alpha, 100 - alpha], axis=0)
+                df[col + ' CI low'] = low
+                df[col + ' CI high'] = high
+            summary[sheet_name] = df
+
+        return summary
+
+    def save_file_excel(self, file_name):
+        Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+        writer = pd.ExcelWriter(file_name, engine='xlsxwriter')
+        for sheet_name, df in self.summary.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+        writer.save()
+        print('...bootstrap rank stability has been saved.')
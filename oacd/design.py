@@ -0,0 +1,137 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from diagnostics import DesignDiagnostics
+from ranking import get_dose_levels
+from regression import build_design
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.workbook import open_workbook
+
+
+# degree-2 model rows of many dose vectors at once, same term order as build_design
+def expand_rows(x, powers):
+    return np.prod(x[:, None, :] ** powers[None, :, :], axis=2)
+
+
+# Coordinate exchange for a D-optimal design on the dose-level grid. For one coordinate all levels are tried at
+# once: replacing model row f by g changes det(M) by (1 + g'Ag)(1 - f'Af) + (f'Ag)^2 with A = M^-1, and an
+# accepted change updates A with two Sherman-Morrison steps, so no step refactorizes M. Doses are scaled to
+# [0, 1] per drug, which leaves the optimal design unchanged. A tiny ridge keeps M invertible while a random
+# start is still singular; it is dropped when the final design is scored.
+def coordinate_exchange(levels, n_runs, seed, max_passes=20, ridge=1e-6):
+    rng = np.random.default_rng(seed)
+    scaled = [lv / lv.max() if lv.max() > 0 else lv for lv in levels]
+    n_drugs = len(levels)
+    _, powers = build_design(np.zeros((1, n_drugs)))
+
+    digits = np.column_stack([rng.integers(0, len(lv), n_runs) for lv in levels])
+    x = np.column_stack([scaled[j][digits[:, j]] for j in range(n_drugs)])
+    rows = expand_rows(x, powers)
+    inv = np.linalg.inv(rows.T @ rows + ridge * np.eye(rows.shape[1]))
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n_runs):
+            for j in range(n_drugs):
+                cand = np.repeat(x[i:i + 1], len(scaled[j]), axis=0)
+                cand[:, j] = scaled[j]
+                g = expand_rows(cand, powers)
+                f = rows[i]
+
+                af = inv @ f
+                ag = g @ inv
+                ratio = (1 + np.sum(ag * g, axis=1)) * (1 - f @ af) + (ag @ f) ** 2
+                best = int(np.argmax(ratio))
+                if best == digits[i, j] or ratio[best] <= 1 + 1e-9:
+                    continue
+
+                # add g, then remove f
+                ag_best = inv @ g[best]
+                inv -= np.outer(ag_best, ag_best) / (1 + g[best] @ ag_best)
+                af = inv @ f
+                inv += np.outer(af, af) / (1 - f @ af)
+
+                digits[i, j] = best
+                x[i] = cand[best]
+                rows[i] = g[best]
+                improved = True
+
+        # refresh the inverse once per pass so rounding does not build up
+        inv = np.linalg.inv(rows.T @ rows + ridge * np.eye(rows.shape[1]))
+        if not improved:
+            break
+
+    sign, logdet = np.linalg.slogdet(rows.T @ rows)
+
+    return digits, (logdet if sign > 0 else -np.inf)
+
+
+def _run_restart(args):
+    levels, n_runs, seed, max_passes = args
+    digits, logdet = coordinate_exchange(levels, n_runs, seed, max_passes)
+
+    # hard constraint: the expanded design of the real doses must be free of linear dependencies
+    x = np.column_stack([levels[j][digits[:, j]] for j in range(len(levels))])
+    if not DesignDiagnostics(x).is_full_rank:
+        logdet = -np.inf
+
+    return digits, logdet
+
+
+# D-optimal OACD array for the drugs of a Conc_table: the best of n_restarts coordinate-exchange runs from
+# random starts, run on a process pool. Returns the design as dose-level codes (like the 'OACD' sheet) and
+# log det(X'X) of the scaled design.
+def generate_design(df_conc_table, drug_names, n_runs=None, n_restarts=8, max_passes=20, seed=0, max_workers=None):
+    levels = get_dose_levels(df_conc_table, drug_names)
+    n_terms = (len(drug_names) + 1) * (len(drug_names) + 2) // 2
+    n_runs = n_runs or n_terms + 10
+    if n_runs < n_terms:
+        raise ValueError('a full-rank quadratic design needs at least ' + str(n_terms) + ' runs')
+
+    seeds = np.random.SeedSequence(seed).generate_state(n_restarts)
+    tasks = [(levels, n_runs, int(s), max_passes) for s in seeds]
+
+    max_workers = min(max_workers or os.cpu_count() or 1, n_restarts)
+    if max_workers == 1:
+        results = [_run_restart(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(_run_restart, tasks))
+
+    digits, logdet = max(results, key=lambda result: result[1])
+    if not np.isfinite(logdet):
+        raise ValueError('no restart produced a design without linear dependencies, try more runs or restarts')
+
+    codes = df_conc_table['Dose level'].values
+    df = pd.DataFrame(codes[digits], columns=drug_names)
+    df.insert(0, 'Combo_ID', ['C' + str(i + 1) for i in range(n_runs)])
+    print('...design with', n_runs, 'runs for', len(drug_names), 'drugs, log det =', round(logdet, 3))
+
+    return df, logdet
+
+
+def save_design_excel(df_design, df_conc_table, file_name):
+    Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+    writer = pd.ExcelWriter(file_name, engine='xlsxwriter')
+    df_design.to_excel(writer, sheet_name='OACD', index=False)
+    df_conc_table.to_excel(writer, sheet_name='Conc_table', index=False)
+    writer.save()
+    print('...design has been saved.')
+
+
+if __name__ == '__main__':
+    file_input = 'OACD.xlsx'
+    file_output = 'OACD_design.xlsx'
+
+    # a new array for the drugs and dose levels of the Conc_table sheet
+    df_conc_table = open_workbook(file_input).parse('Conc_table')
+    drug_names = [col for col in df_conc_table.columns if col != 'Dose level']
+
+    df_design, _ = generate_design(df_conc_table, drug_names)
+    save_design_excel(df_design, df_conc_table, file_output)
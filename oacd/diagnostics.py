@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+from scipy.linalg import qr, solve_triangular
+
+from regression import build_design, term_names
+
+
+# term blocks of the degree-2 design, in the order columns are admitted by the hierarchical pivoting
+BLOCKS = ['intercept', 'linear', 'square', 'interaction']
+
+
+def get_term_blocks(powers):
+    degree = powers.sum(axis=1)
+    n_factors = np.count_nonzero(powers, axis=1)
+
+    return np.where(degree == 0, 0, np.where(degree == 1, 1, np.where(n_factors == 1, 2, 3)))
+
+
+# Column order of a for a hierarchical pivoted QR: the blocks are admitted in order (intercept, linear, squares,
+# interactions) and columns are only pivoted within their block, each against the part of it that the terms
+# already admitted do not explain. So a dependency is charged to the highest-order terms that complete it, not
+# to main effects. Returns the order (independent columns first, then the aliased ones) and the rank.
+def get_hierarchical_order(a, blocks, tol):
+    basis = np.zeros((a.shape[0], 0))
+    independent, aliased = [], []
+    for block in blocks:
+        if len(block) == 0:
+            continue
+        resid = a[:, block] - basis @ (basis.T @ a[:, block])
+        resid -= basis @ (basis.T @ resid)  # second pass keeps the residual orthogonal
+        q, r, piv = qr(resid, mode='economic', pivoting=True)
+        n = int(np.count_nonzero(np.abs(np.diag(r)) > tol))
+        independent += list(block[piv[0:n]])
+        aliased += list(block[piv[n:]])
+        basis = np.hstack([basis, q[:, 0:n]])
+
+    return np.array(independent + aliased, dtype=int), len(independent)
+
+
+# Rank and conditioning of the degree-2 design from one hierarchically pivoted QR factorization (see
+# get_hierarchical_order) of the design with every column scaled to unit norm. Only the p x p triangular factor
+# is kept, so adding rows refactorizes [R; new rows] instead of the whole design, and candidate rows are
+# screened against R without any update.
+class DesignDiagnostics(object):
+    # input
+    drug_names: list
+    terms: list
+    blocks: np.ndarray
+    scale: np.ndarray
+
+    # output
+    factor: np.ndarray
+    pivot: np.ndarray
+    rank: int
+
+    def __init__(self, x, drug_names=None):
+        x = np.asarray(x, dtype=float)
+        mtx, powers = build_design(x)
+        self.drug_names = list(drug_names) if drug_names is not None else ['x' + str(i) for i in range(x.shape[1])]
+        self.terms = term_names(self.drug_names, powers)
+        self.blocks = get_term_blocks(powers)
+
+        norms = np.linalg.norm(mtx, axis=0)
+        self.scale = np.where(norms > 0, norms, 1)
+
+        n_terms = mtx.shape[1]
+        self.factor = np.zeros((0, n_terms))
+        self.pivot = np.arange(n_terms)
+        self.n_rows = 0
+        self.col_sum = np.zeros(n_terms)
+        self.col_sq = np.zeros(n_terms)
+        self._update(mtx)
+
+    @property
+    def n_terms(self):
+        return len(self.terms)
+
+    @property
+    def is_full_rank(self):
+        return self.rank == self.n_terms
+
+    def add_rows(self, x):
+        mtx, _ = build_design(np.atleast_2d(np.asarray(x, dtype=float)))
+        self._update(mtx)
+
+        return self
+
+    # condition number of the scaled design (inf when rank deficient) and of its independent columns
+    def get_condition(self):
+        s = np.linalg.svd(self.factor[0:self.rank, 0:self.rank], compute_uv=False)
+        independent = s[0] / s[-1] if self.rank > 0 else np.inf
+
+        return (independent if self.is_full_rank else np.inf), independent
+
+    def get_summary(self):
+        condition, independent = self.get_condition()
+
+        return {'rows': self.n_rows, 'terms': self.n_terms, 'rank': self.rank,
+                'condition': condition, 'condition (independent terms)': independent,
+                'aliased terms': self.n_terms - self.rank}
+
+    # coefficients expressing every aliased term (rows) in the independent terms (columns), unscaled:
+    # x_term = sum_i c_i * scale_term / scale_i * x_i with c from R11 c = R12
+    def get_alias_matrix(self):
+        r = self.rank
+        coef = solve_triangular(self.factor[0:r, 0:r], self.factor[0:r, r:]).T
+        independent, aliased = self.pivot[0:r], self.pivot[r:]
+        coef = coef * self.scale[aliased][:, None] / self.scale[independent][None, :]
+
+        return pd.DataFrame(coef, index=[self.terms[i] for i in aliased], columns=[self.terms[i] for i in independent])
+
+    def get_aliases(self):
+        rows = []
+        for term, c in self.get_alias_matrix().iterrows():
+            used = c[np.abs(c) > 1e-8 * max(np.abs(c).max(), 1)]
+            expr = ' + '.join('{:.4g}*{}'.format(value, name) for name, value in used.items())
+            rows.append([term, expr.replace('+ -', '- ')])
+
+        return pd.DataFrame(rows, columns=['Term', 'Aliased with'])
+
+    # variance inflation factors of the independent terms, inf for aliased terms, NaN for the intercept
+    def get_vif(self):
+        r = self.rank
+        inv = solve_triangular(self.factor[0:r, 0:r], np.eye(r))
+        var = np.sum(inv ** 2, axis=1)  # diag of (Xs'Xs)^-1 over the independent columns
+
+        vif = np.full(self.n_terms, np.inf)
+        independent = self.pivot[0:r]
+        centered_ss = self.col_sq - self.col_sum ** 2 / self.n_rows
+        vif[independent] = var * centered_ss[independent] / self.scale[independent] ** 2
+        vif[np.array([t == '(Intercept)' for t in self.terms])] = np.nan
+
+        return pd.Series(vif, index=self.terms, name='VIF')
+
+    # What-if screening of candidate rows (one candidate per row), each judged on its own against the current
+    # design: whether it raises the rank, and the log-determinant gain log(1 + x'(X'X)^-1 x) over the
+    # independent terms (the D-criterion change of a rank-one update).
+    def evaluate_candidates(self, x):
+        mtx, _ = build_design(np.atleast_2d(np.asarray(x, dtype=float)))
+        scaled = (mtx / self.scale)[:, self.pivot]
+        r = self.rank
+
+        # residual of each candidate outside the row space of the design
+        lead = solve_triangular(self.factor[0:r, 0:r], scaled[:, 0:r].T, trans='T')
+        resid = scaled[:, r:] - (self.factor[0:r, r:].T @ lead).T
+        norms = np.linalg.norm(scaled, axis=1)
+        gain = np.linalg.norm(resid, axis=1) > 1e-8 * np.maximum(norms, 1e-300)
+
+        return pd.DataFrame({'Rank gain': gain.astype(int), 'Log-det gain': np.log1p(np.sum(lead ** 2, axis=0))})
+
+    def _update(self, mtx):
+        self.n_rows += mtx.shape[0]
+        self.col_sum += mtx.sum(axis=0)
+        self.col_sq += np.sum(mtx ** 2, axis=0)
+
+        n_terms = self.n_terms
+        a = np.vstack([self.factor, (mtx / self.scale)[:, self.pivot]])
+        norm = np.max(np.linalg.norm(a, axis=0))
+        tol = max(self.n_rows, n_terms) * np.finfo(float).eps * (norm if norm > 0 else 1)
+        blocks = [np.flatnonzero(self.blocks[self.pivot] == k) for k in range(len(BLOCKS))]
+        order, self.rank = get_hierarchical_order(a, blocks, tol)
+
+        r = qr(a[:, order], mode='r')[0]
+        self.factor = np.zeros((n_terms, n_terms))
+        self.factor[0:min(r.shape[0], n_terms), :] = r[0:n_terms, :]
+        self.pivot = self.pivot[order]
@@ -1,16 +1,126 @@
+import argparse
+import sys
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import PolynomialFeatures
+
+from bootstrap import BootstrapRanking
+from diagnostics import DesignDiagnostics
+from ranking import PRED_COLUMNS, ComboRanker, get_dose_levels
+from regression import QuadraticRegression
+from score_index import build_score_index
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.cache import StageCache, add_cache_arguments, get_source_digest, get_stage_cache
+from common.figures import FigureJob, render_all
+from common.plates import BLANK, DMSO, NO_DMSO, CELLS, VIRUS, PlateArray, build_plates
+from common.profiling import add_profile_argument, get_profiler
+from common.store import add_store_arguments, open_result_store, save_tables
+from common.workbook import open_workbook
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
+READOUTS = ['Eff', 'Vero', 'Cardiac', 'Liver']
+
+# 'Controls' sheet column: (readout, well role)
+CONTROL_MAP = {'DMSO Eff': ('Eff', DMSO), 'No DMSO Eff': ('Eff', NO_DMSO),
+               'Cells Eff': ('Eff', CELLS), 'Virus Eff': ('Eff', VIRUS),
+               'DMSO Vero': ('Vero', DMSO), 'No DMSO Vero': ('Vero', NO_DMSO),
+               'DMSO Cardiac': ('Cardiac', DMSO), 'No DMSO Cardiac': ('Cardiac', NO_DMSO),
+               'Blank Cardiac': ('Cardiac', BLANK),
+               'DMSO Liver': ('Liver', DMSO), 'No DMSO Liver': ('Liver', NO_DMSO),
+               'Blank Liver': ('Liver', BLANK),
+               # the shipped OACD.xlsx labels the THLE-2 (liver) controls 'Lung'
+               'DMSO Lung': ('Liver', DMSO), 'No DMSO Lung': ('Liver', NO_DMSO),
+               'Blank Lung': ('Liver', BLANK)}
+
+# 'Controls' sheet columns that label the wells rather than hold control values
+CONTROL_LABELS = ['Well']
+
+
+# control set of every (combo, replicate) well as 0-based plate indices: combos are split in order over
+# groups of n_rep sets, one set per replicate (C1-50 on sets 1-3 and C51-100 on sets 4-6 for the 100-run
+# design), monotherapy wells share the first group
+def get_default_plate_map(n_combo, n_mono, n_sets, n_rep=3):
+    if n_sets < n_rep:
+        raise ValueError(str(n_sets) + ' control set(s) for ' + str(n_rep) +
+                         ' replicates, the default plate map needs one set per replicate (or a Plate_map sheet)')
+
+    n_groups = max(n_sets // n_rep, 1)
+    group_size = -(-n_combo // n_groups)
+    group = np.arange(n_combo) // group_size
+    plate_map = group[:, None] * n_rep + np.arange(n_rep)[None, :]
+    mono_plate_map = np.tile(np.arange(n_rep), (n_mono, 1))
+
+    return plate_map, mono_plate_map
+
+
+# 'Plate_map' sheet indexed by combo ID, every control set number checked to be one of 1..n_sets
+def get_sheet_plate_map(df_plate_map, n_sets):
+    df = df_plate_map.set_index(df_plate_map.columns[0])
+    values = df.values.astype(float)
+    bad = ~np.isin(values, np.arange(1, n_sets + 1))
+    if bad.any():
+        row, col = np.argwhere(bad)[0]
+        raise ValueError("'Plate_map' " + str(df.index[row]) + ', ' + str(df.columns[col]) + ': control set ' +
+                         '%g' % values[row, col] + ' is not one of 1..' + str(n_sets))
+
+    return df
+
+
+# predicted response surface of every drug pair over its Conc_table range, all other drugs at zero dose
+def get_interaction_jobs(model, df_conc_table, folder, n_points=25):
+    drug_names = model.drug_names
+    levels = get_dose_levels(df_conc_table, drug_names)
+    jobs = []
+    for i in range(len(drug_names)):
+        for j in range(i + 1, len(drug_names)):
+            xi = np.linspace(0, levels[i].max(), n_points)
+            xj = np.linspace(0, levels[j].max(), n_points)
+            x = np.zeros((n_points * n_points, len(drug_names)))
+            x[:, i] = np.tile(xi, n_points)
+            x[:, j] = np.repeat(xj, n_points)
+            pred = model.predict(x)
+
+            for k, output in enumerate(PRED_COLUMNS[:pred.shape[1]]):
+                data = {'x': xi, 'y': xj, 'z': pred[:, k].reshape(n_points, n_points),
+                        'xlabel': drug_names[i], 'ylabel': drug_names[j], 'title': output}
+                file_name = folder + '/' + model.output_names[k] + '/' + drug_names[i] + '_' + drug_names[j] + '.png'
+                jobs.append(FigureJob('surface', file_name, data))
+
+    return jobs
+
+
+def write_result_excel(file_name, tables):
+    writer = pd.ExcelWriter(file_name, engine='xlsxwriter')
+    wb = writer.book
+    format1 = wb.add_format({'bg_color': '#fff9ae',
+                             'font_color': '#9C0006'})
+
+    for sheet_name, df in tables.items():
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
+        if sheet_name == 'All Y-outputs':
+            worksheet = writer.sheets[sheet_name]
+            # cytotoxicity averages, columns O:Q for triplicates
+            worksheet.conditional_format(1, df.columns.get_loc('Avg_Vero'), df.shape[0], df.columns.get_loc('Avg_Liver'),
+                                         {'type': 'cell',
+                                          'criteria': 'greater than',
+                                          'value': 25,
+                                          'format': format1}
+                                         )
+
+    writer.save()
+    print('...data have been saved.')
+
 
 class ExperimentResult(object):
     # input
     df_solvent: pd.DataFrame
     df_oacd: pd.DataFrame
     df_mono_X: pd.DataFrame
-    df_ctrl = [pd.DataFrame()]*6
+    df_ctrl: list
+    df_plate_map: pd.DataFrame
     df_efficacy: pd.DataFrame
     df_veroE6: pd.DataFrame
     df_cardiac_in: pd.DataFrame
@@ -28,52 +138,68 @@ class ExperimentResult(object):
     df_vero_mono: pd.DataFrame
     df_inhibition_mono: pd.DataFrame
     df_all_y: pd.DataFrame
+    diagnostics: DesignDiagnostics
 
     # input & output
     df_conc_table: pd.DataFrame
+    plates: PlateArray
+    plate_map: np.ndarray
+    mono_plate_map: np.ndarray
 
-    def __init__(self, file_name):
-        xls = pd.ExcelFile(file_name)
+    def __init__(self, file_name, cache=None):
+        # workbook is parsed once, sheets are sliced in memory
+        xls = open_workbook(file_name)
+
+        # steps go through the stage cache, keyed by the sheets they read and the keys of the steps before them
+        self.cache = cache if cache is not None else StageCache('.stage_cache', enabled=False)
+        self.sheet_digests = {s: xls.get_sheet_digest(s) for s in xls.sheet_names} if self.cache.enabled else {}
+        self.source_digest = get_source_digest(ExperimentResult, PlateArray, DesignDiagnostics)
+        self.stage_keys = {}
 
         # read sheets into separate dataframe
-        self.df_solvent = pd.read_excel(xls, sheet_name='Solvent')
-        self.df_oacd = pd.read_excel(xls, sheet_name='OACD')
-        self.df_mono_X = pd.read_excel(xls, sheet_name='mono_X')
-        self.df_conc_table = pd.read_excel(xls, sheet_name='Conc_table')
-        self.df_efficacy = pd.read_excel(xls, sheet_name='Efficacy')
-        self.df_veroE6 = pd.read_excel(xls, sheet_name='VeroE6')
-        self.df_cardiac_in = pd.read_excel(xls, sheet_name='AC16')
-        self.df_liver_in = pd.read_excel(xls, sheet_name='THLE-2')
-        self.df_mono_eff = pd.read_excel(xls, sheet_name='mono_Eff')
-        self.df_mono_veroe6 = pd.read_excel(xls, sheet_name='mono_VeroE6')
-
-        # special case for sheet 'Controls'
-        for i in range(len(self.df_ctrl)):
-            self.df_ctrl[i] = pd.read_excel(xls, sheet_name='Controls', header=2 + 7 * i).iloc[0:4, 0:13]
-            self.df_ctrl[i] = self.df_ctrl[i].infer_objects()
+        self.df_solvent = xls.parse('Solvent')
+        self.df_oacd = xls.parse('OACD')
+        self.df_mono_X = xls.parse('mono_X')
+        self.df_conc_table = xls.parse('Conc_table')
+        self.df_efficacy = xls.parse('Efficacy')
+        self.df_veroE6 = xls.parse('VeroE6')
+        self.df_cardiac_in = xls.parse('AC16')
+        self.df_liver_in = xls.parse('THLE-2')
+        self.df_mono_eff = xls.parse('mono_Eff')
+        self.df_mono_veroe6 = xls.parse('mono_VeroE6')
+
+        # special case for sheet 'Controls': one block per control set, each starting at a 'Well' header row
+        df_controls = xls.parse('Controls', header=None)
+        self.df_ctrl = [self._get_control_block(xls, df_controls, row)
+                        for row in np.flatnonzero(df_controls.iloc[:, 0].values == 'Well')]
+
+        # optional sheet 'Plate_map': control set (1-based) of every replicate of every combo
+        self.df_plate_map = xls.parse('Plate_map') if 'Plate_map' in xls.sheet_names else None
         pass
 
     # step 1: Check linear dependency of the X-input array
     def check_linear_dependency(self):
         print('Step 1:\n- Generating X-input in real concentration...')
-        self._substitute_real_conc()
+        self._run_stage('real_conc', ['OACD', 'mono_X', 'Conc_table'], [], ['df_x_conc', 'df_mono_conc'],
+                        self._substitute_real_conc)
         print('- Checking linear independency of input array...')
-        self._check_linear_dependency()
+        self._run_stage('diagnostics', [], ['real_conc'], ['diagnostics'], self._check_linear_dependency)
+        self._print_diagnostics()
 
     # step 2: Process raw data
     def process_raw_data(self):
         print('Step 2: Calculate plate controls')
-        for i in range(len(self.df_ctrl)):
-            # step 2
-            avg = self._set_plate_avg(i)
-
+        self._run_stage('controls', ['Controls', 'Plate_map', 'Efficacy', 'OACD', 'mono_X'], [],
+                        ['plates', 'plate_map', 'mono_plate_map'], self._calc_controls)
 
     # step 3: Normalization - calculate %cytotoxicity and %inhibition for relevant cell lines
     def normalize(self):
         print('Step 3: Normalization\n- Calculating %cytotoxicity...')
-        self._calc_cytotoxicity()
+        self._run_stage('cytotoxicity', ['VeroE6', 'AC16', 'THLE-2', 'mono_VeroE6'], ['controls'],
+                        ['df_vero', 'df_cardiac', 'df_liver', 'df_vero_mono'], self._calc_cytotoxicity)
         print('- Calculating %inhibition...')
-        self._calc_inhibition()
+        self._run_stage('inhibition', ['Efficacy', 'mono_Eff'], ['controls'],
+                        ['df_inhibition', 'df_inhibition_mono'], self._calc_inhibition)
 
     # step 4: compiling results in desired format
     # 1) compile all y outputs into 1 tab for qualitative check
@@ -89,10 +215,9 @@ class ExperimentResult(object):
         expanded_combo = pd.concat([combo_x, combo_mono], ignore_index=True)
         self.df_all_y = pd.concat([inhib, vero, self.df_cardiac, self.df_liver], axis=1, sort=False)
         #self.df_all_y = pd.concat([self.df_inhibition, self.df_vero, self.df_cardiac, self.df_liver], axis=1, sort=False)
-        self.df_all_y.columns = ['Inhibit_1', 'Inhibit_2', 'Inhibit_3',
-                                 'Vero_1', 'Vero_2', 'Vero_3',
-                                 'Cardiac_1', 'Cardiac_2', 'Cardiac_3',
-                                 'Liver_1', 'Liver_2','Liver_3']
+        n_rep = self.df_inhibition.shape[1]
+        self.df_all_y.columns = [output + '_' + str(r + 1) for output in ['Inhibit', 'Vero', 'Cardiac', 'Liver']
+                                 for r in range(n_rep)]
         self.df_all_y.insert(0, 'Combo_ID', expanded_combo)
 
         self.df_x_conc.insert(0, 'Combo_ID', combo_x)
@@ -114,7 +239,8 @@ class ExperimentResult(object):
         self.df_all_y['Avg_Cardiac'] = self.df_cardiac['average']
         self.df_all_y['Avg_Liver'] = self.df_liver['average']
 
-    def save_file_excel(self, file_name):
+    # logical result tables, keyed by their sheet name in OACD_result.xlsx
+    def get_tables(self):
         sheet_names = ['X_conc', 'mono_conc', 'All Y-outputs',
                        'Inhibition', 'VeroE6', 'AC16', 'THLE-2',
                        'mono_Inhibition', 'mono_VeroE6',
@@ -127,24 +253,24 @@ class ExperimentResult(object):
                    self.df_conc_table
                    ]
 
-        writer = pd.ExcelWriter(file_name, engine='xlsxwriter')
-        wb = writer.book
-        format1 = wb.add_format({'bg_color': '#fff9ae',
-                                 'font_color': '#9C0006'})
-
-        for i, df in enumerate(df_list):
-            df.to_excel(writer, sheet_name=sheet_names[i], index=False)
-            if sheet_names[i] is 'All Y-outputs':
-                worksheet = writer.sheets[sheet_names[i]]
-                worksheet.conditional_format('O2:Q125', {'type': 'cell',
-                                                         'criteria': 'greater than',
-                                                         'value': 25,
-                                                         'format': format1}
-                                             )
-
-        writer.save()
-        print('...data have been saved.')
-        pass
+        return dict(zip(sheet_names, df_list))
+
+    def save_file_excel(self, file_name):
+        write_result_excel(file_name, self.get_tables())
+
+    # Runs a step through the stage cache. The key hashes the sheets the step reads, the keys of the upstream
+    # steps and the source of the step; on a hit the output attributes are restored instead of recomputed.
+    def _run_stage(self, stage, sheets, upstream, outputs, func):
+        key = self.cache.get_key(stage, *[self.sheet_digests.get(s, '-') for s in sheets],
+                                 *[self.stage_keys[u] for u in upstream], self.source_digest)
+        self.stage_keys[stage] = key
+        for name, value in zip(outputs, self.cache.run(key, lambda: self._get_outputs(func, outputs))):
+            setattr(self, name, value)
+
+    def _get_outputs(self, func, outputs):
+        func()
+
+        return [getattr(self, name) for name in outputs]
 
     def _substitute_real_conc(self):
         self.df_x_conc = self.df_oacd.iloc[:, 1:].copy(deep=True)
@@ -158,116 +284,182 @@ class ExperimentResult(object):
                 self.df_conc_table[drug_name].tolist())
 
     def _check_linear_dependency(self):
-        poly = PolynomialFeatures(2, include_bias=False)
-        mtx = poly.fit_transform(self.df_x_conc)
-        rank = np.linalg.matrix_rank(mtx)
-
-        if mtx.shape[1] != rank:
-            print('...linear dependencies issues')
-        else:
-            print('...linearly independent')
+        self.diagnostics = DesignDiagnostics(self.df_x_conc.values, list(self.df_x_conc.columns))
 
-    def _set_plate_avg(self, plate_id):
-        avg = self.df_ctrl[plate_id].sum(numeric_only=True) / self.df_ctrl[plate_id].count()
-        self.df_ctrl[plate_id] = self.df_ctrl[plate_id].append(avg, ignore_index=True)
-        self.df_ctrl[plate_id].iloc[-1, 0] = 'Avg'
+    def _print_diagnostics(self):
+        summary = self.diagnostics.get_summary()
 
-        self._subtract_blank_ctrl(plate_id)
-
-        return avg
-
-    def _subtract_blank_ctrl(self, plate_id):
-        self.df_ctrl[plate_id]['DMSO Cardiac'] -= self.df_ctrl[plate_id]['Blank Cardiac'].iloc[-1]
-        self.df_ctrl[plate_id]['No DMSO Cardiac'] -= self.df_ctrl[plate_id]['Blank Cardiac'].iloc[-1]
-        self.df_ctrl[plate_id]['DMSO Liver'] -= self.df_ctrl[plate_id]['Blank Liver'].iloc[-1]
-        self.df_ctrl[plate_id]['No DMSO Liver'] -= self.df_ctrl[plate_id]['Blank Cardiac'].iloc[-1]
-        return
-
-
-    def _get_controls(self, col):
-        # C1-50 and 24 monotherapy wells
-        cell_vehicle_123 = [self.df_ctrl[0][col].iloc[-1],
-                            self.df_ctrl[1][col].iloc[-1],
-                            self.df_ctrl[2][col].iloc[-1]]
-        # C51-100
-        cell_vehicle_456 = [self.df_ctrl[3][col].iloc[-1],
-                            self.df_ctrl[4][col].iloc[-1],
-                            self.df_ctrl[5][col].iloc[-1]]
-        # compile
-        control = np.vstack((np.full((50, 3), cell_vehicle_123), np.full((50, 3), cell_vehicle_456)))
-
-        return control
+        if not self.diagnostics.is_full_rank:
+            print('...linear dependencies issues: rank', summary['rank'], 'of', summary['terms'], 'terms, aliased:',
+                  ', '.join(self.diagnostics.get_aliases()['Term']))
+        else:
+            print('...linearly independent, condition number', round(summary['condition'], 1))
+
+    def _get_control_block(self, xls, df_controls, header):
+        # block ends at the first row that is not a 'Well <n>' row, columns end at the first empty header
+        wells = df_controls.iloc[header + 1:, 0].astype(str).str.startswith('Well ').values
+        n_rows = int(np.argmin(np.append(wells, False)))
+        n_cols = int(np.argmin(np.append(df_controls.iloc[header, :].notna().values, False)))
+
+        return xls.parse('Controls', header=header).iloc[0:n_rows, 0:n_cols].infer_objects()
+
+    def _calc_controls(self):
+        self.plates = self._build_plates()
+        self.plate_map, self.mono_plate_map = self._get_plate_map()
+
+    # one plate per control set, holding only the control wells
+    def _build_plates(self):
+        for i, df_ctrl in enumerate(self.df_ctrl):
+            unknown = [col for col in df_ctrl.columns if col not in CONTROL_MAP and col not in CONTROL_LABELS]
+            if unknown:
+                raise KeyError('unknown column(s) ' + ', '.join(map(repr, unknown)) + ' in control set ' +
+                               str(i + 1) + " of sheet 'Controls', expected: " + ', '.join(CONTROL_MAP))
+
+        controls = [{CONTROL_MAP[col]: df_ctrl[col].values.astype(float)
+                     for col in df_ctrl.columns if col in CONTROL_MAP}
+                    for df_ctrl in self.df_ctrl]
+
+        return build_plates(controls, [{}] * len(controls), READOUTS)
+
+    # control set of every (combo, replicate) well, from the 'Plate_map' sheet if there is one
+    def _get_plate_map(self):
+        n_rep = self.df_efficacy.shape[1] - 1
+        if self.df_plate_map is not None:
+            df = get_sheet_plate_map(self.df_plate_map, len(self.df_ctrl))
+            plate_map = df.loc[self.df_oacd.iloc[:, 0]].values.astype(int) - 1
+            mono_plate_map = df.loc[self.df_mono_X.iloc[:, 0]].values.astype(int) - 1
+            return plate_map, mono_plate_map
+
+        return get_default_plate_map(self.df_oacd.shape[0], self.df_mono_X.shape[0], len(self.df_ctrl), n_rep)
+
+    # test wells of every readout: (combos x replicates x readouts), monotherapy has no AC16/THLE-2 plates
+    def _get_test_wells(self):
+        combo = np.stack([df.iloc[:, 1:].values.astype(float) for df in
+                          [self.df_efficacy, self.df_veroE6, self.df_cardiac_in, self.df_liver_in]], axis=2)
+        mono = np.full((self.df_mono_X.shape[0], combo.shape[1], len(READOUTS)), np.nan)
+        mono[:, :, 0] = self.df_mono_eff.iloc[:, 1:].values
+        mono[:, :, 1] = self.df_mono_veroe6.iloc[:, 1:].values
+
+        return combo, mono
 
     def _calc_cytotoxicity(self):
-        # cytotox: Vero E6
-        cell_vehicle_vero = self._get_controls('DMSO Vero')
-        cell_drug_vero = self.df_veroE6.iloc[:, 1:4]
-        self.df_vero = (cell_vehicle_vero - cell_drug_vero) / cell_vehicle_vero * 100
-
-        # cytotox: cardiac cells
-        blank_cardiac = self._get_controls('Blank Cardiac')
-        cell_vehicle_ssc = self._get_controls('DMSO Cardiac')
-        cell_drug_ssc = self.df_cardiac_in.iloc[:, 1:4]
-        cell_drug_ssc -= blank_cardiac
-        self.df_cardiac = (cell_vehicle_ssc - cell_drug_ssc) / cell_vehicle_ssc * 100
-
-        # cytotox: liver cells
-        blank_liver = self._get_controls('Blank Liver')
-        cell_vehicle_liver = self._get_controls('DMSO Liver')
-        cell_drug_liver = self.df_liver_in.iloc[:, 1:4]
-        cell_drug_liver -= blank_liver
-        self.df_liver = (cell_vehicle_liver - cell_drug_liver) / cell_vehicle_liver * 100
-
-        # cytotox: monotherapy
-        # - drug upper bound is the same as C1-50
-        cell_vehicle_vero_123 = [self.df_ctrl[0]['DMSO Vero'].iloc[-1],
-                                 self.df_ctrl[1]['DMSO Vero'].iloc[-1],
-                                 self.df_ctrl[2]['DMSO Vero'].iloc[-1]]
-        cell_drug_vero_mono = self.df_mono_veroe6.iloc[:, 1:4]
-        cell_vehicle_vero_mono = np.full((cell_drug_vero_mono.shape[0], 3), cell_vehicle_vero_123)
-        self.df_vero_mono = (cell_vehicle_vero_mono - cell_drug_vero_mono) / cell_vehicle_vero_mono * 100
+        # cytotox: Vero E6, cardiac and liver cells, control baselines gathered through the plate map
+        # - blank wells are subtracted from drug and vehicle wells where the plate has them
+        combo, mono = self._get_test_wells()
+        cytotox = self.plates.calc_cytotoxicity(values=combo, plate_map=self.plate_map)
+        cytotox_mono = self.plates.calc_cytotoxicity(values=mono, plate_map=self.mono_plate_map)
+
+        self.df_vero = pd.DataFrame(cytotox[:, :, 1], columns=self.df_veroE6.columns[1:])
+        self.df_cardiac = pd.DataFrame(cytotox[:, :, 2], columns=self.df_cardiac_in.columns[1:])
+        self.df_liver = pd.DataFrame(cytotox[:, :, 3], columns=self.df_liver_in.columns[1:])
+        self.df_vero_mono = pd.DataFrame(cytotox_mono[:, :, 1], columns=self.df_mono_veroe6.columns[1:])
 
     def _calc_inhibition(self):
-        # inhibition: C1-100 (X-array)
-        cell_drug_virus = self.df_efficacy.iloc[:, 1:4]
-        cell_virus = self._get_controls('DMSO Eff')
-        cell_vehicle = self._get_controls('Cells Eff')
-        self.df_inhibition = (cell_drug_virus - cell_virus) / (cell_vehicle - cell_virus) * 100
-
-        # inhibition: monotherapy
-        cell_drug_virus = self.df_mono_eff.iloc[:, 1:4]
-        # - lower bound: minimum inhibition
-        cell_virus_123 = [self.df_ctrl[0]['DMSO Eff'].iloc[-1],
-                          self.df_ctrl[1]['DMSO Eff'].iloc[-1],
-                          self.df_ctrl[2]['DMSO Eff'].iloc[-1]]
-        cell_virus = np.full((cell_drug_virus.shape[0], 3), cell_virus_123)
-        # - upper bound: maximum inhibition
-        cell_eff_123 = [self.df_ctrl[0]['Cells Eff'].iloc[-1],
-                        self.df_ctrl[1]['Cells Eff'].iloc[-1],
-                        self.df_ctrl[2]['Cells Eff'].iloc[-1]]
-        cell_vehicle = np.full((cell_drug_virus.shape[0], 3), cell_eff_123)
-        self.df_inhibition_mono = (cell_drug_virus - cell_virus) / (cell_vehicle - cell_virus) * 100
+        # inhibition: lower bound DMSO (infected) wells, upper bound uninfected cells
+        combo, mono = self._get_test_wells()
+        inhibition = self.plates.calc_inhibition(values=combo, plate_map=self.plate_map)
+        inhibition_mono = self.plates.calc_inhibition(values=mono, plate_map=self.mono_plate_map)
+
+        self.df_inhibition = pd.DataFrame(inhibition[:, :, 0], columns=self.df_efficacy.columns[1:])
+        self.df_inhibition_mono = pd.DataFrame(inhibition_mono[:, :, 0], columns=self.df_mono_eff.columns[1:])
 
     def _average_stdev(self, df, combo):
-        df['average'] = df.iloc[:, 0:3].sum(axis=1) / df.count(axis=1)
-        df['stdev'] = df.iloc[:, 0:3].std(axis=1)
+        n_rep = df.shape[1]
+        df['average'] = df.iloc[:, 0:n_rep].sum(axis=1) / df.iloc[:, 0:n_rep].count(axis=1)
+        df['stdev'] = df.iloc[:, 0:n_rep].std(axis=1)
         df.insert(0, 'Combo_ID', combo)
 
         return df
 
 
-if __name__ == '__main__':
-    file_input = 'OACD.xlsx'
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='OACD normalization, quadratic regression and ranking.')
+    parser.add_argument('input', nargs='?', default='OACD.xlsx', help='input workbook, default: OACD.xlsx')
+    add_profile_argument(parser, 'oacd')
+    add_cache_arguments(parser)
+    add_store_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    file_input = args.input
     file_output = 'OACD_result.xlsx'
+    folder_store = './results/oacd'
+    file_regr = 'regr_final.xlsx'
+    file_subsets = './regression/OACD_subsets.xlsx'
+    file_bootstrap = './regression/OACD_bootstrap.xlsx'
+    folder_interaction = './regression/interaction_graphs'
+    folder_index = './regression/score_index'
+
+    profiler = get_profiler('oacd', argv)
+    cache = get_stage_cache(argv=argv)
 
     # read in data file
-    res = ExperimentResult(file_input)
+    with profiler.stage('read_input'):
+        res = ExperimentResult(file_input, cache)
 
     # step 1 - 3: output %cytotoxicity and %inhibition
-    res.check_linear_dependency()
-    res.process_raw_data()
-    res.normalize()
+    with profiler.stage('check_linear_dependency') as record:
+        res.check_linear_dependency()
+        record['rows'] = res.df_x_conc.shape[0]
+    with profiler.stage('process_raw_data') as record:
+        res.process_raw_data()
+        record['rows'] = len(res.df_ctrl)
+    with profiler.stage('normalize') as record:
+        res.normalize()
+        record['rows'] = res.df_inhibition.shape[0] + res.df_inhibition_mono.shape[0]
+
+    # # step 4: compile outputs into the result store and/or the excel file --> input to MATLAB regression
+    with profiler.stage('beautify_result') as record:
+        res.beautify_result()
+        record['rows'] = res.df_all_y.shape[0]
+    with profiler.stage('save_results') as record:
+        store = open_result_store(folder_store, args.store)
+        save_tables(store, file_output, res.get_tables(), write_result_excel, args.excel)
+        record['rows'] = sum(df.shape[0] for df in res.get_tables().values())
+
+    # step 5: second-order polynomial regression on all 4 y-outputs (replaces OACD_part1.mlx)
+    print('Step 5: Quadratic regression...')
+    with profiler.stage('regression') as record:
+        regression_key = cache.get_key('regression', res.stage_keys['real_conc'], res.stage_keys['cytotoxicity'],
+                                       res.stage_keys['inhibition'], get_source_digest(QuadraticRegression))
+        model = cache.run(regression_key, lambda: QuadraticRegression(
+            pd.concat([res.df_x_conc, res.df_mono_conc], ignore_index=True), res.df_all_y).fit())
+        print('- R-squared:', dict(zip(model.output_names, np.round(model.r2, 3))))
+        model.save_file_excel(file_regr)
+        record['rows'] = model.x.shape[0]
+
+    # step 6: rank top 4/3/2-drug combinations over the full dose grid (replaces OACD_part2.mlx subsets)
+    print('Step 6: Ranking drug-dose combinations...')
+    with profiler.stage('ranking') as record:
+        ranking_key = cache.get_key('ranking', regression_key, res.stage_keys['real_conc'],
+                                    get_source_digest(ComboRanker))
+        ranker = cache.run(ranking_key, lambda: ComboRanker(model, res.df_conc_table).rank())
+        ranker.save_file_excel(file_subsets)
+        record['rows'] = ranker.n_scored
+    with profiler.stage('score_index', rows=ranker.n_grid):
+        build_score_index(ranker, folder_index)
+
+    # step 7: bootstrap the replicates to get CI bands and rank stability of the ranked combinations
+    print('Step 7: Bootstrapping ranked combinations...')
+    with profiler.stage('bootstrap') as record:
+        boot = BootstrapRanking(model, ranker)
+        boot.run()
+        boot.save_file_excel(file_bootstrap)
+        record['rows'] = boot.n_boot
+
+    # step 8: drug-drug interaction surfaces of every pair and output, only changed figures are re-rendered
+    print('Step 8: Rendering drug-drug interaction graphs...')
+    with profiler.stage('interaction_graphs') as record:
+        jobs = get_interaction_jobs(model, res.df_conc_table, folder_interaction)
+        render_all(jobs)
+        record['rows'] = len(jobs)
+
+    print(cache.get_summary())
+    profiler.save()
+
 
-    # # step 4: compile outputs and save out to excel file --> input to MATLAB regression
-    res.beautify_result()
-    res.save_file_excel(file_output)
+if __name__ == '__main__':
+    main()
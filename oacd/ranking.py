@@ -0,0 +1,258 @@
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import RawArray
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# column headers of OACD_subsets.xlsx, one per fitted y-output
+PRED_COLUMNS = ['% Vero E6 Inhibition', '% Vero E6 Cytotoxicity', '% AC16 Cytotoxicity', '% THLE-2 Cytotoxicity']
+
+
+def get_dose_levels(df_conc_table, drug_names):
+    return [df_conc_table[drug_name].dropna().values.astype(float) for drug_name in drug_names]
+
+
+# decode flat grid indices into per-drug dose levels (mixed radix, last drug varies fastest like allcomb.m)
+def decode_index(index, n_levels):
+    digits = np.empty((len(index), len(n_levels)), dtype=np.int64)
+    rest = np.asarray(index, dtype=np.int64)
+    for i in range(len(n_levels) - 1, -1, -1):
+        digits[:, i] = rest % n_levels[i]
+        rest = rest // n_levels[i]
+
+    return digits
+
+
+def encode_index(digits, n_levels):
+    index = np.zeros(digits.shape[0], dtype=np.int64)
+    for i in range(len(n_levels)):
+        index = index * n_levels[i] + digits[:, i]
+
+    return index
+
+
+def score_block(conc, intercept, linear, quadratic):
+    # y = b0 + x.b + x'Qx for all outputs at once, only the raw doses are held in memory
+    n_drugs, _, n_out = quadratic.shape
+    xq = (conc @ quadratic.reshape(n_drugs, -1)).reshape(conc.shape[0], n_drugs, n_out)
+
+    return intercept + conc @ linear + np.einsum('cj,cjk->ck', conc, xq)
+
+
+# objective-weighted terms retained by a sparse model: offset, linear (drug, coef), quadratic (drug, drug, coef)
+def get_sparse_terms(intercept, linear, quadratic, objective):
+    lin = linear @ objective
+    quad = quadratic @ objective
+    rows, cols = np.nonzero(quad)
+
+    return float(intercept @ objective), np.flatnonzero(lin), lin[lin != 0], rows, cols, quad[rows, cols]
+
+
+def score_terms(conc, terms):
+    offset, lin_index, lin, rows, cols, quad = terms
+
+    return offset + conc[:, lin_index] @ lin + (conc[:, rows] * conc[:, cols]) @ quad
+
+
+def push_topk(heap, scores, index, k):
+    # pre-select in NumPy so the heap only sees at most k candidates per block
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        scores, index = scores[keep], index[keep]
+
+    for s, i in zip(scores.tolist(), index.tolist()):
+        item = (s, -i)  # ties go to the lower grid index
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+
+def merge_topk(parts, k):
+    merged = {}
+    for heaps in parts:
+        for size, heap in heaps.items():
+            merged[size] = heapq.nlargest(k, merged.get(size, []) + heap)
+
+    for heap in merged.values():
+        heapq.heapify(heap)
+
+    return merged
+
+
+# worker-side ranker, built once per process from the shared coefficient buffer
+_shared_ranker = None
+
+
+def _init_worker(buffer, shapes, state):
+    global _shared_ranker
+    flat = np.frombuffer(buffer, dtype=np.float64)
+
+    arrays = []
+    offset = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        arrays.append(flat[offset:offset + size].reshape(shape))
+        offset += size
+
+    _shared_ranker = ComboRanker.__new__(ComboRanker)
+    _shared_ranker.__dict__.update(state)
+    _shared_ranker.intercept, _shared_ranker.linear, _shared_ranker.quadratic = arrays
+
+
+def _rank_shard(start, stop):
+    return _shared_ranker.rank_range(start, stop)
+
+
+class ComboRanker(object):
+    # input
+    drug_names: list
+    levels: list
+    n_levels: np.ndarray
+    intercept: np.ndarray
+    linear: np.ndarray
+    quadratic: np.ndarray
+    objective: np.ndarray
+    terms: tuple
+
+    # output
+    heaps: dict
+    n_scored: int
+
+    def __init__(self, model, df_conc_table, objective=None, sizes=(4, 3, 2), top_k=100, chunk_size=2 ** 16):
+        self.drug_names = list(model.drug_names)
+        self.levels = get_dose_levels(df_conc_table, self.drug_names)
+        self.n_levels = np.array([len(lv) for lv in self.levels], dtype=np.int64)
+        self.intercept, self.linear, self.quadratic = model.get_quadratic_form()
+
+        # objective: weights over the y-outputs, default ranks by %inhibition as in OACD_part2.mlx
+        n_out = len(self.intercept)
+        self.objective = np.eye(n_out)[0] if objective is None else np.asarray(objective, dtype=float)
+        self.terms = self._get_sparse_terms()
+
+        self.sizes = tuple(sizes)
+        self.top_k = top_k
+        self.chunk_size = chunk_size
+        self.heaps = {}
+        self.n_scored = 0
+
+    # reload the coefficients after the model was updated with add_rows / remove_wells, then rank again
+    def set_model(self, model):
+        self.intercept, self.linear, self.quadratic = model.get_quadratic_form()
+        self.terms = self._get_sparse_terms()
+        self.heaps = {}
+
+        return self
+
+    @property
+    def n_grid(self):
+        return int(np.prod(self.n_levels.astype(object)))
+
+    def rank(self):
+        self.heaps = self.rank_range(0, self.n_grid)
+        self.n_scored = self.n_grid
+
+        return self
+
+    # shard the grid by leading-drug prefix across a process pool, each worker returns its partial top-K
+    def rank_parallel(self, max_workers=None):
+        max_workers = max_workers or os.cpu_count() or 1
+        shards = self._get_shards(4 * max_workers)
+
+        # coefficients go through shared memory once per worker instead of being pickled per task
+        coefs = [self.intercept, self.linear, self.quadratic]
+        buffer = RawArray('d', int(sum(c.size for c in coefs)))
+        np.frombuffer(buffer, dtype=np.float64)[:] = np.concatenate([c.ravel() for c in coefs])
+        state = {key: value for key, value in self.__dict__.items()
+                 if key not in ('intercept', 'linear', 'quadratic', 'heaps')}
+
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(buffer, [c.shape for c in coefs], state)) as pool:
+            futures = [pool.submit(_rank_shard, start, stop) for start, stop in shards]
+            self.heaps = merge_topk((f.result() for f in futures), self.top_k)
+
+        self.n_scored = sum(stop - start for start, stop in shards)
+
+        return self
+
+    def rank_range(self, start, stop):
+        heaps = {size: [] for size in self.sizes}
+        for lo in range(start, stop, self.chunk_size):
+            index = np.arange(lo, min(lo + self.chunk_size, stop), dtype=np.int64)
+            digits = decode_index(index, self.n_levels)
+
+            # only rows with the wanted number of drugs are scored
+            n_drugs = np.count_nonzero(self._to_conc(digits), axis=1)
+            wanted = np.isin(n_drugs, self.sizes)
+            if not wanted.any():
+                continue
+            index, digits, n_drugs = index[wanted], digits[wanted], n_drugs[wanted]
+
+            scores = self._score(self._to_conc(digits))
+            for size in self.sizes:
+                mask = n_drugs == size
+                push_topk(heaps[size], scores[mask], index[mask], self.top_k)
+
+        return heaps
+
+    def get_subsets(self):
+        subsets = {}
+        for size in self.sizes:
+            ranked = sorted(self.heaps[size], reverse=True)
+            index = np.array([-i for _, i in ranked], dtype=np.int64)
+            conc = self._to_conc(decode_index(index, self.n_levels))
+            pred = score_block(conc, self.intercept, self.linear, self.quadratic)
+
+            df = pd.DataFrame(conc, columns=self.drug_names)
+            for c, col in enumerate(PRED_COLUMNS[:pred.shape[1]]):
+                df[col] = pred[:, c]
+            subsets[str(size) + '-drug'] = df
+
+        return subsets
+
+    def save_file_excel(self, file_name):
+        Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+        writer = pd.ExcelWriter(file_name, engine='xlsxwriter')
+        for sheet_name, df in self.get_subsets().items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+        writer.save()
+        print('...ranked subsets have been saved.')
+
+    def _get_shards(self, n_min):
+        n_prefix = 1
+        while n_prefix < len(self.n_levels) and np.prod(self.n_levels[:n_prefix]) < n_min:
+            n_prefix += 1
+
+        stride = int(np.prod(self.n_levels[n_prefix:].astype(object)))
+        prefixes = decode_index(np.arange(np.prod(self.n_levels[:n_prefix])), self.n_levels[:n_prefix])
+
+        # a prefix that already holds more drugs than the largest subset cannot contribute
+        n_drugs = np.count_nonzero(self._to_conc(prefixes), axis=1)
+        keep = np.flatnonzero(n_drugs <= max(self.sizes))
+
+        return [(int(j) * stride, (int(j) + 1) * stride) for j in keep]
+
+    # digits may cover only the leading drugs (grid prefixes)
+    def _to_conc(self, digits):
+        conc = np.empty(digits.shape, dtype=float)
+        for i in range(digits.shape[1]):
+            conc[:, i] = self.levels[i][digits[:, i]]
+
+        return conc
+
+    # models with few retained quadratic terms (SparseQuadraticRegression) are scored term by term
+    def _get_sparse_terms(self):
+        terms = get_sparse_terms(self.intercept, self.linear, self.quadratic, self.objective)
+        n_drugs = len(self.drug_names)
+
+        return terms if len(terms[5]) <= n_drugs * (n_drugs + 1) // 4 else None
+
+    def _score(self, conc):
+        if self.terms is not None:
+            return score_terms(conc, self.terms)
+
+        return score_block(conc, self.intercept, self.linear, self.quadratic) @ self.objective
@@ -0,0 +1,380 @@
+import numpy as np
+import pandas as pd
+from scipy.linalg import solve_triangular
+from sklearn.preprocessing import PolynomialFeatures
+
+# y-outputs fitted by IDentif.AI, in the column order of the 'All Y-outputs' tab
+OUTPUTS = ['Inhibit', 'Vero', 'Cardiac', 'Liver']
+
+
+def build_design(x):
+    # same degree-2 expansion as ExperimentResult._check_linear_dependency, plus the intercept column
+    poly = PolynomialFeatures(2, include_bias=True)
+    mtx = poly.fit_transform(np.asarray(x, dtype=float))
+
+    return mtx, poly.powers_
+
+
+def term_names(drug_names, powers):
+    names = []
+    for row in powers:
+        idx = np.flatnonzero(row)
+        if len(idx) == 0:
+            names.append('(Intercept)')
+        elif len(idx) == 2:
+            names.append(drug_names[idx[0]] + ':' + drug_names[idx[1]])
+        elif row[idx[0]] == 2:
+            names.append(drug_names[idx[0]] + '^2')
+        else:
+            names.append(drug_names[idx[0]])
+
+    return names
+
+
+# rank-one downdate of an upper-triangular factor, T'T - uu' (LINPACK dchdd)
+def cholesky_downdate(t, u):
+    t, u = t.copy(), u.astype(float).copy()
+    for k in range(t.shape[0]):
+        r2 = t[k, k] ** 2 - u[k] ** 2
+        if r2 <= (1e-12 * t[k, k]) ** 2:
+            raise np.linalg.LinAlgError('downdate makes the factor indefinite')
+        r = np.sqrt(r2)
+        c, s = r / t[k, k], u[k] / t[k, k]
+        t[k, k] = r
+        t[k, k + 1:] = (t[k, k + 1:] - s * u[k + 1:]) / c
+        u[k + 1:] = c * u[k + 1:] - s * t[k, k + 1:]
+
+    return t
+
+
+# rank-k update of an upper-triangular factor with new rows, T'T + U'U
+def qr_update(t, rows):
+    r = np.linalg.qr(np.vstack([t, rows]), mode='r')
+    out = np.zeros((t.shape[1], t.shape[1]))
+    out[0:min(r.shape[0], t.shape[1]), :] = r[0:t.shape[1], :]
+
+    return out
+
+
+
+def soft_threshold(x, t):
+    return np.sign(x) * np.maximum(np.abs(x) - t, 0)
+
+
+# Coordinate descent for min 1/2 b'Gb - c'b + sum_j penalty_j |b_j| on a cached Gram matrix, warm started
+# from coef. Sweeps only the nonzero terms until they settle, then one full sweep to check the others;
+# converged when no update changes the quadratic loss by more than tol times the null loss 1/2 yy.
+def lasso_gram(gram, cov, penalty, coef, yy, tol=1e-6, max_iter=1000):
+    coef = coef.copy()
+    diag = np.diag(gram)
+    grad = cov - gram @ coef
+    scale = tol * max(yy, 1e-300)
+
+    def sweep(terms):
+        delta = 0.0
+        for j in terms:
+            new = soft_threshold(grad[j] + diag[j] * coef[j], penalty[j]) / diag[j]
+            if new != coef[j]:
+                grad[:] -= gram[:, j] * (new - coef[j])
+                delta = max(delta, diag[j] * (new - coef[j]) ** 2)
+                coef[j] = new
+        return delta
+
+    usable = np.flatnonzero(diag > 0)
+    for _ in range(max_iter):
+        if sweep(usable) <= scale:
+            break
+        for _ in range(max_iter):
+            if sweep(usable[coef[usable] != 0]) <= scale:
+                break
+
+    return coef
+
+
+def get_replicates(df_all_y, output, n_rows):
+    cols = [col for col in df_all_y.columns if col.startswith(output + '_')]
+
+    return df_all_y[cols].iloc[0:n_rows, :].values.astype(float)
+
+
+class QuadraticRegression(object):
+    # input
+    drug_names: list
+    output_names: list
+    x: np.ndarray
+    y_rep: np.ndarray
+
+    # output
+    design: np.ndarray
+    powers: np.ndarray
+    terms: list
+    coef: np.ndarray
+    weights: np.ndarray
+    # per output: upper-triangular factor T of the weighted [design | y] system, T'T = [X y]'W[X y]
+    factors: dict
+    r2: np.ndarray
+
+    def __init__(self, df_x_conc, df_all_y, outputs=OUTPUTS):
+        x = df_x_conc.drop(columns=['Combo_ID'], errors='ignore')
+        self.drug_names = list(x.columns)
+        self.output_names = list(outputs)
+        self.x = x.values.astype(float)
+
+        # (combos x replicates x outputs), one slab per y-output
+        n_rows = self.x.shape[0]
+        self.y_rep = np.stack([get_replicates(df_all_y, out, n_rows) for out in self.output_names], axis=2)
+
+    # Each replicate is a separate point with NaN read-outs dropped (expand_replicates in OACD_part1.mlx).
+    # Stacked least squares equals least squares on the replicate means weighted by the replicate count,
+    # so every output with the same count pattern shares one QR factorization of the weighted design.
+    def fit(self):
+        self.design, self.powers = build_design(self.x)
+        self.terms = term_names(self.drug_names, self.powers)
+
+        counts = np.sum(~np.isnan(self.y_rep), axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            y_mean = np.nansum(self.y_rep, axis=1) / counts
+        y_mean[counts == 0] = 0
+        self.weights = counts.astype(float)
+
+        n_terms = self.design.shape[1]
+        self.coef = np.zeros((n_terms, len(self.output_names)))
+        self.factors = {}
+
+        # spread of the replicates around their mean, part of the residual of the stacked system
+        within = np.nansum((self.y_rep - y_mean[:, None, :]) ** 2, axis=(0, 1))
+
+        patterns, group = np.unique(counts, axis=1, return_inverse=True)
+        for g in range(patterns.shape[1]):
+            cols = np.flatnonzero(np.ravel(group) == g)
+            sqrt_w = np.sqrt(patterns[:, g].astype(float))[:, None]
+            q, r = np.linalg.qr(sqrt_w * self.design)
+
+            if np.min(np.abs(np.diag(r))) <= 1e-10 * np.max(np.abs(np.diag(r))):
+                print('...linear dependencies issues in weighted design, falling back to minimum-norm solution')
+
+            y_w = sqrt_w * y_mean[:, cols]
+            z = q.T @ y_w
+            rho = np.sqrt(np.maximum(np.sum(y_w ** 2, axis=0) - np.sum(z ** 2, axis=0) + within[cols], 0))
+            for i, c in enumerate(cols):
+                t = np.zeros((n_terms + 1, n_terms + 1))
+                t[0:r.shape[0], 0:n_terms] = r
+                t[0:r.shape[0], n_terms] = z[:, i]
+                t[n_terms, n_terms] = rho[i]
+                self.factors[self.output_names[c]] = t
+
+        self._solve()
+
+        return self
+
+    # Append OACD combinations: every non-NaN replicate is one more row of the stacked system, folded into
+    # each output's factor with one rank-k QR update instead of a refit.
+    def add_rows(self, df_x_conc, df_all_y):
+        x = df_x_conc.drop(columns=['Combo_ID'], errors='ignore')[self.drug_names].values.astype(float)
+        y_rep = np.stack([get_replicates(df_all_y, out, x.shape[0]) for out in self.output_names], axis=2)
+        mtx, _ = build_design(x)
+
+        for c, out in enumerate(self.output_names):
+            rows, reps = np.nonzero(~np.isnan(y_rep[:, :, c]))
+            if len(rows) > 0:
+                update = np.hstack([mtx[rows], y_rep[rows, reps, c][:, None]])
+                self.factors[out] = qr_update(self.factors[out], update)
+
+        self.x = np.vstack([self.x, x])
+        self.y_rep = np.concatenate([self.y_rep, y_rep], axis=0)
+        self.design = np.vstack([self.design, mtx])
+        self.weights = np.sum(~np.isnan(self.y_rep), axis=1).astype(float)
+        self._solve()
+
+        return self
+
+    # Drop outlier wells (row, replicate) from the fit of one output, or of all outputs, with rank-one
+    # downdates. If a downdate is not numerically safe the output is refitted from the remaining wells.
+    def remove_wells(self, rows, reps, output=None):
+        outputs = self.output_names if output is None else [output]
+        for out in outputs:
+            c = self.output_names.index(out)
+            t = self.factors[out]
+            try:
+                for row, rep in zip(rows, reps):
+                    if not np.isnan(self.y_rep[row, rep, c]):
+                        t = cholesky_downdate(t, np.append(self.design[row], self.y_rep[row, rep, c]))
+                self.factors[out] = t
+                refit = False
+            except np.linalg.LinAlgError:
+                refit = True
+
+            self.y_rep[np.asarray(rows), np.asarray(reps), c] = np.nan
+            if refit:
+                self.factors[out] = self._factorize(c)
+
+        self.weights = np.sum(~np.isnan(self.y_rep), axis=1).astype(float)
+        self._solve()
+
+        return self
+
+    def predict(self, x):
+        mtx, _ = build_design(np.atleast_2d(x))
+
+        return mtx @ self.coef
+
+    # split the coefficient vector into intercept, linear and upper-triangular quadratic parts for fast scoring
+    def get_quadratic_form(self):
+        n_drugs = len(self.drug_names)
+        n_out = len(self.output_names)
+        intercept = np.zeros(n_out)
+        linear = np.zeros((n_drugs, n_out))
+        quadratic = np.zeros((n_drugs, n_drugs, n_out))
+
+        for k, row in enumerate(self.powers):
+            idx = np.flatnonzero(row)
+            if len(idx) == 0:
+                intercept = self.coef[k, :]
+            elif len(idx) == 2:
+                quadratic[idx[0], idx[1], :] = self.coef[k, :]
+            elif row[idx[0]] == 2:
+                quadratic[idx[0], idx[0], :] = self.coef[k, :]
+            else:
+                linear[idx[0], :] = self.coef[k, :]
+
+        return intercept, linear, quadratic
+
+    def get_coefficients(self):
+        df = pd.DataFrame(self.coef, columns=self.output_names)
+        df.insert(0, 'Term', self.terms)
+
+        return df
+
+    def save_file_excel(self, file_name):
+        df_r2 = pd.DataFrame([self.r2], columns=self.output_names)
+
+        writer = pd.ExcelWriter(file_name, engine='xlsxwriter')
+        self.get_coefficients().to_excel(writer, sheet_name='Coefficients', index=False)
+        df_r2.to_excel(writer, sheet_name='R-squared', index=False)
+        writer.save()
+        print('...regression model has been saved.')
+
+    def _factorize(self, c):
+        rows, reps = np.nonzero(~np.isnan(self.y_rep[:, :, c]))
+        stacked = np.hstack([self.design[rows], self.y_rep[rows, reps, c][:, None]])
+
+        return qr_update(np.zeros((0, stacked.shape[1])), stacked)
+
+    # coefficients from each factor: triangular solve, or the minimum-norm solution when the design is
+    # rank deficient (same solution as least squares on the full stacked design)
+    def _solve(self):
+        n_terms = self.design.shape[1]
+        for c, out in enumerate(self.output_names):
+            r = self.factors[out][0:n_terms, 0:n_terms]
+            z = self.factors[out][0:n_terms, n_terms]
+            diag = np.abs(np.diag(r))
+            if np.min(diag) > 1e-10 * np.max(diag):
+                self.coef[:, c] = solve_triangular(r, z)
+            else:
+                self.coef[:, c] = np.linalg.lstsq(r, z, rcond=None)[0]
+
+        self.r2 = self._calc_r2()
+
+    def _calc_r2(self):
+        fitted = self.design @ self.coef
+        r2 = np.zeros(len(self.output_names))
+
+        for c in range(len(self.output_names)):
+            y = self.y_rep[:, :, c]
+            mask = ~np.isnan(y)
+            resid = (y - fitted[:, c][:, None])[mask]
+            total = y[mask] - y[mask].mean()
+            r2[c] = 1 - np.sum(resid ** 2) / np.sum(total ** 2)
+
+        return r2
+
+
+# Term selection over the quadratic design for panels where the full expansion outgrows the OACD runs.
+# Each output's Gram matrix [X y]'W[X y] comes from its cached factor (T'T), so refits after add_rows /
+# remove_wells reuse it. A LASSO path on the centered, scaled terms is solved by warm-started coordinate
+# descent, the path point with the lowest BIC is kept and, with refit, its terms are refitted by least squares.
+# The path stops once the BIC has not improved for `patience` points, before the slow nearly collinear end.
+class SparseQuadraticRegression(QuadraticRegression):
+    # output
+    support: np.ndarray
+    alpha: np.ndarray
+
+    def __init__(self, df_x_conc, df_all_y, outputs=OUTPUTS, n_alphas=50, eps=1e-3, refit=True, patience=5):
+        super().__init__(df_x_conc, df_all_y, outputs)
+        self.n_alphas = n_alphas
+        self.eps = eps
+        self.refit = refit
+        self.patience = patience
+
+    def _solve(self):
+        n_terms = self.design.shape[1]
+        self.support = np.zeros((n_terms, len(self.output_names)), dtype=bool)
+        self.alpha = np.zeros(len(self.output_names))
+
+        for c, out in enumerate(self.output_names):
+            # an output without measured wells gets no model, like the all-zero least-squares solution
+            if not np.any(self.weights[:, c]):
+                print('...no measured wells for output ' + out + ', coefficients set to 0')
+                self.coef[:, c], self.alpha[c] = 0, np.nan
+                continue
+
+            t = self.factors[out]
+            self.coef[:, c], self.support[:, c], self.alpha[c] = self._select(t.T @ t, self.weights[:, c])
+
+        self.r2 = self._calc_r2()
+
+    def _select(self, gram_xy, weights):
+        p = gram_xy.shape[0] - 1
+        n = gram_xy[0, 0]  # intercept column: sum of the weights = number of wells
+        mean = gram_xy[0, :] / n
+
+        # centered Gram of the terms (intercept left out) and their covariance with y
+        centered = gram_xy[1:, 1:] - n * np.outer(mean[1:], mean[1:])
+        yy = centered[-1, -1]
+
+        # terms that are constant over the measured wells (variance lost to rounding) are never selected
+        variance = np.diag(centered)[:-1]
+        keep = np.flatnonzero(variance > 1e-10 * np.diag(gram_xy)[1:-1])
+        gram, cov = centered[np.ix_(keep, keep)], centered[keep, -1]
+        scale = np.sqrt(variance[keep] / n)
+        full = np.zeros(p)
+        if len(keep) == 0:  # intercept-only model
+            full[0] = mean[-1]
+            return full, np.arange(p) == 0, np.nan
+
+        # a model cannot use more terms than distinct measured combinations
+        max_terms = np.count_nonzero(weights) - 1
+        alpha_max = np.max(np.abs(cov) / scale) / n
+
+        best, best_bic, best_alpha, n_worse = np.zeros(len(keep)), np.inf, alpha_max, 0
+        coef = np.zeros(len(keep))
+        for alpha in alpha_max * np.logspace(0, np.log10(self.eps), self.n_alphas):
+            coef = lasso_gram(gram, cov, n * alpha * scale, coef, yy)
+            active = np.flatnonzero(coef)
+            if len(active) >= max_terms:
+                break
+
+            fitted = self._refit(gram, cov, active) if self.refit else coef
+            rss = max(yy - 2 * fitted @ cov + fitted @ gram @ fitted, 1e-300)
+            bic = n * np.log(rss / n) + (len(active) + 1) * np.log(n)
+            if bic < best_bic:
+                best, best_bic, best_alpha, n_worse = fitted, bic, alpha, 0
+            else:
+                n_worse += 1
+                if n_worse == self.patience:
+                    break
+
+        full[keep + 1] = best
+        full[0] = mean[-1] - mean[1:-1] @ full[1:]
+        support = full != 0
+        support[0] = True
+
+        return full, support, best_alpha
+
+    @staticmethod
+    def _refit(gram, cov, active):
+        coef = np.zeros(gram.shape[0])
+        if len(active) > 0:
+            coef[active] = np.linalg.lstsq(gram[np.ix_(active, active)], cov[active], rcond=None)[0]
+
+        return coef
@@ -0,0 +1,146 @@
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ranking import PRED_COLUMNS, decode_index, score_block
+from search import combined_objective
+
+META = 'meta.json'
+
+
+def get_coef_digest(intercept, linear, quadratic):
+    coefs = np.concatenate([np.ravel(intercept), np.ravel(linear), np.ravel(quadratic)])
+
+    return hashlib.sha256(coefs.astype(np.float64).tobytes()).hexdigest()[:16]
+
+
+def default_objectives(n_out):
+    return {'Inhibit': np.eye(n_out)[0], 'Combined': combined_objective()[:n_out]}
+
+
+# Predicted outputs of every row of the dose grid, stored as memory-mapped .npy files in a folder:
+#   outputs.npy (rows x outputs, float32), n_drugs.npy (rows, uint8) and per objective order_<name>.npy,
+#   the grid indices sorted by descending score (ties by lower index). The row of a combination is its
+#   mixed-radix grid index (encode_index), so no keys are stored.
+class ScoreIndex(object):
+    folder: Path
+    meta: dict
+    outputs: np.ndarray
+    n_drugs: np.ndarray
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.meta = json.loads((self.folder / META).read_text())
+        self.drug_names = self.meta['drug_names']
+        self.levels = [np.array(lv) for lv in self.meta['levels']]
+        self.n_levels = np.array([len(lv) for lv in self.levels], dtype=np.int64)
+        self.outputs = np.load(str(self.folder / 'outputs.npy'), mmap_mode='r')
+        self.n_drugs = np.load(str(self.folder / 'n_drugs.npy'), mmap_mode='r')
+        self._orders = {}
+
+    @property
+    def objectives(self):
+        return {name: np.array(w) for name, w in self.meta['objectives'].items()}
+
+    def matches(self, model):
+        return self.meta['coef_digest'] == get_coef_digest(*model.get_quadratic_form())
+
+    def get_order(self, objective):
+        if objective not in self._orders:
+            self._orders[objective] = np.load(str(self.folder / ('order_' + objective + '.npy')), mmap_mode='r')
+
+        return self._orders[objective]
+
+    def add_objective(self, name, weights):
+        weights = np.asarray(weights, dtype=float)
+        score = self.outputs @ weights.astype(np.float32)
+        order = np.argsort(-score, kind='stable')
+        order = order.astype(np.int32 if order.size < 2 ** 31 else np.int64)
+        np.save(str(self.folder / ('order_' + name + '.npy')), order)
+
+        self.meta['objectives'][name] = weights.tolist()
+        (self.folder / META).write_text(json.dumps(self.meta, indent=1))
+        self._orders.pop(name, None)
+
+        return self
+
+    # Best top_k rows of an objective that satisfy the constraints, found by walking its sorted order.
+    #   sizes: allowed numbers of drugs, exclude: drugs held at zero dose,
+    #   bounds: {drug: (min_dose, max_dose)} in Conc_table concentrations
+    def query(self, objective='Inhibit', top_k=10, sizes=None, exclude=(), bounds=None, chunk_size=2 ** 14):
+        order = self.get_order(objective)
+        weights = self.objectives[objective]
+
+        # per drug: allowed dose levels
+        allowed = [np.ones(n, dtype=bool) for n in self.n_levels]
+        for drug_name in exclude:
+            i = self.drug_names.index(drug_name)
+            allowed[i] = self.levels[i] == 0
+        for drug_name, (low, high) in (bounds or {}).items():
+            i = self.drug_names.index(drug_name)
+            allowed[i] &= (self.levels[i] >= low) & (self.levels[i] <= high)
+
+        found = []
+        n_found = 0
+        for lo in range(0, order.shape[0], chunk_size):
+            index = np.asarray(order[lo:lo + chunk_size])
+            mask = np.ones(index.shape[0], dtype=bool)
+            if sizes is not None:
+                mask &= np.isin(self.n_drugs[index], sizes)
+            digits = decode_index(index, self.n_levels)
+            for i in range(len(self.n_levels)):
+                mask &= allowed[i][digits[:, i]]
+
+            found.append(index[mask][0:top_k - n_found])
+            n_found += found[-1].shape[0]
+            if n_found == top_k:
+                break
+
+        return self._to_frame(np.concatenate(found), weights)
+
+    def _to_frame(self, index, weights):
+        digits = decode_index(index, self.n_levels)
+        conc = np.column_stack([self.levels[i][digits[:, i]] for i in range(len(self.n_levels))])
+        pred = np.asarray(self.outputs[index], dtype=float)
+
+        df = pd.DataFrame(conc, columns=self.drug_names)
+        for c, col in enumerate(PRED_COLUMNS[:pred.shape[1]]):
+            df[col] = pred[:, c]
+        df['Score'] = pred @ weights
+        df['Grid index'] = index
+
+        return df
+
+
+# score every row of the ranker's dose grid once and write the index, objectives: {name: output weights}
+def build_score_index(ranker, folder, objectives=None):
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    n_out = len(ranker.intercept)
+
+    outputs = np.lib.format.open_memmap(str(folder / 'outputs.npy'), mode='w+', dtype=np.float32,
+                                        shape=(ranker.n_grid, n_out))
+    n_drugs = np.lib.format.open_memmap(str(folder / 'n_drugs.npy'), mode='w+', dtype=np.uint8,
+                                        shape=(ranker.n_grid,))
+    for lo in range(0, ranker.n_grid, ranker.chunk_size):
+        index = np.arange(lo, min(lo + ranker.chunk_size, ranker.n_grid), dtype=np.int64)
+        conc = ranker._to_conc(decode_index(index, ranker.n_levels))
+        outputs[index] = score_block(conc, ranker.intercept, ranker.linear, ranker.quadratic)
+        n_drugs[index] = np.count_nonzero(conc, axis=1)
+    outputs.flush()
+    n_drugs.flush()
+    del outputs, n_drugs
+
+    meta = {'drug_names': ranker.drug_names, 'levels': [lv.tolist() for lv in ranker.levels],
+            'coef_digest': get_coef_digest(ranker.intercept, ranker.linear, ranker.quadratic), 'objectives': {}}
+    (folder / META).write_text(json.dumps(meta, indent=1))
+
+    index = ScoreIndex(folder)
+    for name, weights in (objectives or default_objectives(n_out)).items():
+        index.add_objective(name, weights)
+    print('...score index of', ranker.n_grid, 'grid rows has been saved.')
+
+    return index
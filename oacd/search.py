@@ -0,0 +1,95 @@
+import numpy as np
+
+from ranking import ComboRanker, push_topk
+
+
+# maximize %inhibition while penalizing the Vero E6 / AC16 / THLE-2 cytotoxicities
+def combined_objective(penalty=(1, 1, 1)):
+    return np.concatenate([[1.0], -np.asarray(penalty, dtype=float)])
+
+
+class BranchAndBoundRanker(ComboRanker):
+    # output
+    n_evaluated: int
+
+    # Depth-first search over drugs in grid order. A partial assignment is bounded by the exact score of the
+    # assigned drugs, their exact cross-terms with every free drug, and for each pair of free drugs the best
+    # interaction the later drug could add. A drug at zero dose contributes nothing, so with r drugs still to
+    # place the bound is the sum of the r largest per-drug gains. Nodes whose bound falls below the current
+    # K-th best score are pruned, which keeps the result identical to exhaustive ranking.
+    def rank(self):
+        if len(set(self.n_levels.tolist())) != 1:
+            raise ValueError('branch-and-bound search needs the same number of dose levels for every drug')
+
+        self._prepare_tables()
+        self.heaps = {}
+        self.n_evaluated = 0
+        for size in self.sizes:
+            heap = []
+            acc = self.unary.copy()
+            self._search(0, acc, self.offset, 0, 0, size, heap)
+            self.heaps[size] = heap
+
+        self.n_scored = self.n_evaluated
+
+        return self
+
+    def _prepare_tables(self):
+        conc = np.array(self.levels)
+        n_drugs = conc.shape[0]
+        lin = self.linear @ self.objective
+        quad = self.quadratic @ self.objective
+
+        self.offset = float(self.intercept @ self.objective)
+        self.is_zero = conc == 0
+        self.unary = lin[:, None] * conc + np.diag(quad)[:, None] * conc ** 2
+
+        # pair[i, j, a, b]: interaction of drug i at level a with drug j at level b, i < j
+        self.pair = np.zeros((n_drugs, n_drugs, conc.shape[1], conc.shape[1]))
+        for i in range(n_drugs):
+            for j in range(i + 1, n_drugs):
+                self.pair[i, j] = quad[i, j] * np.outer(conc[i], conc[j])
+
+        # tail[j, a]: best interaction drug j at level a can still get from every later drug
+        self.tail = self.pair.max(axis=3).sum(axis=1)
+        self.tol = 1e-9 * (1 + np.abs(self.unary).sum() + np.abs(self.pair).sum())
+
+    def _search(self, depth, acc, score, n_nonzero, index, size, heap):
+        self.n_evaluated += 1
+        n_drugs = acc.shape[0]
+        n_left = size - n_nonzero
+        if n_left < 0 or n_left > n_drugs - depth:
+            return
+
+        # no drug left to add: fill the remaining drugs with their zero dose
+        if n_left == 0:
+            for j in range(depth, n_drugs):
+                zero = int(np.flatnonzero(self.is_zero[j])[0])
+                score += acc[j, zero]
+                index = index * self.n_levels[j] + zero
+            push_topk(heap, np.array([score]), np.array([index]), self.top_k)
+            return
+
+        gain = acc[depth:] + self.tail[depth:]
+        zero_gain = np.where(self.is_zero[depth:], gain, -np.inf).max(axis=1)
+        dose_gain = np.where(self.is_zero[depth:], -np.inf, gain).max(axis=1)
+        extra = np.sort(dose_gain - zero_gain)[::-1][:n_left]
+        bound = score + zero_gain.sum() + extra.sum()
+        if len(heap) == self.top_k and bound < heap[0][0] - self.tol:
+            return
+
+        # most promising dose first so the heap threshold rises early
+        for level in np.argsort(-gain[0], kind='stable'):
+            child = acc.copy()
+            child[depth + 1:] += self.pair[depth, depth + 1:, level, :]
+            self._search(depth + 1, child, score + acc[depth, level], n_nonzero + (not self.is_zero[depth, level]),
+                         index * self.n_levels[depth] + int(level), size, heap)
+
+
+def search_top_combinations(model, df_conc_table, penalty=(1, 1, 1), sizes=(4, 3, 2), top_k=100):
+    ranker = BranchAndBoundRanker(model, df_conc_table, objective=combined_objective(penalty),
+                                  sizes=sizes, top_k=top_k)
+    ranker.rank()
+    print('...evaluated', ranker.n_evaluated, 'search nodes out of', ranker.n_grid, 'grid rows')
+
+    return ranker
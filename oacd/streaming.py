@@ -0,0 +1,216 @@
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from oacd import READOUTS, get_default_plate_map, get_sheet_plate_map
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.plates import BLANK, DMSO, CELLS, ROLE_NAMES
+from common.workbook import open_workbook
+
+# y-outputs per readout: %inhibition for the efficacy plate, %cytotoxicity for the others
+OUTPUTS = ['Inhibit', 'Vero', 'Cardiac', 'Liver']
+
+
+# Welford running count / mean / sum of squared deviations on flat arrays: a batch of values per cell is
+# merged with the pairwise update of Chan et al., index gives the flat cell of every value
+def welford_merge(count, mean, m2, index, values):
+    n_b = np.bincount(index, minlength=count.size).astype(float)
+    touched = n_b > 0
+    mean_b = np.bincount(index, weights=values, minlength=count.size)[touched] / n_b[touched]
+    full_mean_b = np.zeros(count.size)
+    full_mean_b[touched] = mean_b
+    m2_b = np.bincount(index, weights=(values - full_mean_b[index]) ** 2, minlength=count.size)[touched]
+
+    n_a = count[touched]
+    n = n_a + n_b[touched]
+    delta = mean_b - mean[touched]
+    mean[touched] += delta * n_b[touched] / n
+    m2[touched] += m2_b + delta ** 2 * n_a * n_b[touched] / n
+    count[touched] = n
+
+
+# inverse update for single values, index must not repeat
+def welford_remove(count, mean, m2, index, values):
+    n = count[index] - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        new_mean = np.where(n > 0, (count[index] * mean[index] - values) / n, 0)
+    m2[index] = np.where(n > 0, m2[index] - (values - new_mean) * (values - mean[index]), 0)
+    mean[index] = new_mean
+    count[index] = n
+
+
+# Plate-reader exports are long-format CSV files, one row per well:
+#   Plate (1-based control set), Readout (Eff/Vero/Cardiac/Liver), Role (blank/DMSO/no DMSO/cells/virus/test),
+#   Combo_ID (test wells only), Value
+# Control averages per plate and the per-combo replicate average/stdev are kept as running Welford statistics,
+# and every new file only re-normalizes the wells of the plates it touches.
+class StreamingResult(object):
+    # design
+    combo_ids: list
+    plate_map: np.ndarray
+
+    # running state
+    ctrl_count: np.ndarray
+    ctrl_mean: np.ndarray
+    ctrl_m2: np.ndarray
+    raw: np.ndarray
+    y: np.ndarray
+    y_count: np.ndarray
+    y_mean: np.ndarray
+    y_m2: np.ndarray
+    seen: set
+
+    def __init__(self, combo_ids, plate_map):
+        self.combo_ids = list(combo_ids)
+        self.row_index = {combo: i for i, combo in enumerate(self.combo_ids)}
+        self.plate_map = np.asarray(plate_map, dtype=int)
+        n_rows, n_rep = self.plate_map.shape
+        n_plates = int(self.plate_map.max()) + 1
+        n_roles = max(ROLE_NAMES.values()) + 1
+
+        self.ctrl_count = np.zeros((n_plates, n_roles, len(READOUTS)))
+        self.ctrl_mean = np.zeros((n_plates, n_roles, len(READOUTS)))
+        self.ctrl_m2 = np.zeros((n_plates, n_roles, len(READOUTS)))
+
+        self.raw = np.full((n_rows, n_rep, len(READOUTS)), np.nan)
+        self.y = np.full((n_rows, n_rep, len(OUTPUTS)), np.nan)
+        self.y_count = np.zeros((n_rows, len(OUTPUTS)))
+        self.y_mean = np.zeros((n_rows, len(OUTPUTS)))
+        self.y_m2 = np.zeros((n_rows, len(OUTPUTS)))
+        self.seen = set()
+
+    def ingest_file(self, file_name):
+        df = pd.read_csv(file_name)
+        plate = df['Plate'].values.astype(int) - 1
+        readout = np.array([READOUTS.index(r) for r in df['Readout']])
+        role = np.array([ROLE_NAMES[str(r).strip().lower()] for r in df['Role']])
+        value = df['Value'].values.astype(float)
+
+        # the whole file is parsed before any state changes, so a file that fails to parse can be ingested again
+        ctrl = (role != ROLE_NAMES['test']) & ~np.isnan(value)
+        index = np.ravel_multi_index((plate[ctrl], role[ctrl], readout[ctrl]), self.ctrl_count.shape)
+        test = role == ROLE_NAMES['test']
+        rows = np.array([self.row_index[combo] for combo in df['Combo_ID'].values[test]], dtype=int)
+
+        # control wells: running mean per (plate, role, readout)
+        welford_merge(self.ctrl_count.ravel(), self.ctrl_mean.ravel(), self.ctrl_m2.ravel(), index, value[ctrl])
+
+        # test wells: replicate column is the one the plate map assigns to this plate
+        reps = np.argmax(self.plate_map[rows] == plate[test][:, None], axis=1)
+        self.raw[rows, reps, readout[test]] = value[test]
+
+        affected = np.unique(plate)
+        self._normalize(affected)
+        self.seen.add(str(Path(file_name).resolve()))
+
+        return affected
+
+    def get_baseline(self, role):
+        with np.errstate(invalid='ignore'):
+            return np.where(self.ctrl_count[:, role, :] > 0, self.ctrl_mean[:, role, :], np.nan)
+
+    # same formulas as PlateArray.calc_cytotoxicity / calc_inhibition, only for wells of the affected plates
+    def _normalize(self, plates):
+        affected = np.isin(self.plate_map, plates)
+        rows, reps = np.nonzero(affected)
+        plate = self.plate_map[rows, reps]
+        raw = self.raw[rows, reps, :]
+
+        blank = np.nan_to_num(self.get_baseline(BLANK))[plate]
+        cell_vehicle = self.get_baseline(DMSO)[plate] - blank
+        cell_virus = self.get_baseline(DMSO)[plate]
+        cell_uninfected = self.get_baseline(CELLS)[plate]
+
+        y = np.empty((len(rows), len(OUTPUTS)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            y[:, 0] = (raw[:, 0] - cell_virus[:, 0]) / (cell_uninfected[:, 0] - cell_virus[:, 0]) * 100
+            y[:, 1:] = (cell_vehicle[:, 1:] - (raw[:, 1:] - blank[:, 1:])) / cell_vehicle[:, 1:] * 100
+
+        # replace the old replicate values in the running average/stdev, one replicate column at a time so
+        # that no (combo, output) cell is updated twice in the same pass
+        count, mean, m2 = self.y_count.ravel(), self.y_mean.ravel(), self.y_m2.ravel()
+        for r in range(self.plate_map.shape[1]):
+            sel = reps == r
+            index = np.ravel_multi_index(np.meshgrid(rows[sel], np.arange(len(OUTPUTS)), indexing='ij'),
+                                         self.y_count.shape).ravel()
+            old = self.y[rows[sel], r, :].ravel()
+            new = y[sel].ravel()
+
+            welford_remove(count, mean, m2, index[~np.isnan(old)], old[~np.isnan(old)])
+            welford_merge(count, mean, m2, index[~np.isnan(new)], new[~np.isnan(new)])
+            self.y[rows[sel], r, :] = y[sel]
+
+    # same layout as ExperimentResult after _average_stdev: Combo_ID, replicates, average, stdev
+    def get_result(self, output):
+        k = OUTPUTS.index(output)
+        df = pd.DataFrame(self.y[:, :, k], columns=['replicate ' + str(r + 1) for r in range(self.y.shape[1])])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            df['average'] = np.where(self.y_count[:, k] > 0, self.y_mean[:, k], np.nan)
+            df['stdev'] = np.where(self.y_count[:, k] > 1, np.sqrt(self.y_m2[:, k] / (self.y_count[:, k] - 1)),
+                                   np.nan)
+        df.insert(0, 'Combo_ID', self.combo_ids)
+
+        return df
+
+    # Polls a directory for new CSV exports, yields (file name, affected plates) as plates land. A file is
+    # ingested once its size and modification time held still over one poll, so an export the reader is still
+    # writing is not read half-way; a file that fails to parse is tried again on the next poll.
+    def watch(self, directory, poll_interval=2.0, timeout=None):
+        start = time.time()
+        last, failed = {}, {}
+        while timeout is None or time.time() - start < timeout:
+            stats = {}
+            for file_name in sorted(Path(directory).glob('*.csv')):
+                path = str(file_name.resolve())
+                if path in self.seen:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # removed in between
+                stats[path] = (stat.st_mtime_ns, stat.st_size)
+                if last.get(path) != stats[path]:
+                    continue
+
+                try:
+                    affected = self.ingest_file(file_name)
+                except Exception as e:
+                    if failed.get(path) != stats[path]:
+                        logging.warning('Could not ingest %s, retrying on the next poll: %r', file_name, e)
+                    failed[path] = stats[path]
+                    continue
+                yield file_name, affected + 1
+            last = stats
+            time.sleep(poll_interval)
+
+
+# design sheets (OACD, mono_X, optional Plate_map) of a workbook, plate data come from the CSV exports
+def from_design(file_name, n_sets, n_rep=3):
+    xls = open_workbook(file_name)
+    df_oacd = xls.parse('OACD')
+    df_mono_X = xls.parse('mono_X')
+    combo_ids = list(df_oacd.iloc[:, 0]) + list(df_mono_X.iloc[:, 0])
+
+    if 'Plate_map' in xls.sheet_names:
+        df = get_sheet_plate_map(xls.parse('Plate_map'), n_sets)
+        plate_map = df.loc[combo_ids].values.astype(int) - 1
+    else:
+        plate_map = np.vstack(get_default_plate_map(df_oacd.shape[0], df_mono_X.shape[0], n_sets, n_rep))
+
+    return StreamingResult(combo_ids, plate_map)
+
+
+if __name__ == '__main__':
+    file_design = 'OACD.xlsx'
+    dir_plates = './plates'
+
+    res = from_design(file_design, n_sets=6)
+    for file_name, plates in res.watch(dir_plates):
+        print('- ' + file_name.name + ': updated plate(s)', plates.tolist())
+        print(res.get_result('Inhibit')[['Combo_ID', 'average', 'stdev']].dropna().tail(3))
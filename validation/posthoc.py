@@ -0,0 +1,106 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.stats import adjust_pvalues
+
+
+# Kruskal-Wallis H and all pairwise Dunn z-scores from one ranking of the pooled replicates.
+# values: (groups x replicates), NaN replicates are dropped. Rank sums for many label permutations at once
+# are a (permutations x N) @ (N x groups) product, which keeps the permutation test in NumPy.
+def get_groups(values):
+    values = np.asarray(values, dtype=float)
+    mask = ~np.isnan(values)
+    group = np.nonzero(mask)[0]
+    onehot = np.zeros((group.shape[0], values.shape[0]))
+    onehot[np.arange(group.shape[0]), group] = 1
+
+    return values[mask], onehot
+
+
+def get_tie_term(ranks):
+    _, t = np.unique(ranks, return_counts=True)
+
+    return np.sum(t ** 3 - t)
+
+
+# ranks: (permutations x N), returns H (permutations,) and Dunn z (permutations x groups x groups)
+def calc_statistics(ranks, onehot, tie_term):
+    n_obs = ranks.shape[1]
+    n_group = onehot.sum(axis=0)
+    mean_rank = (ranks @ onehot) / n_group
+
+    tie_corr = 1 - tie_term / (n_obs ** 3 - n_obs)
+    h = 12 / (n_obs * (n_obs + 1)) * np.sum(n_group * (mean_rank - (n_obs + 1) / 2) ** 2, axis=1) / tie_corr
+
+    sigma2 = n_obs * (n_obs + 1) / 12 - tie_term / (12 * (n_obs - 1))
+    se = np.sqrt(sigma2 * (1 / n_group[:, None] + 1 / n_group[None, :]))
+    z = (mean_rank[:, :, None] - mean_rank[:, None, :]) / se
+
+    return h, z
+
+
+_shared = None
+
+
+def _init_worker(ranks, onehot, tie_term, h_obs, z_obs):
+    global _shared
+    _shared = (ranks, onehot, tie_term, h_obs, z_obs)
+
+
+def count_exceedances(ranks, onehot, tie_term, h_obs, z_obs, n_perm, seed):
+    rng = np.random.default_rng(seed)
+    perm = np.argsort(rng.random((n_perm, ranks.shape[0])), axis=1)
+    h, z = calc_statistics(ranks[perm], onehot, tie_term)
+
+    # single-step max-T: a pair is compared against the largest |z| of every permutation
+    iu = np.triu_indices(onehot.shape[1], k=1)
+    z_max = np.abs(z[:, iu[0], iu[1]]).max(axis=1)
+
+    return np.sum(h >= h_obs), np.sum(z_max[:, None] >= np.abs(z_obs[iu])[None, :], axis=0)
+
+
+def _run_chunk(n_perm, seed):
+    return count_exceedances(*_shared, n_perm, seed)
+
+
+def kruskal_dunn(values, labels=None, p_adjust='bonferroni', n_perm=0, seed=0, max_workers=None, chunk_size=500):
+    y, onehot = get_groups(values)
+    n_obs, n_groups = onehot.shape
+    labels = list(range(1, n_groups + 1)) if labels is None else list(labels)
+
+    ranks = stats.rankdata(y)
+    tie_term = get_tie_term(ranks)
+    h, z = calc_statistics(ranks[None, :], onehot, tie_term)
+    h, z = h[0], z[0]
+
+    iu = np.triu_indices(n_groups, k=1)
+    p_pair = 2 * stats.norm.sf(np.abs(z[iu]))
+
+    df_kw = pd.DataFrame({'H': [h], 'df': [n_groups - 1], 'p': [stats.chi2.sf(h, n_groups - 1)],
+                          'effect size': [h / ((n_obs ** 2 - 1) / (n_obs + 1))], 'N': [n_obs]})
+    df_dunn = pd.DataFrame({'group 1': np.array(labels)[iu[0]], 'group 2': np.array(labels)[iu[1]],
+                            'z': z[iu], 'p': p_pair, 'p adj': adjust_pvalues(p_pair, p_adjust)})
+
+    if n_perm > 0:
+        sizes = [min(chunk_size, n_perm - i) for i in range(0, n_perm, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        args = (ranks, onehot, tie_term, h, z)
+
+        max_workers = max_workers or os.cpu_count() or 1
+        if max_workers == 1 or len(sizes) == 1:
+            parts = [count_exceedances(*args, n, s) for n, s in zip(sizes, seeds)]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=args) as pool:
+                parts = list(pool.map(_run_chunk, sizes, seeds))
+
+        df_kw['p perm'] = (1 + sum(p[0] for p in parts)) / (1 + n_perm)
+        df_dunn['p perm'] = (1 + sum(p[1] for p in parts)) / (1 + n_perm)
+
+    return df_kw, df_dunn
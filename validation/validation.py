@@ -1,15 +1,22 @@
+import argparse
+import sys
 import pandas as pd
-from scipy import stats
-import scikit_posthocs as sp
-import matplotlib.pyplot as plt
 from pathlib import Path
 import numpy as np
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.figures import FigureJob, render_all
+from common.plates import DMSO, CELLS, from_sheet
+from common.profiling import add_profile_argument, get_profiler
+from common.store import add_store_arguments, open_result_store, save_tables
+from common.workbook import open_workbook
+from posthoc import kruskal_dunn
+
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
 def get_raw_data(file_name, sheet_name):
-    df = pd.read_excel(file_name, sheet_name=sheet_name).astype(float)
+    df = open_workbook(file_name).parse(sheet_name).astype(float)
 
     return df
 
@@ -23,33 +30,19 @@ def subtract_blank(df):
     return df
 
 
-def get_control(df, extra_str):
-    upper_bound = df['DMSO (G10-12)'].mean()
-    lower_bound = 0
-
-    if 'viral plate' in extra_str:
-        lower_bound = upper_bound
-        upper_bound = df['Cells+media (H)'].mean()
-
-    return upper_bound, lower_bound
-
-
 def calculate_y(df, extra_str):
-    # test drug wells
-    exp_well = df.iloc[:, 1:4]
-
-    # control wells
-    cell_vehicle, cell_virus = get_control(df, extra_str)
+    # test drug wells and control wells, blank wells are already subtracted by subtract_blank
+    plate = from_sheet(df, {'DMSO (G10-12)': DMSO, 'Cells+media (H)': CELLS})
 
     # calculate inhibition for viral plate, or cytotoxicity for drug plates
     if 'viral plate' in extra_str:
-        df = (exp_well - cell_virus) / (cell_vehicle - cell_virus) * 100
+        y = plate.calc_inhibition(lower=DMSO, upper=CELLS)
     elif 'drug plate' in extra_str:
-        df = (cell_vehicle - exp_well) / cell_vehicle * 100
+        y = plate.calc_cytotoxicity(vehicle=DMSO)
     else:
         raise ValueError('wrong plate name: ' + extra_str)
 
-    return df
+    return pd.DataFrame(plate.get_test(y).reshape(-1, 3), columns=df.columns[1:4])
 
 
 def get_average_stdev(df):
@@ -80,107 +73,84 @@ def compile_result(x, df_inhibition, df_cyt_vero, df_cyt_ac, df_cyt_thle):
     return df, df_inhibition, df_cyt_vero, df_cyt_ac, df_cyt_thle
 
 
-def save_file(filename, x, df_avg, df1, df2, df3, df4):
+def get_result_tables(x, df_avg, df1, df2, df3, df4):
 
     sheet_names = ['All results', 'Inhibition', 'VeroE6', 'AC16', 'THLE-2']
     df_list = [df_avg, df1, df2, df3, df4]
 
-    writer = pd.ExcelWriter(filename, engine='xlsxwriter')
-
     x = x.iloc[:, 0]
-    for i, df in enumerate(df_list):
-        df = pd.concat([x, df], axis=1, sort=False)
-        df.to_excel(writer, sheet_name=sheet_names[i], index=False)
+
+    return {sheet_name: pd.concat([x, df], axis=1, sort=False) for sheet_name, df in zip(sheet_names, df_list)}
+
+
+def write_excel(filename, tables):
+    writer = pd.ExcelWriter(filename, engine='xlsxwriter')
+    for sheet_name, df in tables.items():
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
 
     writer.save()
     print('...data have been saved.')
 
 
-def do_non_normality_procedure(df, combo, file_name, fig_name):
+def save_file(filename, x, df_avg, df1, df2, df3, df4):
+    write_excel(filename, get_result_tables(x, df_avg, df1, df2, df3, df4))
+
+
+def do_non_normality_procedure(df, combo, file_name, fig_name, n_perm=0):
     index = [i - 1 for i in combo]
     df = df.iloc[index, :]
 
-    args = (df.iloc[i, :].values for i in range(df.shape[0]))
-    hstats, p = stats.kruskal(*args)
-
-    effect_size = hstats / (((len(combo)*3)**2 - 1)/(len(combo)*3+1))
+    df_kw, df_dunn = kruskal_dunn(df.values, labels=combo, p_adjust='bonferroni', n_perm=n_perm)
+    df_kw.insert(0, 'Output', fig_name)
+    df_dunn.insert(0, 'Output', fig_name)
+    df_dunn['significant'] = df_dunn['p adj'] < 0.05
 
+    hstats, p, effect_size = df_kw.loc[0, ['H', 'p', 'effect size']]
     if p < 0.05:
         print('Kruskal-Wallis test: p =', p, 'H =', hstats, 'effect size =', effect_size, '--> do post-hoc Dunn test')
-        heatmap = sp.posthoc_dunn(df.values, p_adjust='bonferroni')
-
-
-        print('Dunn\'s pairwise test: no significant pairs unless stated below')
-
-        r, c = np.where(heatmap.values < 0.05)
-        for i, j in zip(r, c):
-            if i != j:
-                print('Combo:', combo[i], combo[j], ', value:', heatmap.iloc[i, j])
+        print('Dunn\'s pairwise test:', df_dunn['significant'].sum(), 'significant pairs out of', df_dunn.shape[0])
     else:
         print('Kruskal-Wallis test: no significant difference, p =', p, 'H', hstats, 'effect size =', effect_size)
+        df_dunn['significant'] = False
 
+    return df_kw, df_dunn
 
-def plot_barplot(df, x_label, file_name, fig_name):
 
-    x = np.arange(df.shape[0])
-    y = df.mean(axis=1)
-    error_bar = df.std(axis=1)
+def save_stats(filename, results):
+    writer = pd.ExcelWriter(filename, engine='xlsxwriter')
+    pd.concat([r[0] for r in results], ignore_index=True).to_excel(writer, sheet_name='Kruskal-Wallis', index=False)
+    pd.concat([r[1] for r in results], ignore_index=True).to_excel(writer, sheet_name='Dunn', index=False)
+    writer.save()
+    print('...statistical tests have been saved.')
 
-    fig, ax = plt.subplots(figsize=(20, 8))
-    ax.set_xticks(x)
-    ax.set_xticklabels(x_label, fontsize=23)
-    # ax.set_xlabel('Drug Combination Number', fontsize=23)
-    ax.set_ylabel(fig_name, fontsize=23)
-    ax.yaxis.set_tick_params(labelsize=23)
 
-    ax.bar(x, y, yerr=error_bar, align='center', ecolor='black', capsize=5)
+def get_barplot_job(df, x_label, file_name, fig_name):
+    series = [{'x': np.arange(df.shape[0]), 'y': df.mean(axis=1).values, 'err': df.std(axis=1).values}]
+    data = {'series': series, 'xticks': np.arange(df.shape[0]), 'xticklabels': list(x_label), 'ylabel': fig_name}
 
-    Path("./barplots").mkdir(parents=True, exist_ok=True)
-    plt.savefig('./barplots/' + file_name + '_' + fig_name + '.png')
-    plt.close(fig)
+    return FigureJob('bar', './barplots/' + file_name + '_' + fig_name + '.png', data)
 
 
-def plot_multi_barplot(df1, df2, df3, combo, custom_order, labels, file_name, fig_name):
+def get_multi_barplot_job(df1, df2, df3, combo, custom_order, labels, file_name, fig_name):
 
     df1, x_label = sort_df(df1, combo, custom_order)
     df2, _ = sort_df(df2, combo, custom_order)
     df3, _ = sort_df(df3, combo, custom_order)
 
-    y1 = df1.mean(axis=1)
-    y2 = df2.mean(axis=1)
-    y3 = df3.mean(axis=1)
-    err1 = df1.std(axis=1)
-    err2 = df2.std(axis=1)
-    err3 = df3.std(axis=1)
-
     bar_width = 7
     x1 = np.arange(len(combo)) * 30 - 4
-    x2 = [i + bar_width for i in x1]
-    x3 = [i + bar_width for i in x2]
-
-    fig, ax = plt.subplots(figsize=(20, 8))
-    # Make the plot
-    ax.bar(x1, y1, color='gray', width=bar_width, edgecolor='white', label=labels[0],
-           yerr=err1, align='center', ecolor='black', capsize=5)
-    ax.bar(x2, y2, color='orange', width=bar_width, edgecolor='white', label=labels[1],
-           yerr=err2, align='center', ecolor='black', capsize=5)
-    ax.bar(x3, y3, color='indigo', width=bar_width, edgecolor='white', label=labels[2],
-           yerr=err3, align='center', ecolor='black', capsize=5)
-
-    ax.set_xticks([r*30 + 5 for r in range(len(df1))])
-    ax.set_xticklabels(x_label, fontsize=23)
-    # ax.set_xlabel('Drug Combination Number', fontsize=23)
-    ax.set_ylabel(fig_name, fontsize=23)
-    ax.yaxis.set_tick_params(labelsize=23)
-    ax.legend(bbox_to_anchor=(0.95, 1, 0, 0), loc='upper left', fontsize=23)
-
-    # Hide the right and top spines
-    ax.spines['right'].set_visible(False)
-    ax.spines['top'].set_visible(False)
-
-    Path("./barplots").mkdir(parents=True, exist_ok=True)
-    plt.savefig('./barplots/' + file_name + '_' + fig_name + '.png')
-    plt.close(fig)
+    x2 = x1 + bar_width
+    x3 = x2 + bar_width
+
+    series = []
+    for x, df, color, label in zip([x1, x2, x3], [df1, df2, df3], ['gray', 'orange', 'indigo'], labels):
+        series.append({'x': x, 'y': df.mean(axis=1).values, 'err': df.std(axis=1).values,
+                       'color': color, 'width': bar_width, 'label': label})
+    data = {'series': series, 'xticks': [r*30 + 5 for r in range(len(df1))], 'xticklabels': list(x_label),
+            'ylabel': fig_name, 'legend': True, 'hide_spines': True}
+
+    return FigureJob('bar', './barplots/' + file_name + '_' + fig_name + '.png', data)
+
 
 def sort_df(df, combo, custom_order):
     df['combo_id'] = list(range(1, 28))
@@ -199,44 +169,64 @@ def sort_df(df, combo, custom_order):
 def validate_y_output(df, combo, custom_order, file_name, fig_name):
     print(file_name, fig_name)
 
-    do_non_normality_procedure(df, combo, file_name, fig_name)
+    result = do_non_normality_procedure(df, combo, file_name, fig_name)
 
-    # bar graphs for visualisation
+    # bar graphs for visualisation, rendered together by render_all
     df, x_label = sort_df(df, combo, custom_order)
-    plot_barplot(df, x_label, file_name, fig_name)
+    job = get_barplot_job(df, x_label, file_name, fig_name)
 
     print()
 
+    return result, job
 
-if __name__ == '__main__':
-    file_input = 'Validation.xlsx'
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Validation normalization, statistical tests and bar plots.')
+    parser.add_argument('input', nargs='?', default='Validation.xlsx', help='input workbook, default: Validation.xlsx')
+    add_profile_argument(parser, 'validation')
+    add_store_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    file_input = args.input
     file_output = 'Validation_result.xlsx'
+    file_stats = 'Validation_stats.xlsx'
+    folder_store = './results/validation'
 
-    df_eff = get_raw_data(file_input, 'exp3_viral')
-    df_veroe6 = get_raw_data(file_input, 'exp3_veroe6')
-    df_ac16 = get_raw_data(file_input, 'exp3_ac16')
-    df_ac16_2 = get_raw_data(file_input, 'exp3_ac16_2')
-    df_thle2 = get_raw_data(file_input, 'exp3_thle2')
-    df_thle2_2 = get_raw_data(file_input, 'exp3_thle2_2')
+    profiler = get_profiler('validation', argv)
 
-    # if these 2 tabs have blank wells
-    df_ac16 = subtract_blank(df_ac16)
-    df_ac16_2 = subtract_blank(df_ac16_2)
-    df_thle2 = subtract_blank(df_thle2)
-    df_thle2_2 = subtract_blank(df_thle2_2)
+    with profiler.stage('read_input') as record:
+        df_eff = get_raw_data(file_input, 'exp3_viral')
+        df_veroe6 = get_raw_data(file_input, 'exp3_veroe6')
+        df_ac16 = get_raw_data(file_input, 'exp3_ac16')
+        df_ac16_2 = get_raw_data(file_input, 'exp3_ac16_2')
+        df_thle2 = get_raw_data(file_input, 'exp3_thle2')
+        df_thle2_2 = get_raw_data(file_input, 'exp3_thle2_2')
 
-    x = get_raw_data(file_input, 'exp2_result')
+        # if these 2 tabs have blank wells
+        df_ac16 = subtract_blank(df_ac16)
+        df_ac16_2 = subtract_blank(df_ac16_2)
+        df_thle2 = subtract_blank(df_thle2)
+        df_thle2_2 = subtract_blank(df_thle2_2)
 
-    # calculate inhibition and cytotoxicity
-    df_inhibition = calculate_y(df_eff, 'viral plate')
-    df_cyt_vero = calculate_y(df_veroe6, 'drug plate')
-    df_cyt_ac = calculate_y(df_ac16, 'drug plate')
-    df_cyt_ac_2 = calculate_y(df_ac16_2, 'drug plate')
-    df_cyt_thle = calculate_y(df_thle2, 'drug plate')
-    df_cyt_thle_2 = calculate_y(df_thle2_2, 'drug plate')
+        x = get_raw_data(file_input, 'exp2_result')
+        record['rows'] = sum(df.shape[0] for df in [df_eff, df_veroe6, df_ac16, df_ac16_2, df_thle2, df_thle2_2, x])
 
-    df_cyt_ac = pd.concat([df_cyt_ac, df_cyt_ac_2], ignore_index=True)
-    df_cyt_thle = pd.concat([df_cyt_thle, df_cyt_thle_2], ignore_index=True)
+    # calculate inhibition and cytotoxicity
+    with profiler.stage('calculate_y') as record:
+        df_inhibition = calculate_y(df_eff, 'viral plate')
+        df_cyt_vero = calculate_y(df_veroe6, 'drug plate')
+        df_cyt_ac = calculate_y(df_ac16, 'drug plate')
+        df_cyt_ac_2 = calculate_y(df_ac16_2, 'drug plate')
+        df_cyt_thle = calculate_y(df_thle2, 'drug plate')
+        df_cyt_thle_2 = calculate_y(df_thle2_2, 'drug plate')
+
+        df_cyt_ac = pd.concat([df_cyt_ac, df_cyt_ac_2], ignore_index=True)
+        df_cyt_thle = pd.concat([df_cyt_thle, df_cyt_thle_2], ignore_index=True)
+        record['rows'] = sum(df.shape[0] for df in [df_inhibition, df_cyt_vero, df_cyt_ac, df_cyt_thle])
 
     # statistical test
     # note: delete 2 extra drugs in combo_A [2,3], and custom_order_A [15,16] before running stats tests
@@ -250,18 +240,33 @@ if __name__ == '__main__':
 
 
     # stats tests + plot single bar plot
-    validate_y_output(df_inhibition, combo_A, custom_order_A, 'fig2a', '% Inhibition')
-    validate_y_output(df_cyt_vero, combo_A, custom_order_A, 'fig2b_temp',  '% Vero E6 Cytotoxicity')
-    validate_y_output(df_cyt_ac, combo_A, custom_order_A, 'fig2b_temp',  '% AC16 Cytotoxicity')
-    validate_y_output(df_cyt_thle, combo_A, custom_order_A, 'fig2b_temp', '% THLE-2 Cytotoxicity')
+    with profiler.stage('stats_tests', rows=4 * len(combo_A)):
+        stats_results, jobs = zip(
+            validate_y_output(df_inhibition, combo_A, custom_order_A, 'fig2a', '% Inhibition'),
+            validate_y_output(df_cyt_vero, combo_A, custom_order_A, 'fig2b_temp',  '% Vero E6 Cytotoxicity'),
+            validate_y_output(df_cyt_ac, combo_A, custom_order_A, 'fig2b_temp',  '% AC16 Cytotoxicity'),
+            validate_y_output(df_cyt_thle, combo_A, custom_order_A, 'fig2b_temp', '% THLE-2 Cytotoxicity'))
+        save_stats(file_stats, stats_results)
 
     # plot multiple bar plots: Cytotox
-    plot_multi_barplot(df_cyt_vero, df_cyt_ac, df_cyt_thle, combo_A, custom_order_A,
-                     ['Vero E6', 'AC16', 'THLE-2'], 'fig2b', '% Cytotoxicity')
+    with profiler.stage('barplots') as record:
+        jobs += (get_multi_barplot_job(df_cyt_vero, df_cyt_ac, df_cyt_thle, combo_A, custom_order_A,
+                                       ['Vero E6', 'AC16', 'THLE-2'], 'fig2b', '% Cytotoxicity'),)
+        render_all(list(jobs))
+        record['rows'] = len(jobs)
 
 
-    # compile results and save to Excel
-    df_avg, df_inhibition, df_cyt_vero, df_cyt_ac, df_cyt_thle = compile_result(x,
-                                                                                df_inhibition, df_cyt_vero,
-                                                                                df_cyt_ac, df_cyt_thle)
-    save_file(file_output, x, df_avg, df_inhibition, df_cyt_vero, df_cyt_ac, df_cyt_thle)
+    # compile results into the result store and/or the Excel file
+    with profiler.stage('save_results') as record:
+        df_avg, df_inhibition, df_cyt_vero, df_cyt_ac, df_cyt_thle = compile_result(x,
+                                                                                    df_inhibition, df_cyt_vero,
+                                                                                    df_cyt_ac, df_cyt_thle)
+        tables = get_result_tables(x, df_avg, df_inhibition, df_cyt_vero, df_cyt_ac, df_cyt_thle)
+        save_tables(open_result_store(folder_store, args.store), file_output, tables, write_excel, args.excel)
+        record['rows'] = sum(df.shape[0] for df in tables.values())
+
+    profiler.save()
+
+
+if __name__ == '__main__':
+    main()